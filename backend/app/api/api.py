@@ -1,20 +1,144 @@
 import logging
+import os
+import json
+import base64
+import time
+from datetime import datetime
+import tempfile
+from typing import List, Optional
 from fastapi import (
     FastAPI,
     UploadFile,
-    File
+    File,
+    Query,
+    Depends,
+    Header,
+    HTTPException
 )
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, Response
+from starlette.background import BackgroundTask
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pymongo.errors import PyMongoError
+from starlette.routing import Match
 from core.core_functions import CoreFunctions
-from db.db_client import db
+from core.data_models import PredictionConfig, OutputConfig
+from core.video_pipeline import video_file_frames, encoded_frames
+from core.worker_pool import PoolSaturatedError
+from core.pagination import InvalidCursorError
+from core.uploads import (
+    UploadLimitMiddleware,
+    UploadTooLargeError,
+    UnsupportedImageError,
+    InvalidImageError,
+    read_upload,
+    check_spooled_upload,
+    spooled_uploads,
+)
+from ml.model_catalog import UnknownModelError
+from ml.nms import NMS_BACKEND
+from db.db_client import db_client
+from util.metrics import REQUESTS, REQUEST_SECONDS, ERRORS, server_timing
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 logger = logging.getLogger(__name__)
 
-data_model = CoreFunctions(db=db)
+data_model = CoreFunctions(db_client=db_client)
 
 app = FastAPI()
+# Added before the metrics middleware, so the rejected uploads are counted
+app.add_middleware(UploadLimitMiddleware)
+
+def route_path(scope) -> str:
+    """Path template of the route, so the metrics have one series per route instead of one per id."""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def metrics_middleware(request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Streamed responses are timed until their headers are sent
+        route = route_path(request.scope)
+        REQUEST_SECONDS.labels(route).observe(time.perf_counter() - start)
+        REQUESTS.labels(route, request.method, str(status)).inc()
+        if status >= 500:
+            ERRORS.labels("request").inc()
+
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_handler(request, exc: PoolSaturatedError):
+    logging.warning(f"Backpressure on {request.url.path}: {exc}")
+    return JSONResponse(status_code=503, content={"detail": "Server busy, retry later"}, headers={"Retry-After": "1"})
+
+@app.exception_handler(UploadTooLargeError)
+async def upload_too_large_handler(request, exc: UploadTooLargeError):
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+@app.exception_handler(UnsupportedImageError)
+async def unsupported_image_handler(request, exc: UnsupportedImageError):
+    return JSONResponse(status_code=415, content={"detail": str(exc)})
+
+@app.exception_handler(InvalidImageError)
+async def invalid_image_handler(request, exc: InvalidImageError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+@app.exception_handler(UnknownModelError)
+async def unknown_model_handler(request, exc: UnknownModelError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+def prediction_config(
+    score_thr: Optional[float] = Query(None, ge=0, le=1),
+    nms_thr: Optional[float] = Query(None, ge=0, le=1),
+    conf: Optional[float] = Query(None, ge=0, le=1),
+    class_agnostic: Optional[bool] = Query(None),
+    model: Optional[str] = Query(None),
+    latency_budget_ms: Optional[float] = Query(None, gt=0),
+    tiled: Optional[bool] = Query(None),
+    tile_size: Optional[int] = Query(None, ge=32, le=4096),
+    tile_overlap: Optional[float] = Query(None, ge=0, lt=1),
+    tile_merge: Optional[str] = Query(None, regex="^(nms|wbf)$"),
+) -> PredictionConfig:
+    if class_agnostic and NMS_BACKEND == "onnx":
+        # The NMS embedded in the graph is always per class
+        raise HTTPException(status_code=400, detail="class_agnostic isn't supported with NMS_BACKEND=onnx")
+    # Parameters not given in the request keep the PredictionConfig defaults
+    params = {"score_thr": score_thr, "nms_thr": nms_thr, "conf": conf, "class_agnostic": class_agnostic,
+              "model": model, "latency_budget_ms": latency_budget_ms,
+              "tiled": tiled, "tile_size": tile_size, "tile_overlap": tile_overlap, "tile_merge": tile_merge}
+    return PredictionConfig(**{name: value for name, value in params.items() if value is not None})
+
+def output_config(
+    mode: str = Query("image", regex="^(image|json|boxes)$"),
+    format: str = Query("png", regex="^(png|jpeg|webp)$"),
+    quality: int = Query(90, ge=1, le=100),
+    layout: str = Query("crops", regex="^(crops|columnar)$"),
+    preview_size: Optional[int] = Query(None, ge=0),
+) -> OutputConfig:
+    params = {"preview_size": preview_size} if preview_size is not None else {}
+    return OutputConfig(mode=mode, format=format, quality=quality, layout=layout, **params)
+
+def format_records(records, output: str):
+    for record in records:
+        line = json.dumps(record, default=lambda value: value.item())
+        if output == "sse":
+            event = next((name for name in ("summary", "error") if name in record), "frame")
+            yield f"event: {event}\ndata: {line}\n\n"
+        else:
+            yield line + "\n"
+
+def stream_records(records, output: str) -> StreamingResponse:
+    media_type = "text/event-stream" if output == "sse" else "application/x-ndjson"
+    # Closing the stream once the response is done frees it even if it was never iterated
+    return StreamingResponse(format_records(records, output), media_type=media_type,
+                             background=BackgroundTask(records.close))
 
 @app.get("/health")
 async def health():
@@ -22,24 +146,156 @@ async def health():
     return f"AI worker up and running"
 
 @app.post("/upload-image/")
-async def handle_image(file: UploadFile = File(...)):
-    logging.info(f"Image upload initiated: {file.filename}")
-    contents = await file.read()
-    predicted_image_bytes = await data_model.predict_yolox(imag_bytes=contents, filename = file.filename)
-    logging.info(f"Image predicted!")
-    return StreamingResponse(predicted_image_bytes, media_type="image/png")
+async def handle_image(
+    response: Response,
+    file: UploadFile = File(...),
+    config: PredictionConfig = Depends(prediction_config),
+    output: OutputConfig = Depends(output_config),
+):
+    start = time.perf_counter()
+    # Rejected before decoding when it isn't an image or is over MAX_IMAGE_UPLOAD_MB
+    contents = await read_upload(file)
+    config = data_model.resolve_model(config)
+    timings = {}
+    predicted_image_bytes, detections = await data_model.predict_yolox(
+        imag_bytes=contents, filename=file.filename, config=config, output=output, timings=timings
+    )
+    timings["total"] = time.perf_counter() - start
+    response.headers["Server-Timing"] = server_timing(timings)
+    if output.mode != "image":
+        # Only the requested shape of the detections is built
+        detections = detections.to_columnar() if output.layout == "columnar" else detections.to_crops()
+    if output.mode == "json":
+        return {"model": config.model, "detections": detections}
+    if output.mode == "boxes":
+        # The uploaded bytes are sent back as they are, the client draws the boxes
+        return {
+            "image": base64.b64encode(contents).decode(),
+            "mediaType": file.content_type,
+            "model": config.model,
+            "detections": detections,
+        }
+    return Response(predicted_image_bytes, media_type=f"image/{output.format}",
+                    headers={"X-Model": config.model, "Server-Timing": response.headers["Server-Timing"]})
+
+@app.post("/upload-video/")
+async def handle_video(
+    file: UploadFile = File(...),
+    config: PredictionConfig = Depends(prediction_config),
+    frame_stride: int = Query(1, ge=1),
+    max_fps: Optional[float] = Query(None, gt=0),
+    output: str = Query("ndjson", regex="^(ndjson|sse)$"),
+):
+    logging.info(f"Video upload initiated: {file.filename}")
+    # OpenCV needs a path to decode a video, the upload is copied to a temporary file in chunks
+    suffix = os.path.splitext(file.filename or "")[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as video_file:
+        while chunk := await file.read(1024 * 1024):
+            video_file.write(chunk)
+    records = data_model.detect_video(video_file_frames(video_file.name), config, frame_stride=frame_stride,
+                                      max_fps=max_fps, cleanup_path=video_file.name)
+    return stream_records(records, output)
+
+@app.post("/upload-frames/")
+async def handle_frames(
+    files: List[UploadFile] = File(...),
+    config: PredictionConfig = Depends(prediction_config),
+    frame_stride: int = Query(1, ge=1),
+    fps: Optional[float] = Query(None, gt=0),
+    max_fps: Optional[float] = Query(None, gt=0),
+    output: str = Query("ndjson", regex="^(ndjson|sse)$"),
+):
+    logging.info(f"Frames upload initiated: {len(files)} frames")
+    if max_fps is not None and fps is None:
+        raise HTTPException(status_code=400, detail="max_fps needs the fps the frames were captured at")
+    for file in files:
+        check_spooled_upload(file)
+    # The frames are read from the spooled uploads one at a time by the decode stage
+    records = data_model.detect_video(encoded_frames(spooled_uploads(files), fps=fps), config,
+                                      frame_stride=frame_stride, max_fps=max_fps)
+    return stream_records(records, output)
+
+@app.post("/upload-batch/", status_code=202)
+async def handle_batch(files: List[UploadFile] = File(...), config: PredictionConfig = Depends(prediction_config)):
+    logging.info(f"Batch upload initiated: {len(files)} files")
+    # The uploads are closed with the request, the job reads its own copy of them
+    upload_dir = tempfile.mkdtemp(prefix="batch-")
+    uploads = []
+    for index, file in enumerate(files):
+        filename = os.path.basename(file.filename or f"image-{index}")
+        path = os.path.join(upload_dir, f"{index}-{filename}")
+        with open(path, "wb") as upload_file:
+            while chunk := await file.read(1024 * 1024):
+                upload_file.write(chunk)
+        uploads.append((path, filename))
+    try:
+        job = data_model.start_batch_job(upload_dir, uploads, config)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch upload: {e}")
+    return {"jobId": job.id, "total": job.total, "statusUrl": f"/batch-jobs/{job.id}"}
+
+@app.get("/batch-jobs")
+async def list_batch_jobs():
+    return [job.to_dict() for job in data_model.batch_jobs.list()]
+
+@app.get("/batch-jobs/{job_id}")
+async def get_batch_job(job_id: str):
+    job = data_model.batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Batch job {job_id} not found")
+    return job.to_dict()
+
+@app.get("/metrics")
+async def metrics():
+    # Passed as a header, media_type would get a second charset appended
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+@app.get("/worker-pool-stats")
+async def worker_pool_stats():
+    return data_model.worker_pool.stats()
+
+@app.get("/models")
+async def models():
+    return data_model.get_catalog().stats()
+
+@app.get("/result-cache-stats")
+async def result_cache_stats():
+    return data_model.result_cache.stats()
+
+@app.get("/hot-image-cache-stats")
+async def hot_image_cache_stats():
+    return data_model.hot_images.stats()
+
+@app.get("/persistence-stats")
+async def persistence_stats():
+    return data_model.writer.stats()
 
 @app.get("/list-images")
-async def list_images():
-    logging.info("Returning all images!")
-    images = data_model.list_images()
-    return images
+async def list_images(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None),
+    original_file_name: Optional[str] = Query(None),
+):
+    logging.info("Returning a page of images!")
+    try:
+        return await data_model.list_images(limit, cursor, original_file_name)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/get-image/{id}")
-async def get_image(id: str):
+async def get_image(id: str, if_none_match: Optional[str] = Header(None), if_modified_since: Optional[str] = Header(None)):
     logging.info(f"Getting content for image with id: {id}")
-    image_bytes = await data_model.get_bytes_from_image_id(id)
-    return StreamingResponse(image_bytes, media_type="image/png")
+    image_file = await data_model.get_image_file(id)
+    if image_file is None:
+        raise HTTPException(status_code=404, detail=f"Image {id} not found")
+    if image_file.is_not_modified(if_none_match, if_modified_since):
+        return Response(status_code=304, headers=image_file.headers)
+    content = await data_model.get_hot_image_bytes(image_file)
+    if content is not None:
+        return Response(content, media_type=image_file.media_type, headers=image_file.headers)
+    # Streamed from disk in chunks as stored, without decoding and encoding it again
+    return FileResponse(image_file.path, media_type=image_file.media_type, headers=image_file.headers,
+                        stat_result=image_file.stat)
 
 @app.get("/get-histogram-data/{id}")
 async def get_histogram_data(id: str):
@@ -54,8 +310,37 @@ async def get_summary():
     logging.info("Summary properly fetched")
     return summary
 
+@app.get("/get-summary-stats")
+async def get_summary_stats(
+    date_from: Optional[datetime] = Query(None),
+    date_to: Optional[datetime] = Query(None),
+    classes: Optional[List[str]] = Query(None),
+    top_images: int = Query(20, ge=1, le=200),
+):
+    logging.info("Getting summary statistics!")
+    try:
+        return await data_model.get_summary_stats(date_from, date_to, classes, top_images)
+    except PyMongoError:
+        raise HTTPException(status_code=503, detail="Summary statistics unavailable, the database query failed")
+
+@app.get("/get-stats")
+async def get_stats(
+    granularity: str = Query("day", regex="^(hour|day)$"),
+    date_from: Optional[datetime] = Query(None),
+    date_to: Optional[datetime] = Query(None),
+):
+    logging.info("Getting materialized statistics!")
+    return await data_model.get_stats(granularity, date_from, date_to)
+
 @app.on_event("startup")
 async def startup_event():
+    logging.info("Connecting to the database!")
+    await data_model.connect_db()
     logging.info("Loading model!")
     await data_model.load_model()
-    logging.info("Model loaded succesfully!")
\ No newline at end of file
+    logging.info("Model loaded succesfully!")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    logging.info("Shutting down!")
+    await data_model.shutdown()
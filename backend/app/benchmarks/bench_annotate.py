@@ -0,0 +1,84 @@
+"""
+Benchmark of the annotation of the detections: the previous per crop loop of YoloX.annotate_image
+against the AnnotationRenderer, at full resolution and on a downscaled preview. The renderer is
+checked to draw exactly the same pixels as the legacy loop at full resolution.
+
+Usage (from backend/app):
+    python -m benchmarks.bench_annotate --runs 20
+"""
+import argparse
+import statistics
+import time
+import cv2
+import numpy as np
+from ml.detections import Detections
+from ml.renderer import AnnotationRenderer
+from ml.yolox_utils import COCO_CLASSES, _COLORS
+
+IMAGE_SIZES = [(1080, 1920), (3000, 4000)]
+DETECTION_COUNTS = (10, 100, 500)
+PREVIEW_SIZE = 1280
+
+
+def synthetic_detections(num_detections, height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    top_left = rng.random((num_detections, 2)) * [width - 300, height - 300]
+    boxes = np.concatenate([top_left, top_left + rng.random((num_detections, 2)) * 290 + 10], axis=1)
+    scores = rng.uniform(0.45, 1, num_detections)
+    classes = rng.integers(0, len(COCO_CLASSES), num_detections)
+    return Detections.from_arrays(boxes, scores, classes, conf=0.45, class_names=COCO_CLASSES)
+
+
+def legacy_annotate(img, detections):
+    """The previous YoloX.annotate_image."""
+    for crop in detections.to_crops():
+        bbox = crop['bbox']
+        class_name = crop['class']
+        confidence = crop['confidence']
+        x0, y0, x1, y1 = bbox['x_min'], bbox['y_min'], bbox['x_max'], bbox['y_max']
+        color = (_COLORS[COCO_CLASSES.index(class_name)] * 255).astype(np.uint8).tolist()
+        cv2.rectangle(img, (x0, y0), (x1, y1), color, 4)
+        label = f"{class_name} {confidence:.2f}"
+        t_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)[0]
+        cv2.rectangle(img, (x0, y0 - t_size[1]), (x0 + t_size[0], y0), color, -1)
+        cv2.putText(img, label, (x0, y0), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2)
+    return img
+
+
+def measure(func, image, runs):
+    latencies = []
+    for _ in range(runs):
+        img = image.copy()
+        start = time.perf_counter()
+        func(img)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the annotation of the detections")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    renderer = AnnotationRenderer()
+    mismatches = 0
+    print(f"{'image':>10} | {'boxes':>5} | {'legacy ms':>9} | {'renderer ms':>11} | {'us/box':>6} | "
+          f"{'preview ms':>10} | {'speedup':>7}")
+    for height, width in IMAGE_SIZES:
+        image = np.full((height, width, 3), 114, dtype=np.uint8)
+        for num_detections in DETECTION_COUNTS:
+            detections = synthetic_detections(num_detections, height, width)
+            if not np.array_equal(legacy_annotate(image.copy(), detections), renderer.render(image.copy(), detections)):
+                mismatches += 1
+                print(f"MISMATCH: {num_detections} boxes on {width}x{height} are drawn differently")
+            # The first render fills the label widths cache, as the first requests of the server do
+            legacy = measure(lambda img: legacy_annotate(img, detections), image, args.runs)
+            rendered = measure(lambda img: renderer.render(img, detections), image, args.runs)
+            preview = measure(lambda img: renderer.render(img, detections, PREVIEW_SIZE), image, args.runs)
+            print(f"{f'{width}x{height}':>10} | {num_detections:>5} | {legacy:>9.2f} | {rendered:>11.2f} | "
+                  f"{rendered * 1000 / num_detections:>6.1f} | {preview:>10.2f} | {legacy / rendered:>6.1f}x")
+    print("The renderer draws the same pixels" if not mismatches else f"{mismatches} mismatches")
+
+
+if __name__ == "__main__":
+    main()
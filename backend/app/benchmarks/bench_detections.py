@@ -0,0 +1,108 @@
+"""
+Benchmark of the two storage formats of the detections: the crops dicts and the compact columnar
+document (Detections.to_document). For images with an increasing number of detections, it reports
+the BSON size of the image document and the JSON size of the API response, and the time to build
+the detections from the NMS output, encode the document and decode it back to crops. Every format
+is checked to give back the same crops as the legacy per box loop.
+
+Usage (from backend/app):
+    python -m benchmarks.bench_detections --runs 200
+"""
+import argparse
+import json
+import statistics
+import time
+import bson
+import numpy as np
+from ml.detections import Detections
+from ml.yolox_utils import COCO_CLASSES
+
+DETECTION_COUNTS = (1, 10, 50, 200, 1000)
+CONF = 0.45
+
+
+def synthetic_dets(num_detections, seed=0):
+    """NMS output rows (x0, y0, x1, y1, score, class) of a 1920x1080 image, float64 like NMSEngine returns them."""
+    rng = np.random.default_rng(seed)
+    top_left = rng.random((num_detections, 2)) * [1800, 1000]
+    boxes = np.concatenate([top_left, top_left + rng.random((num_detections, 2)) * 300 + 5], axis=1)
+    # Every score is kept by the conf threshold, so the number of detections is the requested one
+    scores = rng.uniform(CONF, 1, num_detections)
+    classes = rng.integers(0, len(COCO_CLASSES), num_detections)
+    return np.concatenate([boxes.astype(np.float32), scores.astype(np.float32)[:, None], classes[:, None]], axis=1)
+
+
+def legacy_crops(dets, conf=CONF, class_names=COCO_CLASSES):
+    """The previous YoloX.extract_crops_info."""
+    crops_info = []
+    for box, score, cls_id in zip(dets[:, :4], dets[:, 4], dets[:, 5]):
+        if score < conf:
+            continue
+        crops_info.append({
+            "bbox": {"x_min": int(box[0]), "y_min": int(box[1]), "x_max": int(box[2]), "y_max": int(box[3])},
+            "class": class_names[int(cls_id)],
+            "confidence": round(score * 100, 1),
+        })
+    return crops_info
+
+
+def image_document(detections_field):
+    document = {
+        "id": "6f1c3f9e-3f5e-4a51-9d7c-6c1e8a1f5b2d",
+        "originalFileName": "image.jpg",
+        "createdOn": "2024-01-01 00:00:00",
+        "filePath": "../data-files/image.jpg",
+        "imageSummary": {},
+    }
+    document.update(detections_field)
+    return document
+
+
+def measure(func, runs):
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the storage formats of the detections")
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    mismatches = 0
+    print(f"{'detections':>10} | {'BSON crops':>10} | {'BSON cols':>9} | {'JSON crops':>10} | {'JSON cols':>9} | "
+          f"{'build legacy':>12} | {'build arrays':>12} | {'encode crops':>12} | {'encode cols':>11} | "
+          f"{'decode crops':>12} | {'decode cols':>11}  (bytes, p50 us)")
+    for num_detections in DETECTION_COUNTS:
+        dets = synthetic_dets(num_detections)
+        build = lambda: Detections.from_arrays(dets[:, :4], dets[:, 4], dets[:, 5], conf=CONF, class_names=COCO_CLASSES)
+        detections = build()
+        crops = legacy_crops(dets)
+        crops_document = bson.encode(image_document({"crops": crops}))
+        columnar_document = bson.encode(image_document({"detections": detections.to_document()}))
+        decoded = Detections.from_image_document(bson.decode(columnar_document))
+        if detections.to_crops() != crops or decoded.to_crops() != crops:
+            mismatches += 1
+            print(f"MISMATCH: the crops of {num_detections} detections differ from the legacy ones")
+
+        results = {
+            "build legacy": measure(lambda: legacy_crops(dets), args.runs),
+            "build arrays": measure(lambda: build().to_crops(), args.runs),
+            "encode crops": measure(lambda: bson.encode(image_document({"crops": build().to_crops()})), args.runs),
+            "encode cols": measure(lambda: bson.encode(image_document({"detections": build().to_document()})), args.runs),
+            "decode crops": measure(lambda: bson.decode(crops_document)["crops"], args.runs),
+            "decode cols": measure(
+                lambda: Detections.from_image_document(bson.decode(columnar_document)).to_crops(), args.runs),
+        }
+        sizes = (len(crops_document), len(columnar_document),
+                 len(json.dumps(crops)), len(json.dumps(detections.to_columnar())))
+        print(f"{num_detections:>10} | {sizes[0]:>10} | {sizes[1]:>9} | {sizes[2]:>10} | {sizes[3]:>9} | "
+              + " | ".join(f"{value:>{max(len(name), 11)}.1f}" for name, value in results.items()))
+    print("All formats give the same crops" if not mismatches else f"{mismatches} mismatches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Load test of the image metadata queries on a large images collection (1M documents by default):
+single image lookups, the legacy full listing, skip/limit pages and the keyset pages of
+/list-images at increasing depths, and the query plans chosen by MongoDB.
+
+The documents are loaded into a separate database of the configured MongoDB (HOST / PORT), which
+is dropped at the end unless --keep is given, and reused as is with --skip-load.
+
+Usage (from backend/app):
+    python -m benchmarks.bench_image_queries --docs 1000000
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+import pymongo
+from core.pagination import IMAGE_LIST_PROJECTION, IMAGE_LIST_SORT, encode_cursor, keyset_filter
+from db.db_client import HOST, PORT, INDEXES
+from ml.yolox_utils import COCO_CLASSES
+
+PAGE_SIZE = 50
+PAGE_DEPTHS = (1, 100, 1000, 10000)
+LEGACY_TIME_LIMIT_S = 30
+
+
+def synthetic_documents(start, count, rng):
+    """Documents shaped like the ones saved by the backend, created one minute apart."""
+    origin = datetime(2024, 1, 1)
+    documents = []
+    for i in range(start, start + count):
+        crops = []
+        for _ in range(rng.randint(0, 20)):
+            x0, y0 = rng.randint(0, 600), rng.randint(0, 600)
+            crops.append({
+                "bbox": {"x_min": x0, "y_min": y0, "x_max": x0 + rng.randint(10, 300), "y_max": y0 + rng.randint(10, 300)},
+                "class": rng.choice(COCO_CLASSES),
+                "confidence": round(rng.uniform(45, 100), 1),
+            })
+        summary = {}
+        for crop in crops:
+            summary[crop["class"]] = summary.get(crop["class"], 0) + 1
+        documents.append({
+            "id": str(uuid4()),
+            "originalFileName": f"image_{i % 50000}.jpg",
+            "createdOn": (origin + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"),
+            "crops": crops,
+            "filePath": f"../data-files/image_{i % 50000}.jpg",
+            "imageSummary": summary,
+        })
+    return documents
+
+
+def load(collection, num_docs, chunk):
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for offset in range(0, num_docs, chunk):
+        collection.insert_many(synthetic_documents(offset, min(chunk, num_docs - offset), rng), ordered=False)
+        print(f"\rLoaded {min(offset + chunk, num_docs)}/{num_docs} documents", end="", flush=True)
+    print(f" in {time.perf_counter() - start:.1f} s")
+
+
+def measure(func, runs):
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1 if len(latencies) > 1 else 0]
+
+
+def plan_stages(cursor):
+    """Stage names of the winning plan, e.g. LIMIT > FETCH > IXSCAN."""
+    try:
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+    except Exception as e:
+        return f"explain not available ({e})"
+    stages = []
+    while plan:
+        stages.append(plan.get("stage", "?"))
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " > ".join(stages)
+
+
+def legacy_listing(collection):
+    """The previous /list-images, every full document, stopped after LEGACY_TIME_LIMIT_S."""
+    start = time.perf_counter()
+    count = 0
+    for _ in collection.find({}, {"_id": 0}):
+        count += 1
+        if time.perf_counter() - start > LEGACY_TIME_LIMIT_S:
+            break
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the image metadata queries")
+    parser.add_argument("--docs", type=int, default=1_000_000)
+    parser.add_argument("--database", default="bench-image-queries")
+    parser.add_argument("--chunk", type=int, default=10000, help="Documents per insert_many while loading")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--skip-load", action="store_true", help="Reuse the documents of a previous run")
+    parser.add_argument("--keep", action="store_true", help="Don't drop the benchmark database at the end")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(f"mongodb://{HOST}:{PORT}")
+    db = client[args.database]
+    collection = db["images"]
+    try:
+        if not args.skip_load:
+            collection.drop()
+            load(collection, args.docs, args.chunk)
+        for name, keys, options in INDEXES:
+            if name == "images":
+                db[name].create_index(keys, **options)
+        num_docs = collection.estimated_document_count()
+        print(f"{num_docs} documents, indexes: {sorted(collection.index_information())}")
+
+        sample_ids = [doc["id"] for doc in collection.aggregate([{"$sample": {"size": args.runs}}, {"$project": {"id": 1}}])]
+        ids = iter(sample_ids * 2)
+        results = {"find_one by id": measure(lambda: collection.find_one({"id": next(ids)}, {"_id": 0}), args.runs)}
+        file_name = "image_123.jpg"
+        results[f"keyset page, originalFileName={file_name}"] = measure(
+            lambda: list(collection.find({"originalFileName": file_name}, IMAGE_LIST_PROJECTION)
+                         .sort(IMAGE_LIST_SORT).limit(PAGE_SIZE + 1)), args.runs)
+
+        for depth in PAGE_DEPTHS:
+            skip = (depth - 1) * PAGE_SIZE
+            if skip >= num_docs:
+                break
+            # The cursor of the page is taken once, as a client walking the pages would have it
+            previous = list(collection.find({}, IMAGE_LIST_PROJECTION).sort(IMAGE_LIST_SORT).skip(skip - 1).limit(1)) if skip else []
+            cursor = encode_cursor(previous[0]) if previous else None
+            results[f"keyset page {depth}"] = measure(
+                lambda: list(collection.find(keyset_filter(cursor), IMAGE_LIST_PROJECTION)
+                             .sort(IMAGE_LIST_SORT).limit(PAGE_SIZE + 1)), args.runs)
+            results[f"skip/limit page {depth}"] = measure(
+                lambda: list(collection.find({}, IMAGE_LIST_PROJECTION).sort(IMAGE_LIST_SORT).skip(skip).limit(PAGE_SIZE)),
+                max(1, args.runs // 5))
+
+        print(f"\n{'query':<45} | {'p50 ms':>9} | {'p95 ms':>9}")
+        for name, (p50, p95) in results.items():
+            print(f"{name:<45} | {p50:9.2f} | {p95:9.2f}")
+
+        count, elapsed = legacy_listing(collection)
+        print(f"\nLegacy full listing: {count} documents in {elapsed:.1f} s "
+              f"(~{num_docs / max(count, 1) * elapsed:.0f} s for the whole collection)")
+
+        middle = encode_cursor({"createdOn": "2024-06-01 00:00:00", "id": "f"})
+        plans = {
+            "find_one by id": collection.find({"id": sample_ids[0]}).limit(1),
+            "keyset page": collection.find(keyset_filter(middle), IMAGE_LIST_PROJECTION).sort(IMAGE_LIST_SORT),
+            "by file name": collection.find({"originalFileName": file_name}, IMAGE_LIST_PROJECTION).sort(IMAGE_LIST_SORT),
+        }
+        print("\nQuery plans:")
+        for name, cursor in plans.items():
+            print(f"  {name:<15} {plan_stages(cursor.limit(PAGE_SIZE + 1))}")
+    finally:
+        if not args.keep:
+            client.drop_database(args.database)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
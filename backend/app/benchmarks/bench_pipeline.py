@@ -0,0 +1,284 @@
+"""
+Benchmark of the whole image prediction pipeline, stage by stage, as run_prediction runs it: decode
+of the uploaded bytes (at a reduced resolution when it still covers the model input, see
+core.uploads.decode_image), letterbox preprocessing, session.run, postprocessing (of which the box decoding
+and the NMS), building the Detections, annotation, encoding of the response and writing the file.
+
+For every input, synthetic images of increasing resolution and optionally a directory of sample
+images, it reports the p50 / p95 / p99 latency of every stage and the peak memory of one pass.
+It then measures the end to end throughput with several concurrent requests. Runs offline, only the
+model file is needed.
+
+Usage (from backend/app):
+    python -m benchmarks.bench_pipeline --images ../data-files --runs 30 --output pipeline.json
+    python -m benchmarks.bench_pipeline --mode json     # no annotation nor encoding, as the json responses
+    python -m benchmarks.bench_pipeline --baseline pipeline.json --tolerance 0.1
+
+--output saves the results as JSON with the commit they were measured on. --baseline compares the run
+with a previous JSON result, lists the stages whose p50 or the throughputs that regressed by more
+than --tolerance and exits with status 1 when there is any.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import onnxruntime as ort
+from core.core_functions import CoreFunctions, IMAGE_ENCODINGS
+from core.data_models import PredictionConfig
+from core.uploads import decode_image
+from ml.detections import Detections
+from ml.renderer import ANNOTATION_PREVIEW_SIZE
+from ml.yolox_model import YoloX, MODEL_PATH
+from ml.yolox_utils import COCO_CLASSES
+
+IMAGE_SIZES = [(480, 640), (1080, 1920), (3000, 4000)]
+CONCURRENCY_LEVELS = (1, 2, 4, 8)
+STAGES = ("decode", "preprocess", "inference", "postprocess", "decode_boxes", "nms", "detections",
+          "annotate", "encode", "write", "total")
+# Parts of the postprocess stage
+SUB_STAGES = ("decode_boxes", "nms")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+class StageRecorder:
+    """Times the stages of the pipeline run by the current thread."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def start(self) -> None:
+        self.local.times = {}
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times = getattr(self.local, "times", None)
+        if times is not None:
+            times[stage] = times.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+        return result
+
+    def wrap(self, stage, func):
+        return lambda *args, **kwargs: self.time(stage, func, *args, **kwargs)
+
+    def stop(self) -> dict:
+        times, self.local.times = self.local.times, None
+        return times
+
+
+def synthetic_image(height, width, seed=0):
+    """JPEG bytes of a photo-like image: smooth gradients with a few filled shapes and some noise."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack([x / width * 255, y / height * 255, (x + y) / (width + height) * 255], axis=2)
+    image += rng.normal(0, 12, image.shape)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    for _ in range(20):
+        x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(20, max(21, min(height, width) // 4)))
+        cv2.rectangle(image, (x0, y0), (x0 + size, y0 + size), rng.integers(0, 255, 3).tolist(), -1)
+    return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def load_inputs(images_dir, limit):
+    inputs = {f"synthetic {width}x{height}": [synthetic_image(height, width, seed)]
+              for seed, (height, width) in enumerate(IMAGE_SIZES)}
+    if images_dir:
+        paths = sorted(os.path.join(images_dir, file_name) for file_name in os.listdir(images_dir)
+                       if file_name.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+        samples = []
+        for path in paths:
+            with open(path, "rb") as image_file:
+                samples.append(image_file.read())
+        if samples:
+            inputs[f"samples ({len(samples)})"] = samples
+    return inputs
+
+
+def encode_image(image, image_format, quality):
+    """As CoreFunctions.return_bytes_from_image."""
+    extension, quality_flag = IMAGE_ENCODINGS[image_format]
+    return cv2.imencode(extension, image, [quality_flag, quality] if quality_flag is not None else [])[1]
+
+
+def run_pipeline(model, recorder, image_bytes, args, write_path=None):
+    """One prediction, returns the milliseconds spent in every stage."""
+    recorder.start()
+    start = time.perf_counter()
+    annotated = args.mode == "image"
+    # Same reduced decode as the served requests of the mode
+    cover, min_side = CoreFunctions.decode_cover(model, PredictionConfig(), annotated, args.preview_size)
+    image, factor = recorder.time("decode", decode_image, image_bytes, cover, min_side)
+    img, ratio = recorder.time("preprocess", model.preprocess, image)
+    outputs = recorder.time("inference", model.inference, img, model.nms_inputs(args.nms_thr, args.score_thr))
+    dets = recorder.time("postprocess", model.postprocess, outputs, ratio, args.nms_thr, args.score_thr)
+    detections = recorder.time("detections", lambda: Detections.empty() if dets is None else Detections.from_arrays(
+        dets[:, :4], dets[:, 4], dets[:, 5], conf=args.conf, class_names=COCO_CLASSES))
+    if annotated:
+        image = recorder.time("annotate", model.annotate_image, image, detections, args.preview_size)
+        recorder.time("encode", encode_image, image, args.format, args.quality)
+        if write_path is not None:
+            recorder.time("write", cv2.imwrite, write_path, image)
+    if factor > 1:
+        detections = recorder.time("detections", detections.scaled, factor)
+    times = recorder.stop()
+    times["total"] = (time.perf_counter() - start) * 1000
+    return times
+
+
+def percentiles(values):
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(np.mean(values)),
+    }
+
+
+def stage_latencies(model, recorder, images, args, write_dir):
+    for image_bytes in images:
+        run_pipeline(model, recorder, image_bytes, args)
+    samples = {stage: [] for stage in STAGES}
+    for run in range(args.runs):
+        for i, image_bytes in enumerate(images):
+            write_path = os.path.join(write_dir, f"{run}_{i}{IMAGE_ENCODINGS[args.format][0]}")
+            times = run_pipeline(model, recorder, image_bytes, args, write_path)
+            for stage in STAGES:
+                # Stages that didn't run, e.g. annotate in the json mode, count as 0 ms
+                samples[stage].append(times.get(stage, 0.0))
+    return {stage: percentiles(values) for stage, values in samples.items()}
+
+
+def peak_memory(model, recorder, images, args):
+    """Peak of the memory allocated by Python and numpy during one pass, opencv buffers aren't traced."""
+    tracemalloc.start()
+    for image_bytes in images:
+        run_pipeline(model, recorder, image_bytes, args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1e6
+
+
+def throughput(model, recorder, images, args, concurrency):
+    requests = [images[i % len(images)] for i in range(max(args.runs * len(images), concurrency * 4))]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda image_bytes: run_pipeline(model, recorder, image_bytes, args), requests[:concurrency]))
+        start = time.perf_counter()
+        list(executor.map(lambda image_bytes: run_pipeline(model, recorder, image_bytes, args), requests))
+        return len(requests) / (time.perf_counter() - start)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, stages in results["stages"].items():
+        for stage, values in stages.items():
+            previous = baseline.get("stages", {}).get(name, {}).get(stage)
+            # Sub-millisecond stages are mostly noise
+            if previous and previous["p50"] >= 0.1 and values["p50"] > previous["p50"] * (1 + tolerance):
+                found.append(f"{name} / {stage}: p50 {previous['p50']:.2f} -> {values['p50']:.2f} ms")
+    for concurrency, value in results["throughput"].items():
+        previous = baseline.get("throughput", {}).get(concurrency)
+        if previous and value < previous * (1 - tolerance):
+            found.append(f"throughput at concurrency {concurrency}: {previous:.1f} -> {value:.1f} img/s")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the prediction pipeline")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--images", help="Directory of sample images, benchmarked with the synthetic ones")
+    parser.add_argument("--max-images", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=20, help="Passes over the images of every input")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(CONCURRENCY_LEVELS))
+    parser.add_argument("--mode", choices=["image", "json"], default="image",
+                        help="image annotates, encodes and writes the result, json only returns the detections")
+    parser.add_argument("--preview-size", type=int, default=ANNOTATION_PREVIEW_SIZE,
+                        help="Longer side of the annotated image, 0 annotates at full resolution")
+    parser.add_argument("--format", choices=list(IMAGE_ENCODINGS), default="png")
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument("--nms-thr", type=float, default=0.6)
+    parser.add_argument("--score-thr", type=float, default=0.1)
+    parser.add_argument("--conf", type=float, default=0.45)
+    parser.add_argument("--output", help="Path of the JSON results")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    model = YoloX(args.model)
+    model.warm_up()
+    recorder = StageRecorder()
+    # Instance attributes shadow the methods, so postprocess goes through the timed versions
+    model.decoder.decode_boxes = recorder.wrap("decode_boxes", model.decoder.decode_boxes)
+    model.multiclass_nms = recorder.wrap("nms", model.multiclass_nms)
+    inputs = load_inputs(args.images, args.max_images)
+
+    results = {
+        "commit": git_commit(),
+        "model": os.path.basename(args.model),
+        "python": platform.python_version(),
+        "onnxruntime": ort.__version__,
+        "cpus": os.cpu_count(),
+        "runs": args.runs,
+        "mode": args.mode,
+        "previewSize": args.preview_size,
+        "format": args.format,
+        "stages": {},
+        "peakMemoryMB": {},
+        "throughput": {},
+    }
+    with tempfile.TemporaryDirectory() as write_dir:
+        for name, images in inputs.items():
+            results["stages"][name] = stage_latencies(model, recorder, images, args, write_dir)
+            results["peakMemoryMB"][name] = peak_memory(model, recorder, images, args)
+    all_images = [image_bytes for images in inputs.values() for image_bytes in images]
+    for concurrency in args.concurrency:
+        results["throughput"][str(concurrency)] = throughput(model, recorder, all_images, args, concurrency)
+    # ru_maxrss is in KB on Linux
+    results["maxRssMB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"model {results['model']}, commit {results['commit']}, {args.runs} runs, {args.mode} mode, "
+          f"{args.format} output")
+    for name, stages in results["stages"].items():
+        print(f"\n{name}, peak traced memory {results['peakMemoryMB'][name]:.1f} MB")
+        print(f"{'stage':<14} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | {'share':>6}")
+        for stage, values in stages.items():
+            share = values["mean"] / stages["total"]["mean"] * 100
+            label = f"  {stage}" if stage in SUB_STAGES else stage
+            print(f"{label:<14} | {values['p50']:>8.2f} | {values['p95']:>8.2f} | {values['p99']:>8.2f} | {share:>5.1f}%")
+    print("\nthroughput: " + ", ".join(f"{value:.1f} img/s at concurrency {concurrency}"
+                                       for concurrency, value in results["throughput"].items()))
+    print(f"max RSS {results['maxRssMB']:.0f} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        print(f"\n{len(found)} regressions against {baseline.get('commit')} (tolerance {args.tolerance:.0%})")
+        for regression in found:
+            print(f"  {regression}")
+        if found:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
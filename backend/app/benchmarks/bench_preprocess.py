@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of the preprocessing step: the previous two-resize path (normalize_input to
+1024x720 followed by the padded 640x640 resize) against the single-resize LetterboxPreprocessor.
+
+Usage (from backend/app):
+    python -m benchmarks.bench_preprocess --runs 50
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from ml.preprocessing import LetterboxPreprocessor
+
+INPUT_SIZE = (640, 640)
+IMAGE_SIZES = [(720, 1280), (1080, 1920), (3000, 4000)]
+
+
+def legacy_normalize_input(img, max_height=1024, max_width=720):
+    height, width = img.shape[:2]
+    scaling_factor = min(max_height / height, max_width / width)
+    new_height = int(height * scaling_factor)
+    new_width = int(width * scaling_factor)
+    return cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+
+def legacy_preprocess(img, input_size=INPUT_SIZE, swap=(2, 0, 1)):
+    img = legacy_normalize_input(img)
+    padded_img = np.ones((input_size[0], input_size[1], 3), dtype=np.uint8) * 114
+    r = min(input_size[0] / img.shape[0], input_size[1] / img.shape[1])
+    resized_img = cv2.resize(
+        img,
+        (int(img.shape[1] * r), int(img.shape[0] * r)),
+        interpolation=cv2.INTER_LINEAR,
+    ).astype(np.uint8)
+    padded_img[: int(img.shape[0] * r), : int(img.shape[1] * r)] = resized_img
+    padded_img = padded_img.transpose(swap)
+    padded_img = np.ascontiguousarray(padded_img, dtype=np.float32)
+    return padded_img, r
+
+
+def measure(func, img, runs):
+    func(img)  # warm up, also allocates the per thread buffers of the letterbox preprocessor
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(img)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    func(img)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(latencies), peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the legacy and letterbox preprocessing paths")
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    letterbox = LetterboxPreprocessor(INPUT_SIZE)
+    rng = np.random.default_rng(0)
+    print(f"{'image':>12} | {'path':>10} | {'p50 ms':>8} | {'peak KiB':>9}")
+    for height, width in IMAGE_SIZES:
+        img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        for name, func in (("legacy", legacy_preprocess), ("letterbox", letterbox)):
+            latency, peak = measure(func, img, args.runs)
+            print(f"{width:>5}x{height:<6} | {name:>10} | {latency:8.2f} | {peak:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
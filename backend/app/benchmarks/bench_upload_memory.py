@@ -0,0 +1,148 @@
+"""
+Benchmark of the peak memory of the image uploads: the previous path, which read the whole upload with
+file.read() and decoded it at full resolution, against read_upload and the reduced decode_image.
+Every request decodes the image and letterboxes it into the model input, as the server does before
+inference. The uploads are spooled to temporary files as Starlette does, and run concurrently with
+the decode in a thread.
+
+Every scenario runs in a fresh process and reports the growth of its peak RSS over its RSS before
+the first request, so the scenarios don't inherit each other's peak. JPEG is decoded straight at
+the reduced size, the other formats are decoded in full and only the image kept is smaller.
+
+Usage (from backend/app):
+    python -m benchmarks.bench_upload_memory --concurrency 1 4 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from core.uploads import decode_image, read_upload, UPLOAD_CHUNK_SIZE
+from ml.preprocessing import LetterboxPreprocessor
+
+IMAGE_SIZES = [(3000, 4000), (6000, 8000)]
+FORMATS = {"jpeg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 90]), "png": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 1])}
+CONCURRENCY_LEVELS = (1, 4, 8)
+INPUT_SIZE = (640, 640)
+PATHS = ("legacy", "streaming")
+
+
+class SpooledUpload:
+    """The part of UploadFile used by the endpoints: reads of the spooled file in a thread."""
+
+    def __init__(self, path, filename):
+        self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_CHUNK_SIZE)
+        with open(path, "rb") as image_file:
+            while chunk := image_file.read(UPLOAD_CHUNK_SIZE):
+                self.file.write(chunk)
+        self.file.seek(0)
+        self.filename = filename
+
+    async def read(self, size=-1):
+        return await asyncio.to_thread(self.file.read, size)
+
+
+def write_image(directory, height, width, image_format):
+    """Photo-like image: smooth gradients with noise, so it compresses like a photo."""
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    extension, params = FORMATS[image_format]
+    path = os.path.join(directory, f"{width}x{height}{extension}")
+    cv2.imwrite(path, image, params)
+    return path
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def legacy_request(upload, preprocess):
+    contents = await upload.read()
+    image = await asyncio.to_thread(cv2.imdecode, np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    await asyncio.to_thread(preprocess, image)
+
+
+async def streaming_request(upload, preprocess):
+    contents = await read_upload(upload, max_bytes=sys.maxsize)
+    image, _ = await asyncio.to_thread(decode_image, contents, INPUT_SIZE)
+    await asyncio.to_thread(preprocess, image)
+
+
+async def run_requests(path, image_path, concurrency):
+    preprocess = LetterboxPreprocessor(INPUT_SIZE)
+    request = legacy_request if path == "legacy" else streaming_request
+    uploads = [SpooledUpload(image_path, os.path.basename(image_path)) for _ in range(concurrency)]
+    await asyncio.gather(*(request(upload, preprocess) for upload in uploads))
+
+
+def run_scenario(path, image_path, concurrency):
+    """Run in the child process, prints the results as JSON."""
+    # Warm up OpenCV and the thread pool on a tiny image, so their setup isn't counted
+    cv2.imdecode(cv2.imencode(".jpg", np.zeros((64, 64, 3), np.uint8))[1], cv2.IMREAD_COLOR)
+    asyncio.run(asyncio.sleep(0))
+    baseline = current_rss_mb()
+    start = time.perf_counter()
+    asyncio.run(run_requests(path, image_path, concurrency))
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"peakMB": peak_rss_mb() - baseline, "seconds": elapsed}))
+
+
+def measure(path, image_path, concurrency):
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_upload_memory", "--scenario", path, image_path, str(concurrency)],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the peak memory of the image uploads")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(CONCURRENCY_LEVELS))
+    parser.add_argument("--formats", nargs="+", choices=list(FORMATS), default=list(FORMATS))
+    parser.add_argument("--output", help="Path of the JSON results")
+    parser.add_argument("--scenario", nargs=3, metavar=("PATH", "IMAGE", "CONCURRENCY"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.scenario:
+        path, image_path, concurrency = args.scenario
+        run_scenario(path, image_path, int(concurrency))
+        return
+
+    results = []
+    print(f"{'image':>14} | {'conc':>4} | {'legacy MB':>9} | {'streaming MB':>12} | {'saved':>6} | "
+          f"{'legacy s':>8} | {'streaming s':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        for image_format in args.formats:
+            for height, width in IMAGE_SIZES:
+                image_path = write_image(directory, height, width, image_format)
+                size_mb = os.path.getsize(image_path) / 1024 ** 2
+                for concurrency in args.concurrency:
+                    measured = {path: measure(path, image_path, concurrency) for path in PATHS}
+                    legacy, streaming = measured["legacy"], measured["streaming"]
+                    results.append({"format": image_format, "width": width, "height": height, "fileMB": size_mb,
+                                    "concurrency": concurrency, **measured})
+                    saved = 1 - streaming["peakMB"] / legacy["peakMB"] if legacy["peakMB"] > 0 else 0.0
+                    print(f"{f'{width}x{height} {image_format}':>14} | {concurrency:>4} | {legacy['peakMB']:>9.0f} | "
+                          f"{streaming['peakMB']:>12.0f} | {saved:>6.0%} | {legacy['seconds']:>8.2f} | "
+                          f"{streaming['seconds']:>11.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from typing import Any, Iterator, Optional, Union
+from uuid import uuid4
+from core.uploads import MAX_IMAGE_UPLOAD_MB, UploadTooLargeError
+from util.logger import Logger
+from util.metrics import ERRORS
+
+BATCH_JOB_HISTORY = int(os.environ.get("BATCH_JOB_HISTORY", 100))
+BATCH_JOB_MAX_FAILURES_REPORTED = 100
+
+ARCHIVE_EXTENSIONS = (".zip",)
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def list_batch_images(paths: list[tuple[str, str]]) -> list[tuple[str, Optional[str], str]]:
+    """
+    Expand the uploaded (path, original file name) pairs into (path, archive member, file name)
+    entries, one per image. Archives are only listed here, the members are read while processing.
+    """
+    entries = []
+    for path, filename in paths:
+        if not is_archive(filename):
+            entries.append((path, None, filename))
+            continue
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                name = os.path.basename(member.filename)
+                # Skip directories and the resource forks and hidden files added by some archivers
+                if member.is_dir() or not name or name.startswith(".") or member.filename.startswith("__MACOSX/"):
+                    continue
+                entries.append((path, member.filename, name))
+    return entries
+
+
+def read_bounded(image_file, name: str, max_bytes: int) -> bytes:
+    """Read at most max_bytes, so a file or an archive member larger than its header says can't get through."""
+    content = image_file.read(max_bytes + 1)
+    if len(content) > max_bytes:
+        raise UploadTooLargeError(f"{name} is larger than {max_bytes // (1024 * 1024)} MB")
+    return content
+
+
+def iter_batch_images(
+    entries: list[tuple[str, Optional[str], str]],
+    max_bytes: int = int(MAX_IMAGE_UPLOAD_MB * 1024 * 1024),
+) -> Iterator[tuple[str, Union[bytes, Exception]]]:
+    """
+    Yields the (file name, bytes) of every image, keeping each archive open while it is read. An image
+    over max_bytes is yielded with an UploadTooLargeError instead of its bytes, and is never read in
+    full: archive members are skipped from the size in their header, and read with a bounded read.
+    """
+    archives = {}
+    try:
+        for path, member, name in entries:
+            try:
+                if member is None:
+                    with open(path, "rb") as image_file:
+                        content = read_bounded(image_file, name, max_bytes)
+                else:
+                    if path not in archives:
+                        archives[path] = zipfile.ZipFile(path)
+                    info = archives[path].getinfo(member)
+                    if info.file_size > max_bytes:
+                        raise UploadTooLargeError(f"{name} is larger than {max_bytes // (1024 * 1024)} MB")
+                    with archives[path].open(info) as image_file:
+                        content = read_bounded(image_file, name, max_bytes)
+            except UploadTooLargeError as e:
+                yield name, e
+                continue
+            yield name, content
+    finally:
+        for archive in archives.values():
+            archive.close()
+
+
+class BatchJob:
+    """Progress of a batch upload, updated from the event loop and read by the job-status endpoint."""
+
+    def __init__(self, total: int):
+        self.id = str(uuid4())
+        self.total = total
+        self.status = "queued"
+        self.succeeded = 0
+        self.failed = 0
+        self.persisted = 0
+        self.failures = []
+        self.created_on = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self) -> None:
+        self.status = "running"
+        self.started_at = time.monotonic()
+
+    def finish(self, status: str = "completed") -> None:
+        self.status = status
+        self.finished_at = time.monotonic()
+
+    def record_failure(self, filename: str, error: Any) -> None:
+        self.failed += 1
+        ERRORS.labels("batch").inc()
+        # The counter keeps the total, only the first failures are kept with their error
+        if len(self.failures) < BATCH_JOB_MAX_FAILURES_REPORTED:
+            self.failures.append({"fileName": filename, "error": str(error)})
+
+    def to_dict(self) -> dict[str, Any]:
+        processed = self.succeeded + self.failed
+        elapsed = 0.0
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "total": self.total,
+            "processed": processed,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "persisted": self.persisted,
+            "progress": round(processed / self.total, 4) if self.total else 1.0,
+            "elapsedSeconds": round(elapsed, 3),
+            "imagesPerSecond": round(processed / elapsed, 2) if elapsed else 0.0,
+            "failures": self.failures,
+        }
+
+
+class BatchJobRegistry:
+    """
+    In-memory registry of the batch jobs of the process. Running jobs are always kept, and only the
+    last BATCH_JOB_HISTORY finished ones, so the registry doesn't grow with the uptime.
+    """
+
+    def __init__(self, history: int = BATCH_JOB_HISTORY):
+        self.history = history
+        self.jobs: "OrderedDict[str, BatchJob]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.logger = Logger(self.__class__).get_logger()
+
+    def create(self, total: int) -> BatchJob:
+        job = BatchJob(total)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._evict()
+        self.logger.info(f"Batch job {job.id} created with {total} images")
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> list[BatchJob]:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def _evict(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
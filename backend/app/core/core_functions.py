@@ -1,95 +1,428 @@
-from typing import Any
+import os
+import asyncio
+import shutil
+import threading
+import time
+from typing import Any, Optional
 from util.logger import Logger
+from util.metrics import stage_timer, request_timings, count_detections, ERRORS
 import cv2
 import numpy as np
 from io import BytesIO
-from ml.yolox_model import YoloX
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from ml.model_catalog import ModelCatalog, MODEL_PROFILE_AT_STARTUP
+from ml.nms import NMS_BACKEND
+from ml.detections import Detections
+from ml.renderer import ANNOTATION_PREVIEW_SIZE
+from core.worker_pool import WorkerPool, PoolSaturatedError, WORKER_POOL_SIZE
+from core.video_pipeline import VideoPipeline, VideoStream
+from core.result_cache import ResultCache, RESULT_CACHE_MONGO, model_fingerprint, result_cache_key
+from core.persistence import WriteBehindWriter
+from core.uploads import decode_image
+from core.image_files import ImageFile, HotImageCache
+from core.pagination import IMAGE_LIST_SORT, IMAGE_LIST_PROJECTION, encode_cursor, keyset_filter
+from core.summary import summary_pipeline, format_summary
+from core.stats import STATS_COLLECTION, STATS_PROJECTION, stats_updates, stats_query, merge_stats, format_stats
+from core.batch_jobs import BatchJob, BatchJobRegistry, list_batch_images, iter_batch_images
 from core.data_models import *
+from db.db_client import MongoConnector
+
+
+VIDEO_MAX_STREAMS = int(os.environ.get("VIDEO_MAX_STREAMS", 2))
+# Images of a batch job in the worker pool at the same time, the rest of the queue is left to interactive requests
+BATCH_JOB_CONCURRENCY = int(os.environ.get("BATCH_JOB_CONCURRENCY", WORKER_POOL_SIZE))
+BATCH_INSERT_CHUNK = int(os.environ.get("BATCH_INSERT_CHUNK", 100))
+BATCH_RETRY_DELAY_S = 0.05
+# crops: list of dicts per detection, columnar: packed arrays (see Detections.to_document)
+DETECTIONS_STORAGE = os.environ.get("DETECTIONS_STORAGE", "crops")
+# Output format -> (extension, OpenCV quality flag), PNG is lossless and has no quality setting
+IMAGE_ENCODINGS = {
+    "png": (".png", None),
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
 
 
 class CoreFunctions:
-    db: Any   
+    db_client: MongoConnector
+    catalog: Optional[ModelCatalog]
 
-    def __init__(self, db: Any):
-        self.db = db
+    def __init__(self, db_client: MongoConnector):
+        self.db_client = db_client
+        self.catalog = None
+        self.worker_pool = WorkerPool()
+        self.video_streams = threading.BoundedSemaphore(VIDEO_MAX_STREAMS)
+        self.batch_jobs = BatchJobRegistry()
+        self.result_cache = ResultCache()
+        self.hot_images = HotImageCache()
+        self.writer = WriteBehindWriter()
+        self.batch_tasks = set()
         self.logger = Logger(self.__class__).get_logger()
 
+    @property
+    def db(self) -> Any:
+        return self.db_client.db
+
+    async def connect_db(self):
+        await self.db_client.connect()
+        # The writer thread uses the sync pymongo database, sharing the pool of the Motor client
+        self.writer.start(self.db_client.sync_db)
+        if RESULT_CACHE_MONGO:
+            self.result_cache = ResultCache(db=self.db)
+
     ####### I/O from data-files
-    async def load_image_from_bytes(self,image_bytes):
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        return image
+    def load_image_from_bytes(self, image_bytes, cover=None, min_side=0):
+        """The decoded image and the factor its coordinates were reduced by, see decode_image."""
+        with stage_timer("decode"):
+            return decode_image(image_bytes, cover, min_side)
+
+    @staticmethod
+    def decode_cover(model, config: PredictionConfig, annotated: bool, preview_size: int) -> tuple:
+        """
+        (cover, min_side) arguments of decode_image: the decoded image can be reduced down to the model
+        input, and to the preview size when it is annotated. Tiled predictions, which run at the native
+        resolution, and full resolution annotated images are decoded in full.
+        """
+        if config.tiled or (annotated and not preview_size):
+            return None, 0
+        return model.input_shape, preview_size if annotated else 0
     
-    async def return_bytes_from_image(self, image:np) -> BytesIO:
-        _, buffer = cv2.imencode('.png', image)
+    def return_bytes_from_image(self, image:np, output: Optional[OutputConfig] = None) -> BytesIO:
+        output = output or OutputConfig()
+        extension, quality_flag = IMAGE_ENCODINGS[output.format]
+        params = [quality_flag, output.quality] if quality_flag is not None else []
+        with stage_timer("encode"):
+            _, buffer = cv2.imencode(extension, image, params)
         image_bytes = BytesIO(buffer)
         return image_bytes
 
 
     ############# I/O data from MongoDB
     def create_image_object(self, image_data: Any) -> Image:
-        image_object = Image.parse_obj(image_data)
-        self.logger.info(f"Image created with timestamp: {datetime.now()}")
-        return image_object
+        return Image.parse_obj(image_data)
 
-    def save_image_to_db(self, image_data: Any):
-        image_object = self.create_image_object(image_data)
-        self.db["images"].insert_one(image_object.dict())
-        self.logger.info("Image saved to MongoDB!")
+    async def save_images_to_db(self, images_data: list[Any]) -> dict[int, str]:
+        """
+        Insert the images and add them to the stats. Returns the error of every image that couldn't
+        be inserted, by its index in images_data, all the other ones are saved.
+        """
+        documents = [self.create_image_object(image_data).dict(exclude_none=True) for image_data in images_data]
+        failed = {}
+        # Unordered, so one failing document doesn't stop the rest of the chunk
+        try:
+            with stage_timer("mongo_insert"):
+                await self.db["images"].insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"]: error["errmsg"] for error in e.details["writeErrors"]}
+        inserted = [document for index, document in enumerate(documents) if index not in failed]
+        if inserted:
+            try:
+                await self.db[STATS_COLLECTION].bulk_write(stats_updates(inserted), ordered=False)
+            except Exception as e:
+                # The images are saved, the stats can be rebuilt with tools.rebuild_stats
+                ERRORS.labels("persistence").inc()
+                self.logger.error(f"Failed to update the stats of {len(inserted)} images: {e}")
+        self.logger.info(f"{len(inserted)} images saved to MongoDB!")
+        return failed
 
-    def list_images(self) -> list[dict[str, Any]]:
+    async def list_images(self, limit: int, cursor: Optional[str] = None,
+                          original_file_name: Optional[str] = None) -> dict[str, Any]:
+        """
+        One page of images, newest first, with only the fields needed to list them. The next page
+        starts after nextCursor, which is None on the last page.
+        """
+        query = keyset_filter(cursor)
+        if original_file_name is not None:
+            query["originalFileName"] = original_file_name
         try:
-            images = list(self.db["images"].find({}, {"_id": 0}))  # Exclude the MongoDB ObjectId from results
+            # One extra document tells whether there is a next page
+            images = await (
+                self.db["images"].find(query, IMAGE_LIST_PROJECTION).sort(IMAGE_LIST_SORT).limit(limit + 1)
+            ).to_list(limit + 1)
             self.logger.debug("Images retrieved from MongoDB!")
-            return images
         except Exception as e:
             self.logger.error(f"Failed to retrieve images: {e}")
-            return []
+            images = []
+        next_cursor = encode_cursor(images[limit - 1]) if len(images) > limit else None
+        return {"items": images[:limit], "nextCursor": next_cursor}
         
-    async def get_bytes_from_image_id(self,image_id:str):
+    async def get_image_file(self, image_id: str) -> Optional[ImageFile]:
+        """The stored annotated image of a prediction, which is served as is without decoding it."""
         try:
-            images = list(self.db["images"].find({"id": image_id}, {"_id": 0}))  # Exclude the MongoDB ObjectId from results
-            self.logger.debug(f"Here are the images retrieved from MongoDB: {images}")
-            filepath = images[0]["filePath"]
-            image = cv2.imread(filepath)
-            return await self.return_bytes_from_image(image=image)
+            image = await self.db["images"].find_one({"id": image_id}, {"_id": 0, "filePath": 1})
+            if image is None:
+                return None
+            return ImageFile(image["filePath"], os.stat(image["filePath"]))
         except Exception as e:
-            self.logger.error(f"Failed to retrieve images: {e}")
-            return []
+            self.logger.error(f"Failed to retrieve image {image_id}: {e}")
+            return None
+
+    async def get_hot_image_bytes(self, image_file: ImageFile) -> Optional[bytes]:
+        """Bytes of small images from the hot cache, None when the file should be streamed from disk."""
+        if not self.hot_images.cacheable(image_file):
+            return None
+        content = self.hot_images.get(image_file)
+        if content is None:
+            content = await asyncio.to_thread(self.hot_images.load, image_file)
+        return content
 
     # Model loading
     async def load_model(self):
         try:
-            YoloX().load_model()
+            self.catalog = ModelCatalog()
+            if MODEL_PROFILE_AT_STARTUP:
+                # Every model gets a latency for the latency budgets, the default one is left loaded
+                self.catalog.profile()
+            else:
+                # The default model is loaded and warmed up before the first request
+                with self.catalog.use(self.catalog.default):
+                    pass
         except Exception as e:
             self.logger.error(f"Failed to load model!: {e}")
 
+    async def shutdown(self):
+        for task in list(self.batch_tasks):
+            task.cancel()
+        await asyncio.gather(*self.batch_tasks, return_exceptions=True)
+        self.worker_pool.shutdown()
+        # After the pool, so the predictions that were still running get saved too
+        self.writer.stop()
+        self.db_client.disconnect()
+        if self.catalog is not None:
+            self.catalog.shutdown()
+
+    def get_catalog(self) -> ModelCatalog:
+        # Fallback in case the catalog couldn't be read at startup, the models are loaded on first use
+        if self.catalog is None:
+            self.catalog = ModelCatalog()
+        return self.catalog
+
+    def resolve_model(self, config: PredictionConfig) -> PredictionConfig:
+        """The config with the catalog model serving it, raises UnknownModelError for an unknown model."""
+        model = self.get_catalog().select(config.model, config.latency_budget_ms)
+        # Requests resolved to the same model share their cached results whatever their budget
+        return config.copy(update={"model": model, "latency_budget_ms": None})
 
 
     # Data prediction
-    async def predict_yolox(self, imag_bytes, filename):
-        self.logger.info("Loading image to compute prediction!")
-        image = await self.load_image_from_bytes(image_bytes=imag_bytes)
+    def run_prediction(self, imag_bytes, filename, config: PredictionConfig, output: OutputConfig,
+                       timings: Optional[dict] = None):
+        """
+        CPU-bound part of the prediction (decode, inference and encode), runs in the worker pool.
+        Only the image mode annotates and encodes the result, the other modes save the uploaded
+        bytes as they are and return no image. The file and the document are saved by the writer
+        after the response is sent. The seconds spent in every stage are added to timings.
+        """
+        with request_timings(timings):
+            return self._run_prediction(imag_bytes, filename, config, output)
+
+    def _run_prediction(self, imag_bytes, filename, config: PredictionConfig, output: OutputConfig):
         filepath = f"../data-files/{filename}"
-        predicted_image, crops_info = YoloX().predict(image, filepath)
-        # Generate image_summary dictionary
-        image_summary = {}
-        for crop in crops_info:
-            class_name = crop["class"]
-            if class_name in image_summary:
-                image_summary[class_name] += 1
+        with self.get_catalog().use(config.model) as model:
+            image, factor = self.load_image_from_bytes(
+                imag_bytes, *self.decode_cover(model, config, output.mode == "image", output.preview_size))
+            if output.mode != "image":
+                detections = model.detect(image, **config.thresholds(), tiler=config.tiler())
+                saved_content, predicted_image_bytes = imag_bytes, b""
             else:
-                image_summary[class_name] = 1
-        image_data = {"originalFileName": filename, "crops": crops_info, "filePath": filepath, "imageSummary": image_summary}
-        predicted_image_bytes = await self.return_bytes_from_image(image=predicted_image)
-        self.save_image_to_db(image_data=image_data)
-        self.logger.info("Returning image bytes!")
-        return predicted_image_bytes
+                saved_content, detections = model.predict(image, **config.thresholds(), tiler=config.tiler(),
+                                                          preview_size=output.preview_size)
+        if factor > 1:
+            detections = detections.scaled(factor)
+        if output.mode == "image":
+            predicted_image_bytes = self.return_bytes_from_image(image=saved_content, output=output).getvalue()
+        image_data = self.build_image_data(filename, filepath, detections, config.model)
+        document = self.create_image_object(image_data).dict(exclude_none=True)
+        self.writer.submit(filepath, saved_content, document)
+        return predicted_image_bytes, detections
+
+    def run_detection(self, imag_bytes, filepath, config: PredictionConfig):
+        """Same as run_prediction for batch jobs, which don't return the annotated image."""
+        with self.get_catalog().use(config.model) as model:
+            image, factor = self.load_image_from_bytes(
+                imag_bytes, *self.decode_cover(model, config, True, ANNOTATION_PREVIEW_SIZE))
+            annotated_image, detections = model.predict(image, **config.thresholds(), tiler=config.tiler())
+        if factor > 1:
+            detections = detections.scaled(factor)
+        count_detections(detections.class_counts())
+        # The documents are inserted in chunks by the batch job itself
+        self.writer.submit(filepath, annotated_image)
+        return detections
+
+    def build_image_data(self, filename, filepath, detections: Detections, model: Optional[str] = None) -> dict[str, Any]:
+        image_data = {"originalFileName": filename, "filePath": filepath, "imageSummary": detections.class_counts(),
+                      "model": model}
+        if DETECTIONS_STORAGE == "columnar":
+            image_data["detections"] = detections.to_document()
+        else:
+            image_data["crops"] = detections.to_crops()
+        return image_data
+
+    async def predict_yolox(self, imag_bytes, filename, config: Optional[PredictionConfig] = None,
+                            output: Optional[OutputConfig] = None, timings: Optional[dict] = None):
+        """
+        Returns the encoded annotated image, empty when the output mode has no image, and the Detections.
+        The seconds spent in the cache lookup and in every stage of the prediction are added to timings.
+        """
+        timings = timings if timings is not None else {}
+        config = self.resolve_model(config or PredictionConfig())
+        output = output or OutputConfig()
+        model_id = model_fingerprint(self.get_catalog().entry(config.model).path, NMS_BACKEND)
+        # The detections don't depend on the output format, only the encoded image does
+        variant = f"{output.format}:{output.quality}" if output.mode == "image" else "detections"
+        if output.mode == "image" and output.preview_size:
+            variant += f":{output.preview_size}"
+        start = time.perf_counter()
+        # hashlib releases the GIL, large images are hashed off the event loop
+        cache_key = await asyncio.to_thread(result_cache_key, imag_bytes, model_id, config, variant)
+        cached = await self.result_cache.get(cache_key)
+        timings["cache"] = time.perf_counter() - start
+        if cached is not None:
+            # Same bytes, model and thresholds: the stored document and file already have this result
+            count_detections(cached[1].class_counts())
+            return cached
+        predicted_image_bytes, detections = await self.worker_pool.run(
+            self.run_prediction, imag_bytes, filename, config, output, timings
+        )
+        count_detections(detections.class_counts())
+        await self.result_cache.put(cache_key, predicted_image_bytes, detections)
+        return predicted_image_bytes, detections
     
+    def detect_video(self, frames, config: PredictionConfig, frame_stride: int = 1,
+                     max_fps: Optional[float] = None, cleanup_path: Optional[str] = None):
+        """
+        Stream the per-frame detections of a video through the VideoPipeline. Each stream keeps
+        four threads busy, so at most VIDEO_MAX_STREAMS of them run at the same time. The returned
+        VideoStream has to be closed if it may not be iterated to the end.
+        """
+        if not self.video_streams.acquire(blocking=False):
+            if cleanup_path is not None:
+                os.remove(cleanup_path)
+            raise PoolSaturatedError(f"{VIDEO_MAX_STREAMS} video streams already running")
+        catalog = self.get_catalog()
+        try:
+            config = self.resolve_model(config)
+            model = catalog.acquire(config.model)
+        except Exception:
+            self.video_streams.release()
+            if cleanup_path is not None:
+                os.remove(cleanup_path)
+            raise
+        pipeline = VideoPipeline(model, frames, config, frame_stride=frame_stride, max_fps=max_fps)
+
+        def release():
+            # The model stays loaded for the whole stream
+            catalog.release(config.model)
+            self.video_streams.release()
+            if cleanup_path is not None:
+                os.remove(cleanup_path)
+            self.logger.info("Video stream finished!")
+
+        return VideoStream(pipeline, release)
+
+    # Batch jobs
+    def start_batch_job(self, upload_dir: str, uploads: list[tuple[str, str]], config: PredictionConfig) -> BatchJob:
+        """
+        Register a job for the uploaded images and archives, saved in upload_dir, and process it in
+        the background. The upload directory is removed once the job is done.
+        """
+        try:
+            config = self.resolve_model(config)
+            entries = list_batch_images(uploads)
+        except Exception:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            raise
+        job = self.batch_jobs.create(total=len(entries))
+        task = asyncio.create_task(self.run_batch_job(job, upload_dir, entries, config))
+        # The loop only keeps weak references to its tasks
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+        return job
+
+    async def run_batch_job(self, job: BatchJob, upload_dir: str, entries, config: PredictionConfig):
+        job.start()
+        slots = asyncio.Semaphore(BATCH_JOB_CONCURRENCY)
+        pending = []
+        tasks = set()
+
+        async def flush():
+            chunk = pending[:]
+            pending.clear()
+            try:
+                failed = await self.save_images_to_db(chunk)
+            except Exception as e:
+                self.logger.error(f"Batch job {job.id} failed to save {len(chunk)} images: {e}")
+                failed = {index: e for index in range(len(chunk))}
+            job.persisted += len(chunk) - len(failed)
+            for index, error in failed.items():
+                job.succeeded -= 1
+                job.record_failure(chunk[index]["originalFileName"], error)
+
+        async def process(filename, imag_bytes):
+            filepath = f"../data-files/{filename}"
+            try:
+                if isinstance(imag_bytes, Exception):
+                    # Not read, e.g. an archive member over the size limit
+                    raise imag_bytes
+                detections = await self.run_batch_detection(imag_bytes, filepath, config)
+                pending.append(self.build_image_data(filename, filepath, detections, config.model))
+                job.succeeded += 1
+                if len(pending) >= BATCH_INSERT_CHUNK:
+                    await flush()
+            except Exception as e:
+                job.record_failure(filename, e)
+            finally:
+                slots.release()
+
+        images = iter_batch_images(entries)
+        reading = None
+        try:
+            while True:
+                await slots.acquire()
+                # Reading the archive members is blocking IO. Shielded, so a cancelled job can tell
+                # whether the generator is still running in its thread
+                reading = asyncio.get_running_loop().run_in_executor(None, next, images, None)
+                image = await asyncio.shield(reading)
+                if image is None:
+                    slots.release()
+                    break
+                task = asyncio.create_task(process(*image))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+            if pending:
+                await flush()
+            job.finish()
+            self.logger.info(f"Batch job {job.id} finished: {job.succeeded} images processed, {job.failed} failed")
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            job.finish("cancelled")
+            raise
+        except Exception as e:
+            self.logger.error(f"Batch job {job.id} failed: {e}")
+            job.finish("failed")
+        finally:
+            if reading is not None and not reading.done():
+                # A generator can't be closed while it runs in another thread, it is stopped once
+                # the current read returns
+                reading.add_done_callback(lambda _: images.close())
+            else:
+                images.close()
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+    async def run_batch_detection(self, imag_bytes, filepath, config: PredictionConfig):
+        # Batch jobs wait for room in the worker pool instead of failing
+        while True:
+            try:
+                return await self.worker_pool.run(self.run_detection, imag_bytes, filepath, config)
+            except PoolSaturatedError:
+                await asyncio.sleep(BATCH_RETRY_DELAY_S)
+
     # Prediction data management functions
     async def image_summary(self, id:str):
         try:
-            image = list(self.db["images"].find({"id": id}, {"_id": 0}))[0]
+            image = await self.db["images"].find_one({"id": id}, {"_id": 0})
             return Image.parse_obj(image).image_summary
         except Exception as e:
             self.logger.error(f"Image summary hasn't been retrieved properly!")
@@ -99,10 +432,49 @@ class CoreFunctions:
         try:
             images = self.db["images"].find({})
             summary_list = []
-            for image in images:
-                image_summary = {"id":image["id"],"originalFileName":image["originalFileName"],"crops": image["crops"],"imageSummary":image["imageSummary"]}
+            async for image in images:
+                crops = Image.parse_obj(image).get_crops()
+                image_summary = {"id":image["id"],"originalFileName":image["originalFileName"],"crops": crops,"imageSummary":image["imageSummary"]}
                 summary_list.append(image_summary)
             return summary_list
         except Exception as e:
             self.logger.error(f"Global summary hasn't been retrieved properly!")
-            return []
\ No newline at end of file
+            return []
+
+    async def get_summary_stats(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                                classes: Optional[list[str]] = None, top_images: int = 20) -> dict[str, Any]:
+        """
+        Detection statistics aggregated in MongoDB, see summary_pipeline. When the server rejects the
+        pipeline, e.g. a MongoDB older than 7.0 without $percentile, they are computed again without
+        the confidence quantiles. Other database errors are logged and raised.
+        """
+        try:
+            pipeline = summary_pipeline(date_from, date_to, classes, top_images)
+            try:
+                results = await self.db["images"].aggregate(pipeline, allowDiskUse=True).to_list(1)
+            except OperationFailure as e:
+                self.logger.warning(f"Summary statistics computed without the confidence quantiles: {e}")
+                pipeline = summary_pipeline(date_from, date_to, classes, top_images, quantiles=False)
+                results = await self.db["images"].aggregate(pipeline, allowDiskUse=True).to_list(1)
+            return format_summary(results[0])
+        except PyMongoError as e:
+            self.logger.error(f"Summary statistics haven't been computed properly: {e}")
+            raise
+
+    async def get_stats(self, granularity: str = "day", date_from: Optional[datetime] = None,
+                        date_to: Optional[datetime] = None) -> dict[str, Any]:
+        """
+        Statistics read from the incrementally maintained stats collection, with the hourly or daily
+        buckets of the date range as a time series. Without dates, the totals are the global document.
+        """
+        buckets = await self.db[STATS_COLLECTION].find(stats_query(granularity, date_from, date_to), STATS_PROJECTION) \
+            .sort("bucket", 1).to_list(None)
+        if date_from is None and date_to is None:
+            stats = await self.db[STATS_COLLECTION].find_one({"_id": "all"}, STATS_PROJECTION) or {}
+        else:
+            stats = merge_stats(buckets)
+        series = [
+            {"bucket": bucket["bucket"], "images": bucket["images"], "detections": bucket["detections"]}
+            for bucket in buckets
+        ]
+        return {**format_stats(stats), "series": series}
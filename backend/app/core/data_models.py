@@ -1,14 +1,61 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 from pydantic import Field
 from datetime import datetime
 from uuid import uuid4
 from util.camel_base_model import CamelBaseModel
+from ml.detections import Detections
+from ml.tiling import Tiler, TILE_SIZE, TILE_OVERLAP, TILE_MERGE
+from ml.renderer import ANNOTATION_PREVIEW_SIZE
 from datetime import datetime
 
 class Image(CamelBaseModel):
     id: str = Field(default_factory=lambda: str(uuid4()))
     original_file_name: str
     created_on: Optional[str] = Field(default_factory=lambda: datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    crops: List
+    crops: Optional[List] = None
+    # Compact detections (Detections.to_document), stored instead of the crops with DETECTIONS_STORAGE=columnar
+    detections: Optional[dict] = None
     file_path: str
     image_summary: dict
+    # Catalog name of the model that made the detections
+    model: Optional[str] = None
+
+    def get_detections(self) -> Detections:
+        """Detections of the image whatever the format it was stored in, decoded when called."""
+        return Detections.from_image_document({"crops": self.crops, "detections": self.detections})
+
+    def get_crops(self) -> list:
+        return self.crops if self.crops is not None else self.get_detections().to_crops()
+
+
+class PredictionConfig(CamelBaseModel):
+    score_thr: float = Field(0.1, ge=0, le=1)
+    nms_thr: float = Field(0.6, ge=0, le=1)
+    conf: float = Field(0.45, ge=0, le=1)
+    class_agnostic: bool = False
+    # Model of the catalog, or the most accurate one within the latency budget, see ModelCatalog.select
+    model: Optional[str] = None
+    latency_budget_ms: Optional[float] = Field(None, gt=0)
+    # Tiled inference of large images, see Tiler
+    tiled: bool = False
+    tile_size: int = Field(TILE_SIZE, ge=32, le=4096)
+    tile_overlap: float = Field(TILE_OVERLAP, ge=0, lt=1)
+    tile_merge: Literal["nms", "wbf"] = TILE_MERGE
+
+    def thresholds(self) -> dict:
+        """Keyword arguments of the model prediction methods."""
+        return self.dict(by_alias=False, include={"nms_thr", "score_thr", "conf", "class_agnostic"})
+
+    def tiler(self) -> Optional[Tiler]:
+        return Tiler(self.tile_size, self.tile_overlap, self.tile_merge) if self.tiled else None
+
+
+class OutputConfig(CamelBaseModel):
+    # image: annotated image, json: detections only, boxes: original image and detections to draw them client side
+    mode: Literal["image", "json", "boxes"] = "image"
+    format: Literal["png", "jpeg", "webp"] = "png"
+    quality: int = Field(90, ge=1, le=100)
+    # Shape of the detections in the json and boxes modes: a list of crops or one list per attribute
+    layout: Literal["crops", "columnar"] = "crops"
+    # Longer side of the annotated image in the image mode, 0 keeps the uploaded resolution
+    preview_size: int = Field(ANNOTATION_PREVIEW_SIZE, ge=0)
@@ -0,0 +1,90 @@
+import os
+import mimetypes
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Optional
+from util.logger import Logger
+
+HOT_IMAGE_CACHE_MB = float(os.environ.get("HOT_IMAGE_CACHE_MB", 64))
+# Bigger files are always streamed from disk, so a few large images don't flush the whole cache
+HOT_IMAGE_MAX_FILE_MB = float(os.environ.get("HOT_IMAGE_MAX_FILE_MB", 4))
+
+
+class ImageFile:
+    """A stored image on disk with the validators of its current version."""
+
+    def __init__(self, path: str, stat_result: os.stat_result):
+        self.path = path
+        self.stat = stat_result
+        self.etag = f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+        self.last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    @property
+    def headers(self) -> dict[str, str]:
+        # no-cache lets clients keep the image but revalidate it, the file is overwritten on re-uploads
+        return {"ETag": self.etag, "Last-Modified": self.last_modified, "Cache-Control": "no-cache"}
+
+    def is_not_modified(self, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+        """Conditional GET as in RFC 7232, If-None-Match takes precedence over If-Modified-Since."""
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag in tags or f"W/{self.etag}" in tags
+        if if_modified_since is not None:
+            try:
+                return int(self.stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class HotImageCache:
+    """
+    LRU of the bytes of recently requested images, bounded by size. Entries are keyed by the
+    ETag of the file, so an image overwritten on disk is never served from a stale entry.
+    """
+
+    def __init__(self, max_bytes: int = int(HOT_IMAGE_CACHE_MB * 1024 * 1024),
+                 max_file_bytes: int = int(HOT_IMAGE_MAX_FILE_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.entries: "OrderedDict[tuple[str, str], bytes]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.logger = Logger(self.__class__).get_logger()
+
+    def cacheable(self, image_file: ImageFile) -> bool:
+        return image_file.stat.st_size <= min(self.max_file_bytes, self.max_bytes)
+
+    def get(self, image_file: ImageFile) -> Optional[bytes]:
+        key = (image_file.path, image_file.etag)
+        with self.lock:
+            content = self.entries.get(key)
+            if content is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return content
+
+    def load(self, image_file: ImageFile) -> bytes:
+        """Reads the file and keeps it in the cache, runs off the event loop."""
+        with open(image_file.path, "rb") as stored_file:
+            content = stored_file.read()
+        with self.lock:
+            # Drop the entries of older versions of the same file
+            for key in [key for key in self.entries if key[0] == image_file.path]:
+                self.size -= len(self.entries.pop(key))
+            self.entries[(image_file.path, image_file.etag)] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return content
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {"entries": len(self.entries), "sizeBytes": self.size, "hits": self.hits, "misses": self.misses}
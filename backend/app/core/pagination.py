@@ -0,0 +1,39 @@
+import base64
+import json
+from typing import Any, Optional
+
+# Newest first, id breaks the ties of images created in the same second
+IMAGE_LIST_SORT = [("createdOn", -1), ("id", -1)]
+IMAGE_LIST_PROJECTION = {"_id": 0, "id": 1, "originalFileName": 1, "createdOn": 1}
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor can't be decoded."""
+
+
+def encode_cursor(document: dict[str, Any]) -> str:
+    """Opaque cursor pointing right after the given document in IMAGE_LIST_SORT order."""
+    payload = json.dumps([document.get("createdOn"), document["id"]]).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[Optional[str], str]:
+    try:
+        created_on, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}") from e
+    return created_on, image_id
+
+
+def keyset_filter(cursor: Optional[str]) -> dict[str, Any]:
+    """
+    Filter of the documents after the cursor. Unlike skip(), it seeks straight to the position in
+    the (createdOn, id) index, so every page costs the same however deep it is.
+    """
+    if cursor is None:
+        return {}
+    created_on, image_id = decode_cursor(cursor)
+    return {"$or": [
+        {"createdOn": {"$lt": created_on}},
+        {"createdOn": created_on, "id": {"$lt": image_id}},
+    ]}
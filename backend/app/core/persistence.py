@@ -0,0 +1,206 @@
+import os
+import queue
+import threading
+import time
+from typing import Any, Optional, Union
+from uuid import uuid4
+import cv2
+import numpy as np
+from pymongo.errors import BulkWriteError
+from core.stats import STATS_COLLECTION, applied_buckets, bucket_updates
+from util.logger import Logger
+from util.metrics import ERRORS, stage_timer
+
+PERSIST_QUEUE_SIZE = int(os.environ.get("PERSIST_QUEUE_SIZE", 256))
+PERSIST_BATCH_SIZE = int(os.environ.get("PERSIST_BATCH_SIZE", 50))
+PERSIST_FLUSH_MS = float(os.environ.get("PERSIST_FLUSH_MS", 200))
+PERSIST_MAX_RETRIES = int(os.environ.get("PERSIST_MAX_RETRIES", 3))
+PERSIST_RETRY_BACKOFF_S = 0.1
+DUPLICATE_KEY_ERROR = 11000
+
+
+class WriteBehindWriter:
+    """
+    Saves the prediction files and Mongo documents off the request path. Writes are queued in a
+    bounded buffer and a background thread groups them in batches of up to batch_size, or whatever
+    arrived in flush_ms, writing the files first and then all the documents with a single
+    insert_many. Failed writes are retried with backoff, and stop() flushes everything still queued.
+
+    The buffer being bounded, submit() blocks while it is full. It is called from the worker pool,
+    so a slow disk or database ends up as backpressure on the pool instead of growing memory.
+    """
+
+    def __init__(self, max_pending: int = PERSIST_QUEUE_SIZE, batch_size: int = PERSIST_BATCH_SIZE,
+                 flush_ms: float = PERSIST_FLUSH_MS, max_retries: int = PERSIST_MAX_RETRIES):
+        self.db = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.files_written = 0
+        self.documents_inserted = 0
+        self.batches = 0
+        self.retries = 0
+        self.failures = 0
+        self.logger = Logger(self.__class__).get_logger()
+
+    def start(self, db: Any) -> None:
+        """Start the writer thread saving the documents to the given (sync pymongo) database."""
+        self.db = db
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, filepath: Optional[str], content: Union[np.ndarray, bytes, None],
+               document: Optional[dict] = None) -> None:
+        """
+        Queue the image to save at filepath, either an image array encoded by the file extension or
+        already encoded bytes, and the document to insert in the images collection. Either can be None.
+        """
+        if self.thread is None:
+            # Not started (scripts, tests), everything is written right away
+            self._write_batch([(filepath, content, document)])
+            return
+        self.queue.put((filepath, content, document))
+
+    def _collect_batch(self) -> Optional[list]:
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop signal back so the loop exits after writing this last batch
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            self._write_batch(batch)
+
+    def _write_batch(self, batch: list) -> None:
+        for filepath, content, _ in batch:
+            if filepath is not None and content is not None:
+                self._retry(f"write {filepath}", self._write_file, filepath, content)
+        documents = [document for _, _, document in batch if document is not None]
+        if documents:
+            inserted = []
+            self._retry(f"insert {len(documents)} documents", self._insert_documents, documents, inserted)
+            if inserted:
+                # Retried on its own, so a failed stats update never inserts or counts the documents again
+                self._retry(f"update the stats of {len(inserted)} documents", self._update_stats,
+                            inserted, {}, uuid4().hex)
+        with self.lock:
+            self.batches += 1
+
+    def _retry(self, action: str, func, *args) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                func(*args)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    with self.lock:
+                        self.failures += 1
+                    ERRORS.labels("persistence").inc()
+                    self.logger.error(f"Failed to {action} after {attempt + 1} attempts: {e}")
+                    return
+                with self.lock:
+                    self.retries += 1
+                self.logger.warning(f"Failed to {action}, retrying: {e}")
+                time.sleep(PERSIST_RETRY_BACKOFF_S * 2 ** attempt)
+
+    def _write_file(self, filepath: str, content: Union[np.ndarray, bytes]) -> None:
+        with stage_timer("disk_write"):
+            if isinstance(content, np.ndarray):
+                if not cv2.imwrite(filepath, content):
+                    raise IOError(f"OpenCV could not write {filepath}")
+            else:
+                with open(filepath, "wb") as image_file:
+                    image_file.write(content)
+        with self.lock:
+            self.files_written += 1
+
+    def _insert_documents(self, documents: list, inserted: list) -> None:
+        """
+        Insert the documents, adding the ones that made it to inserted. Only the ones that failed are
+        left in documents for the retry.
+        """
+        failed, error = set(), None
+        try:
+            with stage_timer("mongo_insert"):
+                self.db["images"].insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # pymongo sets the _id of the documents, so a document inserted by an attempt that failed
+            # before reporting it comes back as a duplicate, it was never added to inserted
+            failed = {error["index"] for error in e.details["writeErrors"] if error["code"] != DUPLICATE_KEY_ERROR}
+            error = e
+        inserted.extend(document for index, document in enumerate(documents) if index not in failed)
+        with self.lock:
+            self.documents_inserted += len(documents) - len(failed)
+        documents[:] = [document for index, document in enumerate(documents) if index in failed]
+        if error is not None and failed:
+            raise error
+
+    def _update_stats(self, documents: list, updates: dict, batch_id: str) -> None:
+        """
+        Apply the $inc stats updates of the documents, by stats document id. They are built on the
+        first attempt and tagged with batch_id, so an update applied by an attempt that failed before
+        acknowledging it isn't applied again. Only the ones not applied are left in updates for the retry.
+        """
+        if documents:
+            updates.update(bucket_updates(documents, batch_id))
+            documents.clear()
+        if not updates:
+            return
+        buckets = list(updates)
+        try:
+            self.db[STATS_COLLECTION].bulk_write(list(updates.values()), ordered=False)
+        except BulkWriteError as e:
+            failed = {buckets[error["index"]] for error in e.details["writeErrors"]}
+            # A duplicate key is either a bucket that already has the batch, or one created at the same
+            # time by another upsert, which has to be retried
+            duplicates = {buckets[error["index"]] for error in e.details["writeErrors"]
+                          if error["code"] == DUPLICATE_KEY_ERROR}
+            if duplicates:
+                failed -= applied_buckets(self.db[STATS_COLLECTION], duplicates, batch_id)
+            for bucket in buckets:
+                if bucket not in failed:
+                    del updates[bucket]
+            if failed:
+                raise
+            return
+        updates.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "maxQueued": self.queue.maxsize,
+                "filesWritten": self.files_written,
+                "documentsInserted": self.documents_inserted,
+                "batches": self.batches,
+                "retries": self.retries,
+                "failures": self.failures,
+            }
@@ -0,0 +1,126 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Optional
+from bson import Binary
+from core.data_models import PredictionConfig
+from ml.detections import Detections
+from util.logger import Logger
+
+RESULT_CACHE_MAX_MB = float(os.environ.get("RESULT_CACHE_MAX_MB", 256))
+RESULT_CACHE_MONGO = os.environ.get("RESULT_CACHE_MONGO", "false").lower() == "true"
+RESULT_CACHE_COLLECTION = "result_cache"
+# Rough size of a detection once its crop dict is built, so entries with many detections also count against the budget
+CROP_SIZE_BYTES = 256
+
+
+def model_fingerprint(model_path: str, nms_backend: str) -> str:
+    """Identifies the model file, so replacing it at the same path doesn't return stale results."""
+    stat = os.stat(model_path)
+    return f"{os.path.abspath(model_path)}:{stat.st_size}:{int(stat.st_mtime)}:{nms_backend}"
+
+
+def result_cache_key(image_bytes: bytes, model_id: str, config: PredictionConfig, variant: str = "") -> str:
+    """The variant tells apart the entries of the same prediction with different outputs."""
+    digest = hashlib.sha256(image_bytes)
+    digest.update(model_id.encode())
+    digest.update(config.json(sort_keys=True).encode())
+    digest.update(variant.encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of the predictions, keyed by the hash of the image bytes, the model and
+    the thresholds. Entries hold the encoded annotated image and the Detections. The in-process tier is an
+    LRU evicting by size, and when a (Motor) db is given the entries are also kept in Mongo, so they survive
+    restarts and are shared between replicas. MongoDB removes them RESULT_CACHE_TTL_HOURS after they were
+    cached, with the TTL index on createdOn.
+    """
+
+    def __init__(self, max_bytes: int = int(RESULT_CACHE_MAX_MB * 1024 * 1024), db: Any = None):
+        self.max_bytes = max_bytes
+        self.collection = db[RESULT_CACHE_COLLECTION] if db is not None else None
+        self.entries: "OrderedDict[str, tuple[bytes, Detections]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.logger = Logger(self.__class__).get_logger()
+
+    async def get(self, key: str) -> Optional[tuple[bytes, Detections]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        if self.collection is not None:
+            try:
+                document = await self.collection.find_one({"key": key}, {"_id": 0})
+            except Exception as e:
+                self.logger.error(f"Failed to read cached result from MongoDB: {e}")
+                document = None
+            if document is not None:
+                # Entries saved before the compact format have the crops instead
+                entry = (bytes(document["image"]), Detections.from_image_document(document))
+                self._store(key, entry)
+                with self.lock:
+                    self.mongo_hits += 1
+                return entry
+        with self.lock:
+            self.misses += 1
+        return None
+
+    async def put(self, key: str, image_bytes: bytes, detections: Detections) -> None:
+        self._store(key, (image_bytes, detections))
+        if self.collection is not None:
+            try:
+                await self.collection.update_one(
+                    {"key": key},
+                    {"$setOnInsert": {"key": key, "image": Binary(image_bytes), "detections": detections.to_document(),
+                                      # A date rather than the string of the images, TTL indexes only expire dates
+                                      "createdOn": datetime.utcnow()}},
+                    upsert=True,
+                )
+            except Exception as e:
+                # The in-process tier still has the entry, a failing Mongo tier only costs hits
+                self.logger.error(f"Failed to save cached result to MongoDB: {e}")
+
+    @staticmethod
+    def _entry_size(entry: tuple[bytes, Detections]) -> int:
+        return len(entry[0]) + CROP_SIZE_BYTES * len(entry[1])
+
+    def _store(self, key: str, entry: tuple[bytes, Detections]) -> None:
+        entry_size = self._entry_size(entry)
+        if entry_size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= self._entry_size(previous)
+            self.entries[key] = entry
+            self.size += entry_size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self._entry_size(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.mongo_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "sizeBytes": self.size,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "mongoHits": self.mongo_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": (self.hits + self.mongo_hits) / lookups if lookups else 0.0,
+                "mongoTier": self.collection is not None,
+            }
@@ -0,0 +1,136 @@
+import math
+from datetime import datetime
+from typing import Any, Iterable, Optional
+import numpy as np
+from pymongo import UpdateOne
+from ml.detections import Detections
+
+STATS_COLLECTION = "stats"
+# Bucket id format of every granularity, applied to the createdOn "%Y-%m-%d %H:%M:%S" strings
+BUCKET_FORMATS = {"hour": "%Y-%m-%d %H", "day": "%Y-%m-%d"}
+BUCKET_LENGTHS = {"hour": 13, "day": 10}
+CONFIDENCE_BIN_WIDTH = 10
+# Ids of the last batches applied to every stats document, so a retried update isn't counted twice
+STATS_APPLIED_BATCHES = 100
+STATS_PROJECTION = {"appliedBatches": 0}
+
+
+def stats_increments(documents: Iterable[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """
+    $inc of every stats document touched by the given image documents: the "all" document with the
+    global totals, and the hourly and daily buckets of their createdOn. The increments of a whole
+    batch are added up, so saving a batch costs one update per bucket instead of one per image.
+    """
+    increments = {}
+    for document in documents:
+        created_on = document.get("createdOn") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        buckets = ["all"] + [f"{granularity}:{created_on[:length]}" for granularity, length in BUCKET_LENGTHS.items()]
+        detections = Detections.from_image_document(document)
+        confidences = detections.confidences
+        inc = {"images": 1, "detections": len(detections)}
+        if len(detections):
+            inc["confidenceSum"] = float(confidences.sum())
+            inc["confidenceSquaresSum"] = float(np.square(confidences).sum())
+            counts = np.bincount(detections.class_ids, minlength=len(detections.labels))
+            sums = np.bincount(detections.class_ids, weights=confidences, minlength=len(detections.labels))
+            for class_name, count, confidence_sum in zip(detections.labels, counts.tolist(), sums.tolist()):
+                if count:
+                    inc[f"classes.{class_name}.count"] = count
+                    inc[f"classes.{class_name}.confidenceSum"] = confidence_sum
+            bins, bin_counts = np.unique(
+                np.minimum(confidences // CONFIDENCE_BIN_WIDTH, 100 // CONFIDENCE_BIN_WIDTH - 1), return_counts=True)
+            for bin_index, count in zip(bins.tolist(), bin_counts.tolist()):
+                inc[f"confidenceHistogram.{int(bin_index) * CONFIDENCE_BIN_WIDTH}"] = count
+        for bucket in buckets:
+            bucket_inc = increments.setdefault(bucket, {})
+            for field, value in inc.items():
+                bucket_inc[field] = bucket_inc.get(field, 0) + value
+    return increments
+
+
+def stats_updates(documents: Iterable[dict[str, Any]], batch_id: Optional[str] = None) -> list[UpdateOne]:
+    """Upserts applying stats_increments, for a bulk_write on the stats collection."""
+    return list(bucket_updates(documents, batch_id).values())
+
+
+def bucket_updates(documents: Iterable[dict[str, Any]], batch_id: Optional[str] = None) -> dict[str, UpdateOne]:
+    """
+    stats_updates by stats document id. With a batch_id, an update only applies to a document that
+    doesn't have it among its appliedBatches yet, and adds it there, so sending it again after an
+    error that hid whether it was applied can't count the batch twice. The upsert of a document
+    that already has it fails with a duplicate key error instead, see applied_buckets.
+    """
+    updates = {}
+    for bucket, inc in stats_increments(documents).items():
+        granularity, _, bucket_id = bucket.partition(":")
+        query = {"_id": bucket}
+        update = {"$inc": inc, "$setOnInsert": {"granularity": granularity, "bucket": bucket_id or None}}
+        if batch_id is not None:
+            query["appliedBatches"] = {"$ne": batch_id}
+            update["$push"] = {"appliedBatches": {"$each": [batch_id], "$slice": -STATS_APPLIED_BATCHES}}
+        updates[bucket] = UpdateOne(query, update, upsert=True)
+    return updates
+
+
+def applied_buckets(collection, buckets: Iterable[str], batch_id: str) -> set[str]:
+    """Ids of the given stats documents the batch_id updates were already applied to."""
+    return {document["_id"] for document in
+            collection.find({"_id": {"$in": list(buckets)}, "appliedBatches": batch_id}, {"_id": 1})}
+
+
+def stats_query(granularity: str, date_from: Optional[datetime] = None,
+                date_to: Optional[datetime] = None) -> dict[str, Any]:
+    """Filter of the buckets of the given granularity overlapping the date range."""
+    bucket_format = BUCKET_FORMATS[granularity]
+    query = {"granularity": granularity}
+    if date_from is not None or date_to is not None:
+        query["bucket"] = {}
+        if date_from is not None:
+            query["bucket"]["$gte"] = date_from.strftime(bucket_format)
+        if date_to is not None:
+            query["bucket"]["$lte"] = date_to.strftime(bucket_format)
+    return query
+
+
+def merge_stats(documents: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    """Add up stats documents, e.g. the daily buckets of a date range."""
+    merged = {}
+
+    def add(target, source):
+        for field, value in source.items():
+            if isinstance(value, dict):
+                add(target.setdefault(field, {}), value)
+            elif isinstance(value, (int, float)):
+                target[field] = target.get(field, 0) + value
+
+    for document in documents:
+        add(merged, document)
+    return merged
+
+
+def format_stats(stats: dict[str, Any]) -> dict[str, Any]:
+    images = stats.get("images", 0)
+    detections = stats.get("detections", 0)
+    mean = stats.get("confidenceSum", 0) / detections if detections else None
+    std = None
+    if detections > 1:
+        variance = (stats.get("confidenceSquaresSum", 0) / detections - mean ** 2) * detections / (detections - 1)
+        std = math.sqrt(max(variance, 0.0))
+    classes = [
+        {"class": class_name, "count": values["count"], "meanConfidence": values["confidenceSum"] / values["count"]}
+        for class_name, values in stats.get("classes", {}).items()
+    ]
+    classes.sort(key=lambda values: (-values["count"], values["class"]))
+    histogram = stats.get("confidenceHistogram", {})
+    return {
+        "images": images,
+        "detections": detections,
+        "meanDetectionsPerImage": detections / images if images else None,
+        "classes": classes,
+        "confidence": {
+            "count": detections,
+            "mean": mean,
+            "std": std,
+            "histogram": {bin_start: histogram[bin_start] for bin_start in sorted(histogram, key=int)},
+        },
+    }
@@ -0,0 +1,109 @@
+from datetime import datetime
+from typing import Any, Optional
+
+CREATED_ON_FORMAT = "%Y-%m-%d %H:%M:%S"
+CONFIDENCE_QUANTILES = [0.25, 0.5, 0.75]
+
+
+def summary_pipeline(date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                     classes: Optional[list[str]] = None, top_images: int = 20,
+                     quantiles: bool = True) -> list[dict[str, Any]]:
+    """
+    Aggregation computing the detection statistics in MongoDB, so only a few KB come back whatever
+    the size of the collection: class distribution and mean confidence per class, detections per
+    image with the images having the most of them, and the confidence distribution. The quantiles
+    use $percentile, which needs MongoDB 7.0, and are left out with quantiles=False.
+
+    createdOn is stored as a sortable string, the date range is compared as strings and can use the
+    createdOn index. With classes, only the images and crops of those classes are counted. The
+    documents saved with DETECTIONS_STORAGE=columnar have no crops to aggregate: they count in the
+    images and the detections per image from their stored count, but not in the class and
+    confidence distributions (and not at all with classes), the stats collection covers both formats.
+    """
+    match = {}
+    if date_from is not None or date_to is not None:
+        match["createdOn"] = {}
+        if date_from is not None:
+            match["createdOn"]["$gte"] = date_from.strftime(CREATED_ON_FORMAT)
+        if date_to is not None:
+            match["createdOn"]["$lte"] = date_to.strftime(CREATED_ON_FORMAT)
+    crops = "$crops"
+    if classes:
+        match["crops.class"] = {"$in": classes}
+        crops = {"$filter": {"input": "$crops", "as": "crop", "cond": {"$in": ["$$crop.class", classes]}}}
+    # Columnar documents have no crops but store their detections count
+    detections_count = {"$cond": [{"$isArray": crops}, {"$size": crops}, {"$ifNull": ["$detections.count", 0]}]}
+    detections_per_image = {"$project": {"id": 1, "originalFileName": 1, "detections": 1}}
+    confidence = {
+        "_id": None,
+        "count": {"$sum": 1},
+        "mean": {"$avg": "$crops.confidence"},
+        "std": {"$stdDevSamp": "$crops.confidence"},
+        "min": {"$min": "$crops.confidence"},
+        "max": {"$max": "$crops.confidence"},
+    }
+    if quantiles:
+        confidence["quantiles"] = {"$percentile": {
+            "input": "$crops.confidence", "p": CONFIDENCE_QUANTILES, "method": "approximate",
+        }}
+    return [
+        {"$match": match},
+        {"$project": {"_id": 0, "id": 1, "originalFileName": 1, "crops": crops, "detections": detections_count}},
+        {"$facet": {
+            "images": [
+                detections_per_image,
+                {"$group": {
+                    "_id": None,
+                    "images": {"$sum": 1},
+                    "detections": {"$sum": "$detections"},
+                    "meanDetections": {"$avg": "$detections"},
+                    "maxDetections": {"$max": "$detections"},
+                }},
+            ],
+            "topImages": [
+                detections_per_image,
+                {"$sort": {"detections": -1, "id": 1}},
+                {"$limit": top_images},
+                {"$project": {"_id": 0, "id": 1, "originalFileName": 1, "detections": 1}},
+            ],
+            "classes": [
+                {"$unwind": "$crops"},
+                {"$group": {
+                    "_id": "$crops.class",
+                    "count": {"$sum": 1},
+                    "meanConfidence": {"$avg": "$crops.confidence"},
+                }},
+                {"$sort": {"count": -1, "_id": 1}},
+            ],
+            "confidence": [
+                {"$unwind": "$crops"},
+                {"$group": confidence},
+            ],
+        }},
+    ]
+
+
+def format_summary(result: dict[str, Any]) -> dict[str, Any]:
+    """Flatten the single document returned by summary_pipeline."""
+    images = result["images"][0] if result["images"] else {}
+    confidence = result["confidence"][0] if result["confidence"] else {}
+    quantiles = confidence.get("quantiles") or [None] * len(CONFIDENCE_QUANTILES)
+    return {
+        "images": images.get("images", 0),
+        "detections": images.get("detections", 0),
+        "meanDetectionsPerImage": images.get("meanDetections"),
+        "maxDetectionsPerImage": images.get("maxDetections"),
+        "topImages": result["topImages"],
+        "classes": [
+            {"class": group["_id"], "count": group["count"], "meanConfidence": group["meanConfidence"]}
+            for group in result["classes"]
+        ],
+        "confidence": {
+            "count": confidence.get("count", 0),
+            "mean": confidence.get("mean"),
+            "std": confidence.get("std"),
+            "min": confidence.get("min"),
+            **{f"{int(p * 100)}%": value for p, value in zip(CONFIDENCE_QUANTILES, quantiles)},
+            "max": confidence.get("max"),
+        },
+    }
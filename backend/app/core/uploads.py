@@ -0,0 +1,222 @@
+import os
+import struct
+from typing import Iterable, Iterator, Optional
+import cv2
+import numpy as np
+
+# Whole request body, videos and batch uploads included
+MAX_UPLOAD_MB = float(os.environ.get("MAX_UPLOAD_MB", 1024))
+MAX_IMAGE_UPLOAD_MB = float(os.environ.get("MAX_IMAGE_UPLOAD_MB", 50))
+# Checked on the image header, so a small file can't expand into gigabytes of pixels
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 100_000_000))
+DECODE_REDUCED = os.environ.get("DECODE_REDUCED", "true").lower() == "true"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Reduction factor -> OpenCV flag, JPEG is decoded at the reduced size, the other formats are resized after decoding
+REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class UploadTooLargeError(Exception):
+    pass
+
+
+class UnsupportedImageError(Exception):
+    pass
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+def sniff_image_format(header: bytes) -> Optional[str]:
+    """Image format from the magic bytes at the start of the file, None for anything OpenCV shouldn't decode."""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header.startswith(b"BM"):
+        return "bmp"
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    return None
+
+
+def image_size(data) -> Optional[tuple[int, int]]:
+    """(width, height) read from the header of a JPEG, PNG, WebP or BMP, None when it can't be read."""
+    image_format = sniff_image_format(bytes(data[:16]))
+    try:
+        if image_format == "png":
+            return struct.unpack(">II", data[16:24])
+        if image_format == "bmp":
+            width, height = struct.unpack("<ii", data[18:26])
+            return width, abs(height)
+        if image_format == "webp":
+            chunk = bytes(data[12:16])
+            if chunk == b"VP8X":
+                return 1 + int.from_bytes(data[24:27], "little"), 1 + int.from_bytes(data[27:30], "little")
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", data[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L":
+                bits = int.from_bytes(data[21:25], "little")
+                return 1 + (bits & 0x3FFF), 1 + ((bits >> 14) & 0x3FFF)
+        if image_format == "jpeg":
+            return jpeg_size(data)
+    except struct.error:
+        return None
+    return None
+
+
+def jpeg_size(data) -> Optional[tuple[int, int]]:
+    """Walk the JPEG segments up to the start of frame, which has the image size."""
+    offset = 2
+    while offset + 9 < len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            offset += 1
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + struct.unpack(">H", data[offset + 2:offset + 4])[0]
+    return None
+
+
+def reduction_factor(width: int, height: int, cover: tuple[int, int], min_side: int = 0) -> int:
+    """
+    Largest of 8, 4 and 2 the image can be shrunk by while one of its axes still covers the model input,
+    so the letterbox keeps downscaling it, and its longer side stays at least min_side. 1 when none fits.
+    """
+    cover_height, cover_width = cover
+    for factor in REDUCED_DECODE_FLAGS:
+        reduced_width, reduced_height = width // factor, height // factor
+        if (reduced_height >= cover_height or reduced_width >= cover_width) and max(reduced_width, reduced_height) >= min_side:
+            return factor
+    return 1
+
+
+def decode_image(data, cover: Optional[tuple[int, int]] = None, min_side: int = 0) -> tuple[np.ndarray, int]:
+    """
+    Decode the image bytes, at 1/2, 1/4 or 1/8 of their resolution when the image is much larger than
+    cover (height, width), see reduction_factor. Returns the image and the factor its coordinates have
+    to be multiplied by to get back to the original image, 1 for a full resolution decode.
+    """
+    size = image_size(data)
+    if size is not None and size[0] * size[1] > MAX_IMAGE_PIXELS:
+        raise UploadTooLargeError(f"Image of {size[0]}x{size[1]} pixels, the limit is {MAX_IMAGE_PIXELS} pixels")
+    factor = 1
+    if DECODE_REDUCED and cover is not None and size is not None:
+        factor = reduction_factor(*size, cover, min_side)
+    flag = REDUCED_DECODE_FLAGS.get(factor, cv2.IMREAD_COLOR)
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if image is None:
+        raise InvalidImageError("Could not decode the image")
+    return image, factor
+
+
+async def read_upload(file, max_bytes: int = int(MAX_IMAGE_UPLOAD_MB * 1024 * 1024)) -> bytearray:
+    """
+    Read an uploaded image in chunks into a single buffer, rejecting it as soon as its first chunk
+    isn't an image or its size goes over max_bytes, before anything is decoded.
+    """
+    content = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        if not content and sniff_image_format(chunk[:16]) is None:
+            raise UnsupportedImageError(f"{file.filename} is not a JPEG, PNG, WebP, BMP or TIFF image")
+        content += chunk
+        if len(content) > max_bytes:
+            raise UploadTooLargeError(f"{file.filename} is larger than {max_bytes // (1024 * 1024)} MB")
+    if not content:
+        raise UnsupportedImageError(f"{file.filename} is empty")
+    return content
+
+
+def check_spooled_upload(file, max_bytes: int = int(MAX_IMAGE_UPLOAD_MB * 1024 * 1024)) -> None:
+    """
+    Same checks as read_upload on an upload already spooled by Starlette, from its first bytes and
+    the size of the spooled file, without reading it into memory.
+    """
+    spooled = file.file
+    header = spooled.read(16)
+    size = spooled.seek(0, os.SEEK_END)
+    spooled.seek(0)
+    if not header:
+        raise UnsupportedImageError(f"{file.filename} is empty")
+    if sniff_image_format(header) is None:
+        raise UnsupportedImageError(f"{file.filename} is not a JPEG, PNG, WebP, BMP or TIFF image")
+    if size > max_bytes:
+        raise UploadTooLargeError(f"{file.filename} is larger than {max_bytes // (1024 * 1024)} MB")
+
+
+def spooled_uploads(files: Iterable) -> Iterator[bytes]:
+    """Bytes of the spooled uploads, read one at a time as they are consumed."""
+    for file in files:
+        yield file.file.read()
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware rejecting request bodies larger than max_bytes with a 413, from their Content-Length
+    or while they are streamed in, so an oversized upload is never fully received or spooled.
+    """
+
+    def __init__(self, app, max_bytes: int = int(MAX_UPLOAD_MB * 1024 * 1024)):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self.reject(send)
+            return
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise UploadTooLargeError(f"Request body larger than {self.max_bytes} bytes")
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # Whatever the app answers to the truncated body is replaced by the 413
+            if exceeded and not response_started:
+                return
+            response_started = response_started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded or response_started:
+                raise
+        if exceeded and not response_started:
+            await self.reject(send)
+
+    async def reject(self, send):
+        body = b'{"detail":"Request body too large"}'
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,289 @@
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, Optional
+import cv2
+import numpy as np
+from ml.yolox_model import YoloX
+from ml.batch_scheduler import BATCH_MAX_SIZE
+from core.data_models import PredictionConfig
+from core.uploads import decode_image
+from util.logger import Logger
+from util.metrics import count_detections
+
+VIDEO_QUEUE_SIZE = int(os.environ.get("VIDEO_QUEUE_SIZE", 16))
+
+# Marks the end of the frames going through the stage queues
+_END = object()
+
+
+class StageStats:
+    def __init__(self):
+        self.frames = 0
+        self.busy_seconds = 0.0
+
+    def to_dict(self, elapsed: float) -> dict[str, Any]:
+        return {
+            "frames": self.frames,
+            "busySeconds": round(self.busy_seconds, 4),
+            "fps": round(self.frames / elapsed, 2) if elapsed else 0.0,
+            "maxFps": round(self.frames / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+        }
+
+
+def video_file_frames(path: str) -> Iterator[tuple[np.ndarray, Optional[float]]]:
+    """Decoded frames of a video file with their timestamp in milliseconds."""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video {path}")
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame, round(capture.get(cv2.CAP_PROP_POS_MSEC), 3)
+    finally:
+        capture.release()
+
+
+def encoded_frames(frames: Iterable[bytes], fps: Optional[float] = None) -> Iterator[tuple[np.ndarray, Optional[float]]]:
+    """
+    Decoded frames of a sequence of encoded images. They have no timestamp of their own, with fps
+    the frame rate they were captured at gives them one, so max_fps can skip some of them.
+    """
+    for frame_number, frame_bytes in enumerate(frames):
+        frame, _ = decode_image(frame_bytes)
+        yield frame, round(frame_number * 1000 / fps, 3) if fps else None
+
+
+class VideoStream:
+    """
+    Records of a VideoPipeline holding resources (model, stream slot, temporary file) that release
+    frees. It runs exactly once: when the records are exhausted or closed, or when close() is
+    called, which covers the responses that never start iterating, e.g. when the client disconnects
+    before the first chunk.
+    """
+
+    def __init__(self, pipeline: "VideoPipeline", release: Callable[[], None]):
+        self.records = iter(pipeline)
+        self._release = release
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        try:
+            yield from self.records
+        finally:
+            self.release()
+
+    def release(self) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._release()
+
+    def close(self) -> None:
+        try:
+            # Stops the stage threads if the records were left suspended
+            self.records.close()
+        except ValueError:
+            # Still running in another thread, which releases the stream when it stops
+            return
+        self.release()
+
+
+class VideoPipeline:
+    """
+    Runs the frames of a video through decode -> preprocess -> inference -> postprocess stages,
+    each one in its own thread and connected by bounded queues, so decoding the next frames
+    overlaps with the inference of the current ones. The inference stage submits every frame
+    waiting in its queue at once, so they are batched by the model scheduler when there is one.
+
+    Iterating the pipeline yields one record per processed frame, an error record if a stage
+    fails, and a final summary with the throughput of every stage.
+    """
+
+    STAGES = ("decode", "preprocess", "inference", "postprocess")
+
+    def __init__(self, model: YoloX, frames: Iterable[tuple[np.ndarray, Optional[float]]],
+                 config: Optional[PredictionConfig] = None, frame_stride: int = 1,
+                 max_fps: Optional[float] = None, queue_size: int = VIDEO_QUEUE_SIZE):
+        self.model = model
+        self.frames = frames
+        self.config = config or PredictionConfig()
+        self.frame_stride = max(1, frame_stride)
+        self.min_interval_ms = 1000 / max_fps if max_fps else 0.0
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in self.STAGES]
+        self.stats = {stage: StageStats() for stage in self.STAGES}
+        self.skipped = 0
+        self.stopped = threading.Event()
+        self.logger = Logger(self.__class__).get_logger()
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        start = time.monotonic()
+        threads = [
+            threading.Thread(target=self._guard, args=(stage,), name=f"video-{stage}", daemon=True)
+            for stage in self.STAGES
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self.queues[-1].get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    # The response is already streaming, the failure is reported in band
+                    yield {"error": str(item)}
+                    break
+                yield item
+        finally:
+            # Unblocks the stages when the client goes away before the end of the video
+            self.stopped.set()
+            for stage_queue in self.queues:
+                self._drain(stage_queue)
+            for thread in threads:
+                thread.join()
+        elapsed = time.monotonic() - start
+        yield {
+            "summary": {
+                "frames": self.stats["postprocess"].frames,
+                "skippedFrames": self.skipped,
+                "elapsedSeconds": round(elapsed, 4),
+                "fps": round(self.stats["postprocess"].frames / elapsed, 2) if elapsed else 0.0,
+                "stages": {stage: stats.to_dict(elapsed) for stage, stats in self.stats.items()},
+            }
+        }
+
+    @staticmethod
+    def _drain(stage_queue: queue.Queue) -> None:
+        try:
+            while True:
+                stage_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _put(self, stage_queue: queue.Queue, item: Any) -> bool:
+        while not self.stopped.is_set():
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, stage_queue: queue.Queue) -> Any:
+        while not self.stopped.is_set():
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _guard(self, stage: str) -> None:
+        index = self.STAGES.index(stage)
+        try:
+            getattr(self, f"_{stage}")(index)
+        except Exception as e:
+            self.logger.error(f"Video pipeline failed in the {stage} stage: {e}")
+            self._put(self.queues[-1], e)
+            self.stopped.set()
+
+    def _decode(self, index: int) -> None:
+        output = self.queues[index]
+        stats = self.stats["decode"]
+        last_timestamp = None
+        frames = iter(self.frames)
+        frame_number = 0
+        while not self.stopped.is_set():
+            start = time.monotonic()
+            frame_info = next(frames, None)
+            if frame_info is None:
+                break
+            frame, timestamp = frame_info
+            stats.busy_seconds += time.monotonic() - start
+            skip = frame_number % self.frame_stride != 0 or (
+                timestamp is not None and last_timestamp is not None
+                and timestamp - last_timestamp < self.min_interval_ms
+            )
+            frame_number += 1
+            if skip:
+                self.skipped += 1
+                continue
+            last_timestamp = timestamp
+            stats.frames += 1
+            if not self._put(output, (frame_number - 1, timestamp, frame)):
+                return
+        self._put(output, _END)
+
+    def _preprocess(self, index: int) -> None:
+        source, output = self.queues[index - 1], self.queues[index]
+        stats = self.stats["preprocess"]
+        while True:
+            item = self._get(source)
+            if item is _END:
+                break
+            frame_number, timestamp, frame = item
+            start = time.monotonic()
+            img, ratio = self.model.preprocess(frame)
+            # The preprocessor reuses its buffer on the next frame, the queued tensor needs its own copy
+            img = img.copy()
+            stats.busy_seconds += time.monotonic() - start
+            stats.frames += 1
+            if not self._put(output, (frame_number, timestamp, img, ratio)):
+                return
+        self._put(output, _END)
+
+    def _inference(self, index: int) -> None:
+        source, output = self.queues[index - 1], self.queues[index]
+        stats = self.stats["inference"]
+        nms_inputs = self.model.nms_inputs(self.config.nms_thr, self.config.score_thr)
+        finished = False
+        while not finished:
+            item = self._get(source)
+            if item is _END:
+                break
+            batch = [item]
+            # Take whatever else is already waiting, up to a full batch
+            while len(batch) < BATCH_MAX_SIZE:
+                try:
+                    item = source.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _END:
+                    finished = True
+                    break
+                batch.append(item)
+            start = time.monotonic()
+            if self.model.scheduler is not None:
+                futures = [self.model.scheduler.submit(img) for _, _, img, _ in batch]
+                results = [future.result() for future in futures]
+            else:
+                results = [self.model.inference(img, nms_inputs) for _, _, img, _ in batch]
+            stats.busy_seconds += time.monotonic() - start
+            stats.frames += len(batch)
+            for (frame_number, timestamp, _, ratio), outputs in zip(batch, results):
+                if not self._put(output, (frame_number, timestamp, outputs, ratio)):
+                    return
+        self._put(output, _END)
+
+    def _postprocess(self, index: int) -> None:
+        source, output = self.queues[index - 1], self.queues[index]
+        stats = self.stats["postprocess"]
+        config = self.config
+        while True:
+            item = self._get(source)
+            if item is _END:
+                break
+            frame_number, timestamp, outputs, ratio = item
+            start = time.monotonic()
+            detections = self.model.detections(outputs, ratio, **config.thresholds())
+            stats.busy_seconds += time.monotonic() - start
+            stats.frames += 1
+            count_detections(detections.class_counts())
+            record = {"frame": frame_number, "timestamp": timestamp, "detections": detections.to_crops()}
+            if not self._put(output, record):
+                return
+        self._put(output, _END)
@@ -0,0 +1,93 @@
+import os
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+from util.logger import Logger
+
+WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", 8))
+WORKER_QUEUE_DEPTH = int(os.environ.get("WORKER_QUEUE_DEPTH", 32))
+
+
+class PoolSaturatedError(Exception):
+    """Raised when the worker pool already has as many jobs running and queued as it accepts."""
+
+
+class WorkerPool:
+    """
+    Thread pool running the CPU-bound work (decode, inference, encode) off the event loop.
+    OpenCV and onnxruntime release the GIL, so threads scale on CPU while sharing the sessions and
+    the batch scheduler of the process. Jobs beyond workers + queue depth are rejected right away.
+    """
+
+    def __init__(self, max_workers: int = WORKER_POOL_SIZE, queue_depth: int = WORKER_QUEUE_DEPTH):
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference-worker")
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self.logger = Logger(self.__class__).get_logger()
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        with self.lock:
+            if self.in_flight >= self.max_workers + self.queue_depth:
+                self.rejected += 1
+                self.logger.warning(f"Rejecting job, {self.in_flight} jobs already running or queued")
+                raise PoolSaturatedError(f"Worker pool saturated with {self.in_flight} jobs")
+            self.in_flight += 1
+        try:
+            future = self.executor.submit(self._call, func, args)
+        except Exception:
+            self._release()
+            raise
+        # Released when the job is done in the pool, or cancelled before it started, not when the
+        # awaiting request is cancelled while its job keeps running
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future: Any = None) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def _call(self, func: Callable, args: tuple) -> Any:
+        with self.lock:
+            self.active += 1
+        start = time.monotonic()
+        failed = False
+        try:
+            return func(*args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.busy_seconds += time.monotonic() - start
+                self.completed += 1
+                if failed:
+                    self.failed += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            uptime = time.monotonic() - self.started_at
+            return {
+                "workers": self.max_workers,
+                "queueDepth": self.queue_depth,
+                "active": self.active,
+                "queued": self.in_flight - self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "utilization": self.active / self.max_workers,
+                "averageUtilization": self.busy_seconds / (uptime * self.max_workers) if uptime else 0.0,
+            }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
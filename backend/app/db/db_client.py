@@ -1,28 +1,110 @@
 import os
+import asyncio
 import logging
 import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
 
 logger = logging.getLogger(__name__)
 DATABASE = os.environ.get("MONGO_DB_DATABASE", "ai-e2e-boilerplate")
 HOST = os.environ.get("HOST", "mongo")
 PORT = os.environ.get("PORT", 27017)
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 60000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 30000))
+# Entries of the result_cache collection are removed by MongoDB this long after they were cached
+RESULT_CACHE_TTL_HOURS = float(os.environ.get("RESULT_CACHE_TTL_HOURS", 24 * 7))
+# Delay between the attempts to create the indexes while MongoDB is unreachable, doubled up to 60 s
+MONGO_INDEX_RETRY_SECONDS = float(os.environ.get("MONGO_INDEX_RETRY_SECONDS", 5))
+INDEX_OPTIONS_CONFLICT = 85
+
+# (collection, keys, options) created in the background from startup, create_index is a no-op when the index exists
+INDEXES = [
+    ("images", [("id", pymongo.ASCENDING)], {"unique": True}),
+    # Keyset pagination of /list-images, newest first, optionally for a single file name
+    ("images", [("createdOn", pymongo.DESCENDING), ("id", pymongo.DESCENDING)], {}),
+    ("images", [("originalFileName", pymongo.ASCENDING), ("createdOn", pymongo.DESCENDING),
+                ("id", pymongo.DESCENDING)], {}),
+    ("result_cache", [("key", pymongo.ASCENDING)], {"unique": True}),
+    # TTL index, createdOn is a BSON date in this collection
+    ("result_cache", [("createdOn", pymongo.ASCENDING)], {"expireAfterSeconds": int(RESULT_CACHE_TTL_HOURS * 3600)}),
+    # Date range reads of the hourly and daily rollups of the stats collection
+    ("stats", [("granularity", pymongo.ASCENDING), ("bucket", pymongo.ASCENDING)], {}),
+]
+
 
 class MongoConnector:
+    """
+    Motor client for the async request handlers. The background threads (write-behind writer, batch
+    jobs) use sync_db, the pymongo database wrapped by Motor, so both share the same connection pool.
+    Nothing connects at import time, connect() is awaited at startup. The client connects lazily on
+    the first operation, so the API starts even when MongoDB is unreachable, and the indexes are
+    created by a background task retrying until it succeeds.
+    """
+
     def __init__(self) -> None:
         self.client = None
         self.db = None
+        self.sync_db = None
+        self.indexes_ready = False
+        self.index_task = None
 
-    def connect(self) -> None:
+    async def connect(self) -> None:
         if self.db is None:
             logger.info("Initializing connection to the database...")
-            self.client = pymongo.MongoClient(f"mongodb://{HOST}:{PORT}")
-            self.db = self.client[DATABASE]
+            client = AsyncIOMotorClient(
+                f"mongodb://{HOST}:{PORT}",
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            )
+            # Only set once the client exists, so a failed connect is retried by the next one
+            self.client = client
+            self.db = client[DATABASE]
+            self.sync_db = self.db.delegate
+            logger.info("Database client ready!")
+        if not self.indexes_ready and (self.index_task is None or self.index_task.done()):
+            self.index_task = asyncio.create_task(self.ensure_indexes())
+
+    async def create_indexes(self) -> None:
+        for collection, keys, options in INDEXES:
+            try:
+                await self.db[collection].create_index(keys, **options)
+            except pymongo.errors.OperationFailure as e:
+                if e.code != INDEX_OPTIONS_CONFLICT or "expireAfterSeconds" not in options:
+                    raise
+                # The TTL was changed, collMod updates the existing index in place
+                await self.db.command("collMod", collection, index={
+                    "keyPattern": dict(keys), "expireAfterSeconds": options["expireAfterSeconds"],
+                })
+
+    async def ensure_indexes(self) -> None:
+        """Create the indexes, retrying with a growing delay until MongoDB answers."""
+        delay = MONGO_INDEX_RETRY_SECONDS
+        while not self.indexes_ready:
+            try:
+                await self.create_indexes()
+                self.indexes_ready = True
+                logger.info("Database indexes ready!")
+            except pymongo.errors.PyMongoError as e:
+                logger.warning(f"Could not create the database indexes, retrying in {delay:g} s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
 
     def disconnect(self) -> None:
-        if self.connection is not None:
-            self.connection.close()
+        if self.index_task is not None:
+            self.index_task.cancel()
+            self.index_task = None
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+            self.db = None
+            self.sync_db = None
+
 
 db_client = MongoConnector()
-db_client.connect()
-db = db_client.db
-logger.info(f"Initializing connection to the database...")
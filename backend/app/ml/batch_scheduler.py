@@ -0,0 +1,94 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+import onnxruntime as ort
+from util.logger import Logger
+
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 8))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 5))
+
+
+class BatchScheduler:
+    """
+    Groups the tensors submitted by concurrent requests into a single batched session.run call.
+    A batch is dispatched as soon as it has max_batch_size images or the first queued image has
+    waited max_wait_ms, and every request gets back the slice of the outputs belonging to its image.
+    """
+
+    def __init__(self, session: ort.InferenceSession, max_batch_size: int = BATCH_MAX_SIZE,
+                 max_wait_ms: float = BATCH_MAX_WAIT_MS):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = None
+        self.batches_run = 0
+        self.images_run = 0
+        self.logger = Logger(self.__class__).get_logger()
+
+    @staticmethod
+    def supports_batching(session: ort.InferenceSession) -> bool:
+        """Models exported with a dynamic batch axis have a symbolic (non int) first dimension."""
+        batch_dim = session.get_inputs()[0].shape[0]
+        return not isinstance(batch_dim, int)
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, img: np.ndarray) -> Future:
+        """Queue a single CHW tensor, the future resolves to the list of outputs for that image."""
+        future = Future()
+        self.queue.put((img, future))
+        return future
+
+    def _collect_batch(self) -> list:
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop signal back so the loop exits after running this last batch
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            futures = [future for _, future in batch]
+            try:
+                inputs = np.stack([img for img, _ in batch])
+                outputs = self.session.run(None, {self.input_name: inputs})
+            except Exception as e:
+                self.logger.error(f"Batched inference failed for {len(batch)} images: {e}")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches_run += 1
+            self.images_run += len(batch)
+            for i, future in enumerate(futures):
+                future.set_result([output[i] for output in outputs])
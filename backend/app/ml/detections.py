@@ -0,0 +1,105 @@
+import numpy as np
+
+BOX_KEYS = ("x_min", "y_min", "x_max", "y_max")
+# Little endian dtypes of the arrays packed in the documents
+CLASS_ID_DTYPE = np.dtype("u1")
+BOX_DTYPE = np.dtype("<i2")
+CONFIDENCE_DTYPE = np.dtype("<f4")
+BOX_LIMITS = np.iinfo(BOX_DTYPE)
+
+
+class Detections:
+    """
+    Detections of an image as arrays: class ids indexing labels, one (x_min, y_min, x_max, y_max)
+    row per box and the confidences in percent, rounded to one decimal. They are converted to the
+    crops dicts, the compact document or the columnar JSON only when one of them is asked for.
+    """
+
+    def __init__(self, labels, class_ids, boxes, confidences):
+        self.labels = list(labels)
+        self.class_ids = class_ids
+        self.boxes = boxes
+        self.confidences = confidences
+        self._crops = None
+
+    def __len__(self) -> int:
+        return len(self.class_ids)
+
+    @classmethod
+    def empty(cls) -> "Detections":
+        return cls([], np.zeros(0, np.intp), np.zeros((0, 4), np.int64), np.zeros(0, np.float64))
+
+    @classmethod
+    def from_arrays(cls, boxes, scores, cls_ids, conf=0.5, class_names=()) -> "Detections":
+        """Detections above conf from the NMS output, without a Python loop over the boxes."""
+        keep = scores >= conf
+        used, class_ids = np.unique(cls_ids[keep].astype(np.intp), return_inverse=True)
+        return cls(
+            [class_names[class_id] for class_id in used],
+            class_ids.reshape(-1),
+            boxes[keep].astype(np.int64),
+            np.round(scores[keep].astype(np.float64) * 100, 1),
+        )
+
+    @classmethod
+    def from_crops(cls, crops: list) -> "Detections":
+        if not crops:
+            return cls.empty()
+        labels, class_ids = np.unique([crop["class"] for crop in crops], return_inverse=True)
+        boxes = np.array([[crop["bbox"][key] for key in BOX_KEYS] for crop in crops], dtype=np.int64)
+        confidences = np.array([crop["confidence"] for crop in crops], dtype=np.float64)
+        return cls(labels.tolist(), class_ids.reshape(-1), boxes, confidences)
+
+    @classmethod
+    def from_document(cls, document: dict) -> "Detections":
+        """Inverse of to_document, the arrays are read from the stored bytes without copying them."""
+        boxes = np.frombuffer(document["boxes"], dtype=BOX_DTYPE).reshape(-1, 4)
+        confidences = np.round(np.frombuffer(document["confidences"], dtype=CONFIDENCE_DTYPE).astype(np.float64), 1)
+        return cls(document["labels"], np.frombuffer(document["classIds"], dtype=CLASS_ID_DTYPE), boxes, confidences)
+
+    @classmethod
+    def from_image_document(cls, document: dict) -> "Detections":
+        """Detections of a document of the images collection, stored in either format."""
+        if document.get("detections") is not None:
+            return cls.from_document(document["detections"])
+        return cls.from_crops(document.get("crops") or [])
+
+    def scaled(self, factor) -> "Detections":
+        """Same detections with the boxes multiplied by factor, e.g. back to the resolution of the uploaded image."""
+        return Detections(self.labels, self.class_ids, self.boxes * factor, self.confidences)
+
+    def to_crops(self) -> list:
+        """One {"bbox", "class", "confidence"} dict per detection, built once."""
+        if self._crops is None:
+            labels = self.labels
+            self._crops = [
+                {"bbox": dict(zip(BOX_KEYS, box)), "class": labels[class_id], "confidence": confidence}
+                for box, class_id, confidence in zip(self.boxes.tolist(), self.class_ids.tolist(), self.confidences.tolist())
+            ]
+        return self._crops
+
+    def to_document(self) -> dict:
+        """
+        Compact document stored instead of the crops: the labels once, and the class ids, boxes and
+        confidences packed as uint8, int16 and float32 arrays, saved as BSON binary.
+        """
+        return {
+            "count": len(self),
+            "labels": self.labels,
+            "classIds": self.class_ids.astype(CLASS_ID_DTYPE).tobytes(),
+            "boxes": np.clip(self.boxes, BOX_LIMITS.min, BOX_LIMITS.max).astype(BOX_DTYPE).tobytes(),
+            "confidences": self.confidences.astype(CONFIDENCE_DTYPE).tobytes(),
+        }
+
+    def to_columnar(self) -> dict:
+        """Columnar JSON shape of the API responses, one list per attribute."""
+        return {
+            "labels": self.labels,
+            "classIds": self.class_ids.tolist(),
+            "boxes": self.boxes.tolist(),
+            "confidences": self.confidences.tolist(),
+        }
+
+    def class_counts(self) -> dict:
+        counts = np.bincount(self.class_ids, minlength=len(self.labels)).tolist()
+        return {label: count for label, count in zip(self.labels, counts) if count}
@@ -0,0 +1,255 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Optional
+from util.logger import Logger
+from ml.abstract_class_definition import onnx_model
+from ml.batch_scheduler import BatchScheduler
+from ml.model_registry import model_registry
+from ml.yolox_model import YoloX, MODEL_PATH
+
+MODEL_CATALOG_DIR = os.environ.get("MODEL_CATALOG_DIR", os.path.dirname(MODEL_PATH))
+MODEL_CATALOG_FILE = "models.json"
+MODEL_CACHE_MAX_MB = float(os.environ.get("MODEL_CACHE_MAX_MB", 1024))
+MODEL_LATENCY_RUNS = int(os.environ.get("MODEL_LATENCY_RUNS", 5))
+# Load every model with no latencyMs once at startup to measure it, so the latency budgets can pick any of them
+MODEL_PROFILE_AT_STARTUP = os.environ.get("MODEL_PROFILE_AT_STARTUP", "true").lower() == "true"
+# Implementations of the onnx_model interface, by the architecture name used in the catalog
+ARCHITECTURES = {"yolox": YoloX}
+
+
+class UnknownModelError(Exception):
+    pass
+
+
+class CatalogEntry:
+    def __init__(self, name: str, path: str, architecture: str = "yolox", input_size: Optional[list] = None,
+                 latency_ms: Optional[float] = None, accuracy: Optional[float] = None, quantized: bool = False,
+                 description: str = ""):
+        if architecture not in ARCHITECTURES:
+            raise ValueError(f"Unknown architecture {architecture} of model {name}, expected one of {list(ARCHITECTURES)}")
+        self.name = name
+        self.path = path
+        self.architecture = architecture
+        self.input_size = input_size
+        self.latency_ms = latency_ms
+        self.measured_latency_ms = None
+        self.accuracy = accuracy
+        self.quantized = quantized
+        self.description = description
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        # Serializes the loading of this model without blocking the other ones
+        self.lock = threading.Lock()
+
+    @property
+    def latency(self) -> Optional[float]:
+        """Measured when the model was loaded, the latency given in the catalog until then."""
+        return self.measured_latency_ms if self.measured_latency_ms is not None else self.latency_ms
+
+
+class ModelCatalog:
+    """
+    The models one backend process can serve, e.g. nano / tiny / s / m and their quantized versions.
+
+    They are listed in the models.json of the catalog directory, from the fastest to the most accurate:
+    [{"name": "yolox_nano", "file": "yolox_nano.onnx", "inputSize": [416, 416], "latencyMs": 8}, ...]
+    When every model has an "accuracy" (e.g. its COCO mAP), they are ranked by it instead of by their
+    order in the file. Without models.json, every .onnx file of the directory is a model named after
+    the file, ranked by file size: the smaller models of an architecture are the faster and less
+    accurate ones. The entries are kept in that ranking, from the least to the most accurate.
+
+    Models are loaded when first used and kept in LRU order. When the total size of the loaded model
+    files goes over max_bytes, the least recently used ones that no request is using are unloaded.
+    """
+
+    def __init__(self, directory: str = MODEL_CATALOG_DIR, max_bytes: int = int(MODEL_CACHE_MAX_MB * 1024 * 1024),
+                 default_path: str = MODEL_PATH):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = self.read_entries(directory)
+        if not self.entries:
+            raise ValueError(f"No model found in {directory}")
+        self.default = next(
+            (entry.name for entry in self.entries.values() if os.path.abspath(entry.path) == os.path.abspath(default_path)),
+            next(iter(self.entries)),
+        )
+        self.loaded: "OrderedDict[str, onnx_model]" = OrderedDict()
+        self.in_use: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+        self.logger = Logger(self.__class__).get_logger()
+
+    @staticmethod
+    def read_entries(directory: str) -> "OrderedDict[str, CatalogEntry]":
+        entries = OrderedDict()
+        catalog_file = os.path.join(directory, MODEL_CATALOG_FILE)
+        if os.path.exists(catalog_file):
+            with open(catalog_file) as f:
+                for model in json.load(f):
+                    entries[model["name"]] = CatalogEntry(
+                        name=model["name"],
+                        path=os.path.join(directory, model["file"]),
+                        architecture=model.get("architecture", "yolox"),
+                        input_size=model.get("inputSize"),
+                        latency_ms=model.get("latencyMs"),
+                        accuracy=model.get("accuracy"),
+                        quantized=model.get("quantized", False),
+                        description=model.get("description", ""),
+                    )
+        elif os.path.isdir(directory):
+            for file_name in sorted(os.listdir(directory)):
+                if file_name.endswith(".onnx"):
+                    name = os.path.splitext(file_name)[0]
+                    entries[name] = CatalogEntry(name, os.path.join(directory, file_name))
+            entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1].size))
+        if entries and all(entry.accuracy is not None for entry in entries.values()):
+            entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1].accuracy))
+        return entries
+
+    def entry(self, name: str) -> CatalogEntry:
+        entry = self.entries.get(name)
+        if entry is None:
+            raise UnknownModelError(f"Unknown model {name}, available models: {list(self.entries)}")
+        return entry
+
+    def select(self, name: Optional[str] = None, latency_budget_ms: Optional[float] = None) -> str:
+        """
+        The requested model, or with a latency budget the most accurate model whose latency fits in it
+        (the fastest one when none does), by the ranking of the entries. Models with no known latency,
+        neither in models.json nor measured yet, are only picked by name, see profile.
+        """
+        if name is not None:
+            return self.entry(name).name
+        if latency_budget_ms is None:
+            return self.default
+        timed = [entry for entry in self.entries.values() if entry.latency is not None]
+        if not timed:
+            return self.default
+        fitting = [entry for entry in timed if entry.latency <= latency_budget_ms]
+        if fitting:
+            return fitting[-1].name
+        return min(timed, key=lambda entry: entry.latency).name
+
+    def profile(self) -> None:
+        """
+        Load the models with no known latency one after the other to measure it, the cache evicts them
+        as usual. The default model is used last, so it stays loaded.
+        """
+        for entry in self.entries.values():
+            if entry.latency is None and entry.name != self.default:
+                try:
+                    with self.use(entry.name):
+                        pass
+                except Exception as e:
+                    self.logger.error(f"Could not measure the latency of model {entry.name}: {e}")
+        with self.use(self.default):
+            pass
+
+    @contextmanager
+    def use(self, name: str):
+        """The loaded model, which can't be evicted until the block exits."""
+        model = self.acquire(name)
+        try:
+            yield model
+        finally:
+            self.release(name)
+
+    def acquire(self, name: str) -> onnx_model:
+        entry = self.entry(name)
+        with self.lock:
+            model = self.loaded.get(name)
+            if model is not None:
+                self.loaded.move_to_end(name)
+                self.in_use[name] = self.in_use.get(name, 0) + 1
+                return model
+        with entry.lock:
+            with self.lock:
+                model = self.loaded.get(name)
+            if model is None:
+                model = self.load(entry)
+            with self.lock:
+                self.loaded[name] = model
+                self.loaded.move_to_end(name)
+                self.in_use[name] = self.in_use.get(name, 0) + 1
+        self.evict()
+        return model
+
+    def release(self, name: str) -> None:
+        with self.lock:
+            self.in_use[name] -= 1
+        self.evict()
+
+    def load(self, entry: CatalogEntry) -> onnx_model:
+        self.logger.info(f"Loading model {entry.name} from {entry.path}")
+        model = ARCHITECTURES[entry.architecture](entry.path, input_size=entry.input_size)
+        model.warm_up()
+        entry.measured_latency_ms = model.measure_latency(MODEL_LATENCY_RUNS)
+        if BatchScheduler.supports_batching(model.session):
+            model.scheduler = BatchScheduler(model.session)
+            model.scheduler.start()
+        self.loads += 1
+        return model
+
+    def evict(self) -> None:
+        """Unload the least recently used idle models until the loaded ones fit in max_bytes."""
+        evicted = []
+        with self.lock:
+            size = sum(self.entries[name].size for name in self.loaded)
+            for name in list(self.loaded):
+                if size <= self.max_bytes:
+                    break
+                # The last loaded model stays, even when it is larger than max_bytes
+                if self.in_use.get(name, 0) or len(self.loaded) == 1:
+                    continue
+                evicted.append(self.loaded.pop(name))
+                size -= self.entries[name].size
+                self.evictions += 1
+        for model in evicted:
+            self.unload(model)
+
+    def unload(self, model: onnx_model) -> None:
+        self.logger.info(f"Unloading model {model.model_path}")
+        if model.scheduler is not None:
+            model.scheduler.stop()
+        if model.tile_executor is not None:
+            model.tile_executor.shutdown()
+        model_registry.unload(model.model_path)
+
+    def shutdown(self) -> None:
+        with self.lock:
+            models = list(self.loaded.values())
+            self.loaded.clear()
+        for model in models:
+            self.unload(model)
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            loaded = list(self.loaded)
+            in_use = dict(self.in_use)
+        return {
+            "default": self.default,
+            "loadedBytes": sum(self.entries[name].size for name in loaded),
+            "maxBytes": self.max_bytes,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "models": [
+                {
+                    "name": entry.name,
+                    "file": os.path.basename(entry.path),
+                    "architecture": entry.architecture,
+                    "inputSize": entry.input_size,
+                    "quantized": entry.quantized,
+                    "description": entry.description,
+                    "sizeBytes": entry.size,
+                    "latencyMs": entry.latency_ms,
+                    "accuracy": entry.accuracy,
+                    "measuredLatencyMs": entry.measured_latency_ms,
+                    "loaded": entry.name in loaded,
+                    "inUse": in_use.get(entry.name, 0),
+                }
+                for entry in self.entries.values()
+            ],
+        }
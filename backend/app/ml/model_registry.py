@@ -0,0 +1,56 @@
+import os
+import threading
+import onnxruntime as ort
+from util.logger import Logger
+
+INTRA_OP_NUM_THREADS = int(os.environ.get("ORT_INTRA_OP_NUM_THREADS", 0))
+INTER_OP_NUM_THREADS = int(os.environ.get("ORT_INTER_OP_NUM_THREADS", 0))
+GRAPH_OPTIMIZATION_LEVEL = os.environ.get("ORT_GRAPH_OPTIMIZATION_LEVEL", "all")
+ENABLE_MEM_ARENA = os.environ.get("ORT_ENABLE_MEM_ARENA", "true").lower() == "true"
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of ONNX inference sessions, so every model file is loaded only once
+    and shared between all the handlers. InferenceSession.run is thread-safe.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.logger = Logger(self.__class__).get_logger()
+
+    def build_session_options(self) -> ort.SessionOptions:
+        options = ort.SessionOptions()
+        # 0 lets onnxruntime pick the number of threads from the available cores
+        options.intra_op_num_threads = INTRA_OP_NUM_THREADS
+        options.inter_op_num_threads = INTER_OP_NUM_THREADS
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[GRAPH_OPTIMIZATION_LEVEL]
+        options.enable_cpu_mem_arena = ENABLE_MEM_ARENA
+        return options
+
+    def get_session(self, model_path: str) -> ort.InferenceSession:
+        session = self.sessions.get(model_path)
+        if session is not None:
+            return session
+        with self.lock:
+            if model_path not in self.sessions:
+                self.logger.info(f"Loading ONNX session for model: {model_path}")
+                self.sessions[model_path] = ort.InferenceSession(
+                    model_path, sess_options=self.build_session_options()
+                )
+            return self.sessions[model_path]
+
+    def unload(self, model_path: str) -> None:
+        with self.lock:
+            self.sessions.pop(model_path, None)
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,221 @@
+import os
+import numpy as np
+
+NMS_BACKEND = os.environ.get("NMS_BACKEND", "auto")
+NMS_MATRIX_MAX_CANDIDATES = int(os.environ.get("NMS_MATRIX_MAX_CANDIDATES", 200))
+NMS_OFFSET_MAX_CANDIDATES = int(os.environ.get("NMS_OFFSET_MAX_CANDIDATES", 1000))
+
+# Names of the outputs added to the graph by tools.embed_nms
+EMBEDDED_NMS_OUTPUTS = ("boxes", "scores", "selected_indices")
+
+
+def nms(boxes, scores, nms_thr):
+    """Single class NMS implemented in Numpy."""
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+
+        inds = np.where(ovr <= nms_thr)[0]
+        order = order[inds + 1]
+
+    return keep
+
+
+def multiclass_nms_class_aware(boxes, scores, nms_thr, score_thr):
+    """Multiclass NMS implemented in Numpy. Class-aware version."""
+    final_dets = []
+    num_classes = scores.shape[1]
+    for cls_ind in range(num_classes):
+        cls_scores = scores[:, cls_ind]
+        valid_score_mask = cls_scores > score_thr
+        if valid_score_mask.sum() == 0:
+            continue
+        else:
+            valid_scores = cls_scores[valid_score_mask]
+            valid_boxes = boxes[valid_score_mask]
+            keep = nms(valid_boxes, valid_scores, nms_thr)
+            if len(keep) > 0:
+                cls_inds = np.ones((len(keep), 1)) * cls_ind
+                dets = np.concatenate(
+                    [valid_boxes[keep], valid_scores[keep, None], cls_inds], 1
+                )
+                final_dets.append(dets)
+    if len(final_dets) == 0:
+        return None
+    return np.concatenate(final_dets, 0)
+
+
+def multiclass_nms_class_agnostic(boxes, scores, nms_thr, score_thr):
+    """Multiclass NMS implemented in Numpy. Class-agnostic version."""
+    cls_inds = scores.argmax(1)
+    cls_scores = scores[np.arange(len(cls_inds)), cls_inds]
+
+    valid_score_mask = cls_scores > score_thr
+    if valid_score_mask.sum() == 0:
+        return None
+    valid_scores = cls_scores[valid_score_mask]
+    valid_boxes = boxes[valid_score_mask]
+    valid_cls_inds = cls_inds[valid_score_mask]
+    keep = nms(valid_boxes, valid_scores, nms_thr)
+    if not keep:
+        return None
+    dets = np.concatenate(
+        [valid_boxes[keep], valid_scores[keep, None], valid_cls_inds[keep, None]], 1
+    )
+    return dets
+
+
+class NMSEngine:
+    """
+    Multiclass NMS with pluggable backends, selected with NMS_BACKEND:
+    - offset: shifts the boxes of every class by a class dependent offset so boxes of different
+      classes never overlap, and all the classes are suppressed in a single greedy pass.
+    - matrix: the IoU of every pair of candidates is computed at once and masked to pairs of the
+      same class, the greedy pass then only reads precomputed rows. Fastest for small candidate sets.
+    - auto: matrix up to NMS_MATRIX_MAX_CANDIDATES candidates, offset up to NMS_OFFSET_MAX_CANDIDATES
+      and above that one greedy pass per class present among the candidates, since the single pass
+      gets slower than the per class ones once there are thousands of candidates.
+    - legacy: the original loop over the 80 classes.
+    - onnx: the NMS runs inside the model graph, see tools.embed_nms and from_embedded_outputs. The
+      nms_thr and score_thr of the request are fed to the graph, but its NonMaxSuppression node is
+      always per class, class_agnostic can't be applied and is rejected by the API.
+    All of them keep the same boxes as the legacy implementation.
+    """
+
+    BACKENDS = ("auto", "offset", "matrix", "legacy", "onnx")
+
+    def __init__(self, backend: str = NMS_BACKEND, matrix_max_candidates: int = NMS_MATRIX_MAX_CANDIDATES,
+                 offset_max_candidates: int = NMS_OFFSET_MAX_CANDIDATES):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown NMS backend {backend}, expected one of {self.BACKENDS}")
+        self.backend = backend
+        self.matrix_max_candidates = matrix_max_candidates
+        self.offset_max_candidates = offset_max_candidates
+
+    def __call__(self, boxes, scores, nms_thr, score_thr, class_agnostic=True):
+        """Returns the (N, 6) x0, y0, x1, y1, score, class detections or None when nothing is kept."""
+        if self.backend == "legacy":
+            if class_agnostic:
+                return multiclass_nms_class_agnostic(boxes, scores, nms_thr, score_thr)
+            return multiclass_nms_class_aware(boxes, scores, nms_thr, score_thr)
+
+        if class_agnostic:
+            cls_inds = scores.argmax(1)
+            cls_scores = scores[np.arange(len(cls_inds)), cls_inds]
+            box_inds = np.nonzero(cls_scores > score_thr)[0]
+            cls_inds = cls_inds[box_inds]
+            cls_scores = cls_scores[box_inds]
+        else:
+            box_inds, cls_inds = np.nonzero(scores > score_thr)
+            cls_scores = scores[box_inds, cls_inds]
+        if len(box_inds) == 0:
+            return None
+
+        candidate_boxes = boxes[box_inds]
+        keep = self.suppress(candidate_boxes, cls_scores, None if class_agnostic else cls_inds, nms_thr)
+        if len(keep) == 0:
+            return None
+        if not class_agnostic:
+            # Same order as the per class loop: by class, then by decreasing score
+            keep = np.asarray(keep)
+            keep = keep[np.lexsort((-cls_scores[keep], cls_inds[keep]))]
+        return np.concatenate(
+            [candidate_boxes[keep], cls_scores[keep, None], cls_inds[keep, None]], 1
+        )
+
+    def suppress(self, boxes, scores, cls_inds, nms_thr):
+        """Indices kept by a greedy NMS over all the candidates, boxes only compete within their class."""
+        backend = self.backend
+        if backend == "auto":
+            if len(boxes) <= self.matrix_max_candidates:
+                backend = "matrix"
+            elif cls_inds is not None and len(boxes) > self.offset_max_candidates:
+                return self.per_class_suppress(boxes, scores, cls_inds, nms_thr)
+            else:
+                backend = "offset"
+        if backend == "matrix":
+            return self.matrix_suppress(boxes, scores, cls_inds, nms_thr)
+        if cls_inds is not None:
+            # float64 keeps the coordinate differences exact once the offsets are added
+            boxes = boxes.astype(np.float64)
+            offset = boxes.max() - boxes.min() + 2
+            boxes += (cls_inds * offset)[:, None]
+        return nms(boxes, scores, nms_thr)
+
+    @staticmethod
+    def per_class_suppress(boxes, scores, cls_inds, nms_thr):
+        # Stable sort keeps the anchor order inside every class, as in the per class loop
+        order = np.argsort(cls_inds, kind="stable")
+        _, starts = np.unique(cls_inds[order], return_index=True)
+        keep = []
+        for group in np.split(order, starts[1:]):
+            keep.extend(group[nms(boxes[group], scores[group], nms_thr)])
+        return keep
+
+    @staticmethod
+    def matrix_suppress(boxes, scores, cls_inds, nms_thr):
+        order = scores.argsort()[::-1]
+        boxes = boxes[order]
+        x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+        # Pairwise IoU with the same arithmetic as the greedy nms, computed in place
+        inter = np.minimum.outer(x2, x2)
+        inter -= np.maximum.outer(x1, x1)
+        inter += 1
+        np.maximum(inter, 0.0, out=inter)
+        h = np.minimum.outer(y2, y2)
+        h -= np.maximum.outer(y1, y1)
+        h += 1
+        np.maximum(h, 0.0, out=h)
+        inter *= h
+        union = np.add.outer(areas, areas)
+        union -= inter
+        np.divide(inter, union, out=inter)
+        # Same comparison as the greedy nms, so NaN overlaps also suppress
+        suppress_matrix = ~(inter <= nms_thr)
+        if cls_inds is not None:
+            cls_inds = cls_inds[order]
+            suppress_matrix &= cls_inds[:, None] == cls_inds[None, :]
+
+        # Greedy pass over the precomputed rows, one iteration per kept box
+        keep = []
+        remaining = np.arange(len(order))
+        while remaining.size > 0:
+            i = remaining[0]
+            keep.append(order[i])
+            remaining = remaining[1:][~suppress_matrix[i, remaining[1:]]]
+        return keep
+
+    @staticmethod
+    def from_embedded_outputs(boxes, scores, selected_indices, ratio):
+        """
+        Build the detections from a model with an embedded NonMaxSuppression node, which returns the
+        decoded (num_anchors, 4) boxes, the (num_classes, num_anchors) scores and the selected
+        (num_kept, 3) batch, class and box indices for one image.
+        """
+        if len(selected_indices) == 0:
+            return None
+        cls_inds = selected_indices[:, 1]
+        box_inds = selected_indices[:, 2]
+        return np.concatenate(
+            [boxes[box_inds] / ratio, scores[cls_inds, box_inds, None], cls_inds[:, None]], 1
+        )
@@ -0,0 +1,66 @@
+import os
+from typing import Optional
+import cv2
+import numpy as np
+from ml.yolox_utils import COCO_CLASSES, _COLORS
+
+# Longer side of the annotated images in pixels, 0 keeps the original resolution
+ANNOTATION_PREVIEW_SIZE = int(os.environ.get("ANNOTATION_PREVIEW_SIZE", 0))
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.5
+FONT_THICKNESS = 2
+BOX_THICKNESS = 4
+TEXT_COLOR = (0, 0, 0)
+
+
+class AnnotationRenderer:
+    """
+    Draws the Detections on an image. Everything that doesn't depend on the image is computed once:
+    the uint8 BGR palette indexed by class id, the class id of every class name, the label height
+    and the width of every label drawn so far. Boxes are drawn straight from the detection arrays.
+
+    With max_size, the image is first downscaled so its longer side is at most max_size pixels, and
+    the boxes are drawn on that preview at the same line and text size, which is much faster to
+    annotate and encode for large images.
+    """
+
+    def __init__(self, class_names=COCO_CLASSES, colors=_COLORS):
+        self.palette = (np.asarray(colors) * 255).astype(np.uint8)
+        # OpenCV takes the colors as tuples of Python ints
+        self.colors = [tuple(color) for color in self.palette.tolist()]
+        self.class_index = {name: class_id for class_id, name in enumerate(class_names)}
+        # The label height only depends on the font, the widths are cached by label
+        self.label_height = cv2.getTextSize("0", FONT, FONT_SCALE, FONT_THICKNESS)[0][1]
+        self.label_widths = {}
+
+    def label_width(self, label: str) -> int:
+        width = self.label_widths.get(label)
+        if width is None:
+            width = self.label_widths[label] = cv2.getTextSize(label, FONT, FONT_SCALE, FONT_THICKNESS)[0][0]
+        return width
+
+    def render(self, img, detections, max_size: Optional[int] = None):
+        """Annotated image, drawn in place unless it's downscaled to a preview."""
+        height, width = img.shape[:2]
+        scale = 1.0
+        if max_size and max(height, width) > max_size:
+            scale = max_size / max(height, width)
+            # INTER_AREA looks a bit smoother but is more than 10x slower on large images
+            img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                             interpolation=cv2.INTER_LINEAR)
+        if not len(detections):
+            return img
+        boxes = detections.boxes if scale == 1.0 else np.round(detections.boxes * scale)
+        # Colors of the Detections labels, looked up once per image instead of once per box
+        label_colors = [self.colors[self.class_index[label]] for label in detections.labels]
+        label_height = self.label_height
+        for (x0, y0, x1, y1), class_id, confidence in zip(
+            boxes.astype(np.int64).tolist(), detections.class_ids.tolist(), detections.confidences.tolist()
+        ):
+            color = label_colors[class_id]
+            label = f"{detections.labels[class_id]} {confidence:.2f}"
+            cv2.rectangle(img, (x0, y0), (x1, y1), color, BOX_THICKNESS)
+            cv2.rectangle(img, (x0, y0 - label_height), (x0 + self.label_width(label), y0), color, -1)
+            cv2.putText(img, label, (x0, y0), FONT, FONT_SCALE, TEXT_COLOR, FONT_THICKNESS)
+        return img
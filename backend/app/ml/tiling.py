@@ -0,0 +1,108 @@
+import os
+import numpy as np
+
+TILE_SIZE = int(os.environ.get("TILE_SIZE", 640))
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", 0.2))
+TILE_MERGE = os.environ.get("TILE_MERGE", "nms")
+# Also run the whole letterboxed image, for the objects larger than a tile
+TILE_FULL_IMAGE = os.environ.get("TILE_FULL_IMAGE", "true").lower() == "true"
+TILE_WORKERS = int(os.environ.get("TILE_WORKERS", 4))
+
+
+def tile_origins(length: int, tile_size: int, overlap: float) -> list[int]:
+    """Start of every tile along one axis, the last tile ends on the image border."""
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+
+def box_iou(box, boxes):
+    """IoU of one x0, y0, x1, y1 box with every row of boxes."""
+    x0 = np.maximum(box[0], boxes[:, 0])
+    y0 = np.maximum(box[1], boxes[:, 1])
+    x1 = np.minimum(box[2], boxes[:, 2])
+    y1 = np.minimum(box[3], boxes[:, 3])
+    inter = np.maximum(0.0, x1 - x0) * np.maximum(0.0, y1 - y0)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = (box[2] - box[0]) * (box[3] - box[1]) + areas - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+def weighted_boxes_fusion(dets, iou_thr, class_agnostic=False):
+    """
+    Weighted boxes fusion of (N, 6) x0, y0, x1, y1, score, class detections: every box, by decreasing
+    score, joins the cluster of its class whose fused box overlaps it the most above iou_thr, or starts
+    a new one. A cluster becomes the score weighted average of its boxes, with their mean score.
+    """
+    if class_agnostic:
+        return _fuse(dets, iou_thr)
+    return np.concatenate([_fuse(dets[dets[:, 5] == cls], iou_thr) for cls in np.unique(dets[:, 5])])
+
+
+def _fuse(dets, iou_thr):
+    dets = dets[np.argsort(-dets[:, 4], kind="stable")]
+    fused = np.empty_like(dets)
+    weighted_sums = np.empty((len(dets), 4))
+    score_sums = np.empty(len(dets))
+    counts = np.empty(len(dets))
+    num_fused = 0
+    for det in dets:
+        if num_fused:
+            ious = box_iou(det[:4], fused[:num_fused, :4])
+            best = int(np.argmax(ious))
+            if ious[best] > iou_thr:
+                weighted_sums[best] += det[:4] * det[4]
+                score_sums[best] += det[4]
+                counts[best] += 1
+                fused[best, :4] = weighted_sums[best] / score_sums[best]
+                fused[best, 4] = score_sums[best] / counts[best]
+                continue
+        fused[num_fused] = det
+        weighted_sums[num_fused] = det[:4] * det[4]
+        score_sums[num_fused] = det[4]
+        counts[num_fused] = 1
+        num_fused += 1
+    return fused[:num_fused]
+
+
+class Tiler:
+    """
+    Tiled inference of large images: the image is cut into overlapping tile_size x tile_size tiles at
+    its native resolution, so small objects keep their pixels instead of being shrunk with the whole
+    image into the model input. The detections of the tiles, shifted back to image coordinates, are
+    merged with a global NMS or a weighted boxes fusion, which also removes the duplicates found in
+    the overlaps.
+    """
+
+    MERGES = ("nms", "wbf")
+
+    def __init__(self, tile_size: int = TILE_SIZE, overlap: float = TILE_OVERLAP, merge: str = TILE_MERGE,
+                 full_image: bool = TILE_FULL_IMAGE):
+        if merge not in self.MERGES:
+            raise ValueError(f"Unknown tile merge {merge}, expected one of {self.MERGES}")
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.merge_method = merge
+        self.full_image = full_image
+
+    def tiles(self, image) -> list:
+        """(x0, y0, tile) of every tile, the tiles are views of the image."""
+        height, width = image.shape[:2]
+        tiles = [
+            (x0, y0, image[y0:y0 + self.tile_size, x0:x0 + self.tile_size])
+            for y0 in tile_origins(height, self.tile_size, self.overlap)
+            for x0 in tile_origins(width, self.tile_size, self.overlap)
+        ]
+        if self.full_image and len(tiles) > 1:
+            tiles.insert(0, (0, 0, image))
+        return tiles
+
+    def merge(self, dets, nms_engine, nms_thr, class_agnostic=False):
+        """Merge the (N, 6) detections of all the tiles, already in image coordinates."""
+        if self.merge_method == "wbf":
+            return weighted_boxes_fusion(dets, nms_thr, class_agnostic)
+        keep = nms_engine.suppress(dets[:, :4], dets[:, 4], None if class_agnostic else dets[:, 5], nms_thr)
+        return dets[np.sort(np.asarray(keep, dtype=np.intp))]
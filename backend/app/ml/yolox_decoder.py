@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class YoloXDecoder:
+    """
+    Decodes the raw YOLOX head outputs into boxes. The anchor grids and expanded strides only
+    depend on the input size and the number of strides, so they are built once per
+    (input size, p6) and reused for every image, whatever input sizes the models use.
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def grids(self, img_size, p6=False):
+        """Returns the (num_anchors, 2) grid offsets and the (num_anchors, 1) strides as float32."""
+        key = (int(img_size[0]), int(img_size[1]), p6)
+        cached = self.cache.get(key)
+        if cached is None:
+            strides = [8, 16, 32] if not p6 else [8, 16, 32, 64]
+            grids = []
+            expanded_strides = []
+            for stride in strides:
+                hsize, wsize = key[0] // stride, key[1] // stride
+                xv, yv = np.meshgrid(np.arange(wsize), np.arange(hsize))
+                grids.append(np.stack((xv, yv), 2).reshape(-1, 2))
+                expanded_strides.append(np.full((hsize * wsize, 1), stride))
+            cached = (
+                np.concatenate(grids, 0).astype(np.float32),
+                np.concatenate(expanded_strides, 0).astype(np.float32),
+            )
+            self.cache[key] = cached
+        return cached
+
+    def decode(self, outputs, img_size, p6=False):
+        """Decode the (..., num_anchors, 5 + num_classes) outputs in place to cx, cy, w, h in input pixels."""
+        grids, strides = self.grids(img_size, p6)
+        outputs[..., :2] = (outputs[..., :2] + grids) * strides
+        outputs[..., 2:4] = np.exp(outputs[..., 2:4]) * strides
+        return outputs
+
+    def decode_boxes(self, outputs, img_size, ratio=1.0, p6=False, anchor_inds=None):
+        """
+        Decode the raw (num_anchors, 5 + num_classes) outputs of one image straight to x0, y0, x1, y1
+        boxes divided by ratio. The outputs are left untouched and the boxes are built in a compact
+        (num_anchors, 4) array, which is much faster than writing back into the wide output rows.
+        When the outputs are a subset of the anchors, anchor_inds gives their position in the grid.
+        """
+        grids, strides = self.grids(img_size, p6)
+        if anchor_inds is not None:
+            grids, strides = grids[anchor_inds], strides[anchor_inds]
+        centers = outputs[:, :2] + grids
+        centers *= strides
+        half_sizes = np.exp(outputs[:, 2:4])
+        half_sizes *= strides
+        half_sizes /= 2.
+        boxes_xyxy = np.empty((len(outputs), 4), dtype=np.float32)
+        np.subtract(centers, half_sizes, out=boxes_xyxy[:, :2])
+        np.add(centers, half_sizes, out=boxes_xyxy[:, 2:])
+        boxes_xyxy /= ratio
+        return boxes_xyxy
@@ -1,225 +1,217 @@
-import onnxruntime as ort
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 from util.logger import Logger
 from ml.abstract_class_definition import onnx_model
-from ml.yolox_utils import COCO_CLASSES, _COLORS
+from ml.model_registry import model_registry
+from ml.preprocessing import LetterboxPreprocessor
+from ml.yolox_decoder import YoloXDecoder
+from ml.nms import NMSEngine, EMBEDDED_NMS_OUTPUTS
+from ml.yolox_utils import COCO_CLASSES
+from ml.detections import Detections
+from ml.tiling import TILE_WORKERS
+from ml.batch_scheduler import BATCH_MAX_SIZE
+from ml.renderer import AnnotationRenderer, ANNOTATION_PREVIEW_SIZE
+from util.metrics import stage_timer
+
+MODEL_PATH = os.environ.get("MODEL_PATH", "./ml/image_models_files/yolox_s.onnx")
+EARLY_PRUNING = os.environ.get("POSTPROCESS_EARLY_PRUNING", "true").lower() == "true"
 
 class YoloX(onnx_model):
 
-    def __init__(self):
+    def __init__(self, model_path=MODEL_PATH, input_size=None):
+        self.model_path = model_path
+        self.decoder = YoloXDecoder()
+        self.nms_engine = NMSEngine()
+        self.early_pruning = EARLY_PRUNING
         self.session = None
+        self.scheduler = None
+        # Shared by the requests running on the worker pool, its threads only start with the first tiles
+        self.tile_executor = ThreadPoolExecutor(max_workers=TILE_WORKERS, thread_name_prefix="tile-worker")
         self.load_model()
+        self.input_shape = self.model_input_shape(input_size)
+        self.preprocessor = LetterboxPreprocessor(self.input_shape)
+        self.renderer = AnnotationRenderer(COCO_CLASSES)
         self.logger = Logger(self.__class__).get_logger()
 
     def load_model(self):
-        self.session = ort.InferenceSession("./ml/image_models_files/yolox_s.onnx")
+        self.session = model_registry.get_session(self.model_path)
+        output_names = tuple(output.name for output in self.session.get_outputs())
+        if self.nms_engine.backend == "onnx" and output_names != EMBEDDED_NMS_OUTPUTS:
+            raise ValueError(f"NMS_BACKEND=onnx needs a model exported with tools.embed_nms, got outputs {output_names}")
 
-    def normalize_input(self, img):
+    def warm_up(self):
         """
-        Normalize the image to have as maximum 1024 x 720, without breaking the aspect ratio of the img.
-        For that let's get the ratio to scale the image.
+        Run a dummy inference so onnxruntime allocates its buffers and finishes lazy initialization
+        before the first real request arrives.
         """
-        max_height = 1024
-        max_width = 720
-
-        height, width = img.shape[:2]
-
-        scaling_factor = min(max_height / height, max_width / width)
-
-        new_height = int(height * scaling_factor)
-        new_width = int(width * scaling_factor)
-
-        resized_img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-
-        return resized_img
-
-    def preprocess(self,img, input_size, swap=(2, 0, 1)):
-        if len(img.shape) == 3:
-            padded_img = np.ones((input_size[0], input_size[1], 3), dtype=np.uint8) * 114
-        else:
-            padded_img = np.ones(input_size, dtype=np.uint8) * 114
-
-        r = min(input_size[0] / img.shape[0], input_size[1] / img.shape[1])
-        resized_img = cv2.resize(
-            img,
-            (int(img.shape[1] * r), int(img.shape[0] * r)),
-            interpolation=cv2.INTER_LINEAR,
-        ).astype(np.uint8)
-        padded_img[: int(img.shape[0] * r), : int(img.shape[1] * r)] = resized_img
-
-        padded_img = padded_img.transpose(swap)
-        padded_img = np.ascontiguousarray(padded_img, dtype=np.float32)
-        return padded_img, r
-    
-
-    def predict(self,image, filepath):
-        input_shape = (640,640)
-        resized_image = self.normalize_input(image)
-        img, ratio = self.preprocess(resized_image, input_shape)
-        
-        ort_inputs = {self.session.get_inputs()[0].name: img[None, :, :, :]}
-        output = self.session.run(None, ort_inputs)
-        predictions = self.demo_postprocess(output[0], input_shape)[0]
-
-        boxes = predictions[:, :4]
-        scores = predictions[:, 4:5] * predictions[:, 5:]
-        boxes_xyxy = np.ones_like(boxes)
-        boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2]/2.
-        boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3]/2.
-        boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2]/2.
-        boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3]/2.
-        boxes_xyxy /= ratio
-        dets = self.multiclass_nms(boxes_xyxy, scores, nms_thr=0.6, score_thr=0.1, class_agnostic=False)
-        if dets is not None:
-            final_boxes, final_scores, final_cls_inds = dets[:, :4], dets[:, 4], dets[:, 5]
-            crops_info = self.extract_crops_info(final_boxes, final_scores, final_cls_inds,
-                            conf=0.45, class_names=COCO_CLASSES)
-            annotated_image = self.annotate_image(resized_image, crops_info)
-            cv2.imwrite(filepath,annotated_image)
-            return annotated_image, crops_info
-        else:
-            cv2.imwrite(filepath,annotated_image)
-            return image, []
-
-    def nms(self,boxes, scores, nms_thr):
-        """Single class NMS implemented in Numpy."""
-        x1 = boxes[:, 0]
-        y1 = boxes[:, 1]
-        x2 = boxes[:, 2]
-        y2 = boxes[:, 3]
-
-        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-        order = scores.argsort()[::-1]
-
-        keep = []
-        while order.size > 0:
-            i = order[0]
-            keep.append(i)
-            xx1 = np.maximum(x1[i], x1[order[1:]])
-            yy1 = np.maximum(y1[i], y1[order[1:]])
-            xx2 = np.minimum(x2[i], x2[order[1:]])
-            yy2 = np.minimum(y2[i], y2[order[1:]])
-
-            w = np.maximum(0.0, xx2 - xx1 + 1)
-            h = np.maximum(0.0, yy2 - yy1 + 1)
-            inter = w * h
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-
-            inds = np.where(ovr <= nms_thr)[0]
-            order = order[inds + 1]
-
-        return keep
-
-    def extract_crops_info(self, boxes, scores, cls_ids, conf=0.5, class_names=COCO_CLASSES):
-        crops_info = []
-        for i in range(len(boxes)):
-            crop_info = {}
-            box = boxes[i]
-            cls_id = int(cls_ids[i])
-            score = scores[i]
-            if score < conf:
-                continue
-            x0 = int(box[0])
-            y0 = int(box[1])
-            x1 = int(box[2])
-            y1 = int(box[3])
-            crop_info["bbox"] = {"x_min": x0, "y_min": y0, "x_max": x1, "y_max": y1}
-            crop_info["class"] = class_names[cls_id]
-            crop_info["confidence"] = round(score * 100, 1)
-            crops_info.append(crop_info)
-
-        return crops_info
-
-    def annotate_image(self, img, crops_info):
-        for crop in crops_info:
-            bbox = crop['bbox']
-            class_name = crop['class']
-            confidence = crop['confidence']
-            x0, y0, x1, y1 = bbox['x_min'], bbox['y_min'], bbox['x_max'], bbox['y_max']
-
-            # Generate color per class
-            color = (_COLORS[COCO_CLASSES.index(class_name)] * 255).astype(np.uint8).tolist()
-
-            # Draw bounding box
-            cv2.rectangle(img, (x0, y0), (x1, y1), color, 4)
-
-            # Draw label
-            label = f"{class_name} {confidence:.2f}"
-            t_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)[0]
-            cv2.rectangle(img, (x0, y0 - t_size[1]), (x0 + t_size[0], y0), color, -1)
-            cv2.putText(img, label, (x0, y0), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2)
-        
-        return img
-
-    def demo_postprocess(self,outputs, img_size, p6=False):
-        grids = []
-        expanded_strides = []
-        strides = [8, 16, 32] if not p6 else [8, 16, 32, 64]
-
-        hsizes = [img_size[0] // stride for stride in strides]
-        wsizes = [img_size[1] // stride for stride in strides]
-
-        for hsize, wsize, stride in zip(hsizes, wsizes, strides):
-            xv, yv = np.meshgrid(np.arange(wsize), np.arange(hsize))
-            grid = np.stack((xv, yv), 2).reshape(1, -1, 2)
-            grids.append(grid)
-            shape = grid.shape[:2]
-            expanded_strides.append(np.full((*shape, 1), stride))
-
-        grids = np.concatenate(grids, 1)
-        expanded_strides = np.concatenate(expanded_strides, 1)
-        outputs[..., :2] = (outputs[..., :2] + grids) * expanded_strides
-        outputs[..., 2:4] = np.exp(outputs[..., 2:4]) * expanded_strides
+        self.session.run(None, self.dummy_inputs())
+
+    def measure_latency(self, runs=5):
+        """Median latency in ms of the inference of a single image, the pre and post processing excluded."""
+        inputs = self.dummy_inputs()
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            self.session.run(None, inputs)
+            latencies.append((time.perf_counter() - start) * 1000)
+        return statistics.median(latencies)
+
+    def dummy_inputs(self):
+        model_input = self.session.get_inputs()[0]
+        return {model_input.name: np.zeros((1, 3, *self.input_shape), dtype=np.float32),
+                **(self.nms_inputs(0.6, 0.1) or {})}
+
+    def model_input_shape(self, input_size=None):
+        """(height, width) of the graph input, or input_size (default 640x640) when they are dynamic."""
+        height, width = self.session.get_inputs()[0].shape[2:]
+        if isinstance(height, int) and isinstance(width, int):
+            return height, width
+        return tuple(input_size or (640, 640))
+
+    def preprocess(self, img):
+        """Letterbox the image into the model input, see LetterboxPreprocessor."""
+        with stage_timer("preprocess"):
+            return self.preprocessor(img)
+
+    def predict(self,image, nms_thr=0.6, score_thr=0.1, conf=0.45, class_agnostic=False, tiler=None,
+                preview_size=ANNOTATION_PREVIEW_SIZE):
+        """
+        Returns the annotated image and the Detections, saving them is up to the caller. With preview_size
+        the image is downscaled to it, the Detections stay in the coordinates of the original image.
+        """
+        if tiler is not None:
+            detections = self.detect(image, nms_thr, score_thr, conf, class_agnostic, tiler)
+            return self.annotate_image(image, detections, preview_size), detections
+        img, ratio = self.preprocess(image)
+        outputs = self.inference(img, self.nms_inputs(nms_thr, score_thr))
+        return self.process_output(outputs, ratio, image, nms_thr, score_thr, conf, class_agnostic, preview_size)
+
+    def detect(self, image, nms_thr=0.6, score_thr=0.1, conf=0.45, class_agnostic=False, tiler=None):
+        """Same as predict, returning only the Detections without annotating or saving the image."""
+        if tiler is not None:
+            dets = self.tiled_postprocess(image, tiler, nms_thr, score_thr, class_agnostic)
+            if dets is None:
+                return Detections.empty()
+            return Detections.from_arrays(dets[:, :4], dets[:, 4], dets[:, 5], conf=conf, class_names=COCO_CLASSES)
+        img, ratio = self.preprocess(image)
+        outputs = self.inference(img, self.nms_inputs(nms_thr, score_thr))
+        return self.detections(outputs, ratio, nms_thr, score_thr, conf, class_agnostic)
+
+    def inference(self, img, extra_inputs=None):
+        """
+        Run the model on a single CHW image, going through the batch scheduler when there is one.
+        Returns the list of model outputs for that image, without the batch dimension.
+        """
+        with stage_timer("inference"):
+            return self.run_inference(img, extra_inputs)
 
-        return outputs
+    def run_inference(self, img, extra_inputs=None):
+        if self.scheduler is not None:
+            return self.scheduler.submit(img).result()
+        ort_inputs = {self.session.get_inputs()[0].name: img[None, :, :, :], **(extra_inputs or {})}
+        return [output[0] for output in self.session.run(None, ort_inputs)]
 
-    def multiclass_nms(self,boxes, scores, nms_thr, score_thr, class_agnostic=True):
-        """Multiclass NMS implemented in Numpy"""
-        if class_agnostic:
-            nms_method = self.multiclass_nms_class_agnostic
-        else:
-            nms_method = self.multiclass_nms_class_aware
-        return nms_method(boxes, scores, nms_thr, score_thr)
-
-    def multiclass_nms_class_aware(self,boxes, scores, nms_thr, score_thr):
-        """Multiclass NMS implemented in Numpy. Class-aware version."""
-        final_dets = []
-        num_classes = scores.shape[1]
-        for cls_ind in range(num_classes):
-            cls_scores = scores[:, cls_ind]
-            valid_score_mask = cls_scores > score_thr
-            if valid_score_mask.sum() == 0:
-                continue
-            else:
-                valid_scores = cls_scores[valid_score_mask]
-                valid_boxes = boxes[valid_score_mask]
-                keep = self.nms(valid_boxes, valid_scores, nms_thr)
-                if len(keep) > 0:
-                    cls_inds = np.ones((len(keep), 1)) * cls_ind
-                    dets = np.concatenate(
-                        [valid_boxes[keep], valid_scores[keep, None], cls_inds], 1
-                    )
-                    final_dets.append(dets)
-        if len(final_dets) == 0:
+    def inference_many(self, imgs, extra_inputs=None):
+        """
+        Run the model on several CHW images at once. With the batch scheduler they are queued together
+        and run in batches. Without it, a model with a dynamic batch axis runs them in batched session.run
+        calls of up to BATCH_MAX_SIZE images. A model with a static batch of 1, like the exported YOLOX
+        models, can only run them one by one, in parallel from the tile threads.
+        """
+        with stage_timer("inference"):
+            if self.scheduler is not None:
+                futures = [self.scheduler.submit(img) for img in imgs]
+                return [future.result() for future in futures]
+            batch_dim = self.session.get_inputs()[0].shape[0]
+            # The embedded NMS outputs aren't split by image, those models keep the per tile calls
+            if not isinstance(batch_dim, int) and extra_inputs is None:
+                input_name = self.session.get_inputs()[0].name
+                results = []
+                for start in range(0, len(imgs), BATCH_MAX_SIZE):
+                    outputs = self.session.run(None, {input_name: np.stack(imgs[start:start + BATCH_MAX_SIZE])})
+                    results.extend([output[i] for output in outputs] for i in range(len(outputs[0])))
+                return results
+            return list(self.tile_executor.map(lambda img: self.run_inference(img, extra_inputs), imgs))
+
+    def tiled_postprocess(self, image, tiler, nms_thr=0.6, score_thr=0.1, class_agnostic=False):
+        """(N, 6) detections of all the tiles of the image in image coordinates, merged by the tiler."""
+        tiles = tiler.tiles(image)
+        imgs, ratios = [], []
+        for _, _, tile in tiles:
+            img, ratio = self.preprocess(tile)
+            # The preprocessor reuses its tensor for the next tile
+            imgs.append(img.copy())
+            ratios.append(ratio)
+        outputs = self.inference_many(imgs, self.nms_inputs(nms_thr, score_thr))
+        tile_dets = []
+        for (x0, y0, _), ratio, tile_outputs in zip(tiles, ratios, outputs):
+            dets = self.postprocess(tile_outputs, ratio, nms_thr, score_thr, class_agnostic)
+            if dets is not None:
+                dets[:, :4] += (x0, y0, x0, y0)
+                tile_dets.append(dets)
+        if not tile_dets:
             return None
-        return np.concatenate(final_dets, 0)
+        with stage_timer("merge"):
+            return tiler.merge(np.concatenate(tile_dets), self.nms_engine, nms_thr, class_agnostic)
 
-    def multiclass_nms_class_agnostic(self,boxes, scores, nms_thr, score_thr):
-        """Multiclass NMS implemented in Numpy. Class-agnostic version."""
-        cls_inds = scores.argmax(1)
-        cls_scores = scores[np.arange(len(cls_inds)), cls_inds]
-
-        valid_score_mask = cls_scores > score_thr
-        if valid_score_mask.sum() == 0:
+    def nms_inputs(self, nms_thr, score_thr):
+        """Thresholds fed to the graph when the NMS is embedded in the model, see tools.embed_nms."""
+        if self.nms_engine.backend != "onnx":
             return None
-        valid_scores = cls_scores[valid_score_mask]
-        valid_boxes = boxes[valid_score_mask]
-        valid_cls_inds = cls_inds[valid_score_mask]
-        keep = self.nms(valid_boxes, valid_scores, nms_thr)
-        if keep:
-            dets = np.concatenate(
-                [valid_boxes[keep], valid_scores[keep, None], valid_cls_inds[keep, None]], 1
-            )
-        return dets
+        return {
+            "iou_threshold": np.array([nms_thr], dtype=np.float32),
+            "score_threshold": np.array([score_thr], dtype=np.float32),
+        }
+
+    def postprocess(self, outputs, ratio, nms_thr=0.6, score_thr=0.1, class_agnostic=False):
+        """Turn the model outputs of one image into (N, 6) detections in original image coordinates."""
+        with stage_timer("postprocess"):
+            if self.nms_engine.backend == "onnx":
+                return self.nms_engine.from_embedded_outputs(*outputs, ratio)
+            output = outputs[0]
+            if not self.early_pruning:
+                boxes_xyxy = self.decoder.decode_boxes(output, self.input_shape, ratio)
+                scores = output[:, 4:5] * output[:, 5:]
+                return self.multiclass_nms(boxes_xyxy, scores, nms_thr, score_thr, class_agnostic)
+
+            # The class scores are sigmoid outputs <= 1, so obj * cls > score_thr needs obj > score_thr.
+            # Anchors are dropped on objectness first and then on their best class score, and only the
+            # survivors are decoded, which are usually a few dozens out of the 8400 anchors.
+            anchor_inds = np.nonzero(output[:, 4] > score_thr)[0]
+            objectness = output[anchor_inds, 4:5]
+            scores = output[anchor_inds, 5:] * objectness
+            survivors = scores.max(1) > score_thr
+            anchor_inds = anchor_inds[survivors]
+            if len(anchor_inds) == 0:
+                return None
+            boxes_xyxy = self.decoder.decode_boxes(output[anchor_inds], self.input_shape, ratio, anchor_inds=anchor_inds)
+            return self.multiclass_nms(boxes_xyxy, scores[survivors], nms_thr, score_thr, class_agnostic)
+
+    def detections(self, outputs, ratio, nms_thr=0.6, score_thr=0.1, conf=0.45, class_agnostic=False):
+        """Detections above conf, empty when nothing survives the NMS."""
+        dets = self.postprocess(outputs, ratio, nms_thr, score_thr, class_agnostic)
+        if dets is None:
+            return Detections.empty()
+        return Detections.from_arrays(dets[:, :4], dets[:, 4], dets[:, 5], conf=conf, class_names=COCO_CLASSES)
+
+    def process_output(self, outputs, ratio, image, nms_thr=0.6, score_thr=0.1, conf=0.45, class_agnostic=False,
+                       preview_size=ANNOTATION_PREVIEW_SIZE):
+        detections = self.detections(outputs, ratio, nms_thr, score_thr, conf, class_agnostic)
+        return self.annotate_image(image, detections, preview_size), detections
+
+    def annotate_image(self, img, detections, preview_size=None):
+        """Draw the detections on the image, or on a preview of it downscaled to preview_size, see AnnotationRenderer."""
+        with stage_timer("annotate"):
+            return self.renderer.render(img, detections, preview_size)
+
+    def demo_postprocess(self,outputs, img_size, p6=False):
+        return self.decoder.decode(outputs, img_size, p6)
 
+    def multiclass_nms(self,boxes, scores, nms_thr, score_thr, class_agnostic=True):
+        """Multiclass NMS, the backend is chosen by the NMSEngine configuration"""
+        with stage_timer("nms"):
+            return self.nms_engine(boxes, scores, nms_thr, score_thr, class_agnostic)
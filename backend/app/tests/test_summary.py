@@ -0,0 +1,50 @@
+"""
+summary_pipeline on a collection mixing crops and columnar documents. Runs on mongomock from
+backend/app with `python -m pytest tests`. mongomock implements neither $stdDevSamp nor $percentile,
+so the confidence facet is left out, it only reads the crops.
+"""
+import pytest
+from core.summary import summary_pipeline, format_summary
+
+mongomock = pytest.importorskip("mongomock")
+
+CREATED_ON = "2024-01-01 12:00:00"
+
+
+@pytest.fixture
+def images():
+    collection = mongomock.MongoClient().db.images
+    collection.insert_many([
+        {"id": "crops", "originalFileName": "crops.jpg", "createdOn": CREATED_ON, "crops": [
+            {"class": "person", "confidence": 90.0},
+            {"class": "dog", "confidence": 50.0},
+        ]},
+        {"id": "columnar", "originalFileName": "columnar.jpg", "createdOn": CREATED_ON,
+         "detections": {"count": 3, "labels": ["person"], "classIds": b"", "boxes": b"", "confidences": b""}},
+        {"id": "empty", "originalFileName": "empty.jpg", "createdOn": CREATED_ON, "crops": []},
+    ])
+    return collection
+
+
+def summarize(collection, **kwargs):
+    pipeline = summary_pipeline(**kwargs)
+    pipeline[-1]["$facet"].pop("confidence")
+    result = list(collection.aggregate(pipeline))[0]
+    return format_summary({**result, "confidence": []})
+
+
+def test_mixed_storage_formats(images):
+    summary = summarize(images)
+    assert summary["images"] == 3
+    assert summary["detections"] == 5
+    assert summary["maxDetectionsPerImage"] == 3
+    assert [image["id"] for image in summary["topImages"]] == ["columnar", "crops", "empty"]
+    # Only the crops have classes
+    assert {group["class"]: group["count"] for group in summary["classes"]} == {"person": 1, "dog": 1}
+
+
+def test_mixed_storage_formats_by_class(images):
+    summary = summarize(images, classes=["dog"])
+    assert summary["images"] == 1
+    assert summary["detections"] == 1
+    assert summary["classes"] == [{"class": "dog", "count": 1, "meanConfidence": 50.0}]
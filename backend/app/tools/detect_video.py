@@ -0,0 +1,47 @@
+"""
+Run the video detection pipeline on a local video file and print the per-frame detections as
+NDJSON, followed by the throughput summary of every stage.
+
+Usage (from backend/app):
+    python -m tools.detect_video ./sample.mp4 --max-fps 5
+"""
+import argparse
+import json
+from core.data_models import PredictionConfig
+from core.video_pipeline import VideoPipeline, video_file_frames
+from ml.batch_scheduler import BatchScheduler
+from ml.yolox_model import YoloX, MODEL_PATH
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect objects in every frame of a local video")
+    parser.add_argument("video", help="Path of the video file")
+    parser.add_argument("--model", default=MODEL_PATH, help="ONNX model to run")
+    parser.add_argument("--frame-stride", type=int, default=1, help="Process one frame out of every N")
+    parser.add_argument("--max-fps", type=float, default=None, help="Maximum processed frames per video second")
+    parser.add_argument("--score-thr", type=float, default=0.1)
+    parser.add_argument("--nms-thr", type=float, default=0.6)
+    parser.add_argument("--conf", type=float, default=0.45)
+    parser.add_argument("--summary-only", action="store_true", help="Only print the final summary")
+    args = parser.parse_args()
+
+    model = YoloX(args.model)
+    model.warm_up()
+    if BatchScheduler.supports_batching(model.session):
+        model.scheduler = BatchScheduler(model.session)
+        model.scheduler.start()
+    config = PredictionConfig(score_thr=args.score_thr, nms_thr=args.nms_thr, conf=args.conf)
+    pipeline = VideoPipeline(model, video_file_frames(args.video), config,
+                             frame_stride=args.frame_stride, max_fps=args.max_fps)
+    try:
+        for record in pipeline:
+            if args.summary_only and "summary" not in record:
+                continue
+            print(json.dumps(record, default=lambda value: value.item()))
+    finally:
+        if model.scheduler is not None:
+            model.scheduler.stop()
+
+
+if __name__ == "__main__":
+    main()
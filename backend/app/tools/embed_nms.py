@@ -0,0 +1,115 @@
+"""
+Append the YOLOX box decoding and an ONNX NonMaxSuppression node to an exported model, so the
+whole postprocessing runs inside onnxruntime (EfficientNMS-style). Serve the result with
+NMS_BACKEND=onnx.
+
+Usage (from backend/app):
+    python -m tools.embed_nms --input ./ml/image_models_files/yolox_s.onnx \
+        --output ./ml/image_models_files/yolox_s_nms.onnx
+
+The new model returns the decoded (1, num_anchors, 4) boxes, the (1, num_classes, num_anchors)
+scores and the (1, num_kept, 3) selected indices. The IoU and score thresholds are graph inputs
+with the default values below, so they can be overridden per inference. ONNX NonMaxSuppression
+computes the IoU without the +1 pixel convention of the numpy NMS, so boxes right at the
+threshold can be kept differently.
+"""
+import argparse
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+from ml.nms import EMBEDDED_NMS_OUTPUTS
+from ml.yolox_decoder import YoloXDecoder
+
+DEFAULT_IOU_THRESHOLD = 0.6
+DEFAULT_SCORE_THRESHOLD = 0.1
+MAX_OUTPUT_BOXES_PER_CLASS = 1000
+
+
+def opset_version(model: onnx.ModelProto) -> int:
+    return next(opset.version for opset in model.opset_import if opset.domain in ("", "ai.onnx"))
+
+
+def embed_nms(model: onnx.ModelProto, p6: bool = False) -> onnx.ModelProto:
+    graph = model.graph
+    input_shape = graph.input[0].type.tensor_type.shape.dim
+    batch_size = input_shape[0].dim_value
+    if batch_size != 1:
+        raise ValueError("Embedded NMS needs a model exported with a static batch of 1")
+    img_size = (input_shape[2].dim_value, input_shape[3].dim_value)
+    raw_output = graph.output[0].name
+    grids, strides = YoloXDecoder().grids(img_size, p6)
+    opset = opset_version(model)
+    boxes_name, scores_name, selected_name = EMBEDDED_NMS_OUTPUTS
+
+    initializers = [
+        numpy_helper.from_array(grids[None], "nms_grids"),
+        numpy_helper.from_array(strides[None], "nms_strides"),
+        numpy_helper.from_array(strides[None] / 2, "nms_half_strides"),
+        numpy_helper.from_array(np.array([0], dtype=np.int64), "nms_slice_0"),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), "nms_slice_2"),
+        numpy_helper.from_array(np.array([4], dtype=np.int64), "nms_slice_4"),
+        numpy_helper.from_array(np.array([5], dtype=np.int64), "nms_slice_5"),
+        numpy_helper.from_array(np.array([np.iinfo(np.int64).max], dtype=np.int64), "nms_slice_end"),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), "nms_slice_axis"),
+        numpy_helper.from_array(np.array([MAX_OUTPUT_BOXES_PER_CLASS], dtype=np.int64), "nms_max_output"),
+        numpy_helper.from_array(np.array([DEFAULT_IOU_THRESHOLD], dtype=np.float32), "iou_threshold"),
+        numpy_helper.from_array(np.array([DEFAULT_SCORE_THRESHOLD], dtype=np.float32), "score_threshold"),
+    ]
+    nodes = [
+        helper.make_node("Slice", [raw_output, "nms_slice_0", "nms_slice_2", "nms_slice_axis"], ["nms_xy"]),
+        helper.make_node("Slice", [raw_output, "nms_slice_2", "nms_slice_4", "nms_slice_axis"], ["nms_wh"]),
+        helper.make_node("Slice", [raw_output, "nms_slice_4", "nms_slice_5", "nms_slice_axis"], ["nms_obj"]),
+        helper.make_node("Slice", [raw_output, "nms_slice_5", "nms_slice_end", "nms_slice_axis"], ["nms_cls"]),
+        helper.make_node("Add", ["nms_xy", "nms_grids"], ["nms_grid_xy"]),
+        helper.make_node("Mul", ["nms_grid_xy", "nms_strides"], ["nms_centers"]),
+        helper.make_node("Exp", ["nms_wh"], ["nms_exp_wh"]),
+        helper.make_node("Mul", ["nms_exp_wh", "nms_half_strides"], ["nms_half_sizes"]),
+        helper.make_node("Sub", ["nms_centers", "nms_half_sizes"], ["nms_x0y0"]),
+        helper.make_node("Add", ["nms_centers", "nms_half_sizes"], ["nms_x1y1"]),
+        helper.make_node("Concat", ["nms_x0y0", "nms_x1y1"], [boxes_name], axis=2),
+        helper.make_node("Mul", ["nms_obj", "nms_cls"], ["nms_class_scores"]),
+        helper.make_node("Transpose", ["nms_class_scores"], [scores_name], perm=[0, 2, 1]),
+        helper.make_node(
+            "NonMaxSuppression",
+            [boxes_name, scores_name, "nms_max_output", "iou_threshold", "score_threshold"],
+            ["nms_selected"],
+        ),
+    ]
+    if opset >= 13:
+        initializers.append(numpy_helper.from_array(np.array([0], dtype=np.int64), "nms_unsqueeze_axes"))
+        nodes.append(helper.make_node("Unsqueeze", ["nms_selected", "nms_unsqueeze_axes"], [selected_name]))
+    else:
+        nodes.append(helper.make_node("Unsqueeze", ["nms_selected"], [selected_name], axes=[0]))
+
+    graph.node.extend(nodes)
+    graph.initializer.extend(initializers)
+    # The thresholds are also graph inputs, so the initializers only act as default values
+    graph.input.extend([
+        helper.make_tensor_value_info("iou_threshold", TensorProto.FLOAT, [1]),
+        helper.make_tensor_value_info("score_threshold", TensorProto.FLOAT, [1]),
+    ])
+    num_anchors = len(grids)
+    del graph.output[:]
+    graph.output.extend([
+        helper.make_tensor_value_info(boxes_name, TensorProto.FLOAT, [1, num_anchors, 4]),
+        helper.make_tensor_value_info(scores_name, TensorProto.FLOAT, [1, "num_classes", num_anchors]),
+        helper.make_tensor_value_info(selected_name, TensorProto.INT64, [1, "num_kept", 3]),
+    ])
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed the YOLOX decoding and NMS in an ONNX model")
+    parser.add_argument("--input", required=True, help="Path of the exported ONNX model")
+    parser.add_argument("--output", required=True, help="Path where the model with embedded NMS is saved")
+    parser.add_argument("--p6", action="store_true", help="The model has the extra stride 64 output")
+    args = parser.parse_args()
+
+    model = embed_nms(onnx.load(args.input), p6=args.p6)
+    onnx.checker.check_model(model)
+    onnx.save(model, args.output)
+    print(f"Model with embedded NMS saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
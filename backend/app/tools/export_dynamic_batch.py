@@ -0,0 +1,54 @@
+"""
+Rewrite the batch dimension of an exported ONNX model as a dynamic axis, so the backend can run
+batched inference through the BatchScheduler.
+
+Usage (from backend/app):
+    python -m tools.export_dynamic_batch --input ./ml/image_models_files/yolox_s.onnx \
+        --output ./ml/image_models_files/yolox_s_dynamic.onnx
+
+Graphs that hardcode the batch size inside their nodes (e.g. in Reshape constants) can't be fixed
+this way, for those re-export the model with `python tools/export_onnx.py --dynamic` from the YOLOX repo.
+"""
+import argparse
+import numpy as np
+import onnx
+import onnxruntime as ort
+
+
+def make_batch_dynamic(model: onnx.ModelProto, dim_name: str = "batch") -> onnx.ModelProto:
+    for value_info in list(model.graph.input) + list(model.graph.output):
+        batch_dim = value_info.type.tensor_type.shape.dim[0]
+        batch_dim.ClearField("dim_value")
+        batch_dim.dim_param = dim_name
+    return model
+
+
+def check_batched_run(model_path: str, batch_size: int = 2) -> None:
+    session = ort.InferenceSession(model_path)
+    model_input = session.get_inputs()[0]
+    shape = [batch_size] + [dim if isinstance(dim, int) else 1 for dim in model_input.shape[1:]]
+    outputs = session.run(None, {model_input.name: np.zeros(shape, dtype=np.float32)})
+    if outputs[0].shape[0] != batch_size:
+        raise ValueError(f"Model returned batch {outputs[0].shape[0]} for an input batch of {batch_size}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Make the batch axis of an ONNX model dynamic")
+    parser.add_argument("--input", required=True, help="Path of the exported ONNX model")
+    parser.add_argument("--output", required=True, help="Path where the dynamic batch model is saved")
+    args = parser.parse_args()
+
+    model = make_batch_dynamic(onnx.load(args.input))
+    onnx.checker.check_model(model)
+    onnx.save(model, args.output)
+    try:
+        check_batched_run(args.output)
+    except Exception as e:
+        raise SystemExit(
+            f"The model doesn't support batched inference ({e}), re-export it from YOLOX with --dynamic"
+        )
+    print(f"Dynamic batch model saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
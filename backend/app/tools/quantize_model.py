@@ -0,0 +1,307 @@
+"""
+Build reduced precision variants of an exported FP32 model and report how they compare to it, so the
+variant to serve can be chosen on data:
+
+- int8_dynamic: INT8 weights, the activations are quantized at runtime (ConvInteger / MatMulInteger)
+- int8_static: INT8 weights and activations in QDQ format, with scales calibrated on local images
+- fp16: FP16 weights and activations, the inputs and outputs stay FP32. Most CPUs have no FP16
+  kernels, so onnxruntime may run it slower than FP32, it's mostly useful on GPU
+
+Usage (from backend/app):
+    python -m tools.quantize_model --input ./ml/image_models_files/yolox_s.onnx \
+        --calibration-dir ../data-files --eval-dir ./eval-images --report ./quantization_report.json --catalog
+
+The variants are saved next to the input model as <model>_<variant>.onnx. The report runs the FP32
+model and every variant through YoloX on the same evaluation images and gives the file size, the
+inference latency, the end to end throughput, and the agreement of the detections with FP32: the
+boxes of a variant are matched to the FP32 boxes of the same class with IoU >= --match-iou, the
+precision and recall are the matched fractions of the variant and FP32 boxes. Use different images
+for the calibration and the evaluation, or the static variant is evaluated on what it was fitted to.
+
+With --catalog, the variants are added to the models.json of the output directory before their FP32
+model, with their measured latency, so they can be served and selected by latency budget.
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import onnx
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType
+from onnxruntime.quantization import quantize_dynamic, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from onnxruntime.transformers.float16 import convert_float_to_float16
+from ml.model_catalog import MODEL_CATALOG_FILE, ModelCatalog
+from ml.model_registry import model_registry
+from ml.preprocessing import LetterboxPreprocessor
+from ml.tiling import box_iou
+from ml.yolox_model import YoloX
+
+VARIANTS = ("int8_dynamic", "int8_static", "fp16")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+CALIBRATION_METHODS = {
+    "minmax": CalibrationMethod.MinMax,
+    "entropy": CalibrationMethod.Entropy,
+    "percentile": CalibrationMethod.Percentile,
+}
+
+
+def image_paths(directory: str, limit: int = None) -> list:
+    paths = sorted(
+        os.path.join(directory, file_name) for file_name in os.listdir(directory)
+        if file_name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        raise SystemExit(f"No image found in {directory}")
+    return paths[:limit]
+
+
+class ImageCalibrationReader(CalibrationDataReader):
+    """Feeds the letterboxed calibration images to the calibrator, one image per batch."""
+
+    def __init__(self, paths: list, input_name: str, input_size: tuple):
+        self.paths = iter(paths)
+        self.input_name = input_name
+        self.preprocessor = LetterboxPreprocessor(input_size)
+
+    def get_next(self):
+        for path in self.paths:
+            image = cv2.imread(path)
+            if image is not None:
+                tensor, _ = self.preprocessor(image)
+                return {self.input_name: tensor[None].copy()}
+        return None
+
+
+def graph_input(model_path: str) -> tuple:
+    """Name and (height, width) of the image input of the model."""
+    model_input = onnx.load(model_path, load_external_data=False).graph.input[0]
+    dims = model_input.type.tensor_type.shape.dim
+    return model_input.name, (dims[2].dim_value or 640, dims[3].dim_value or 640)
+
+
+def build_variant(variant: str, input_path: str, output_path: str, args) -> None:
+    if variant == "fp16":
+        onnx.save(convert_float_to_float16(onnx.load(input_path), keep_io_types=True), output_path)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Shape inference and graph optimizations first, as recommended by onnxruntime before quantizing.
+        # The exported YOLOX graphs have static shapes, the ONNX shape inference is enough for them.
+        preprocessed_path = os.path.join(tmp_dir, "preprocessed.onnx")
+        quant_pre_process(input_path, preprocessed_path, skip_symbolic_shape=True)
+        if variant == "int8_dynamic":
+            # The CPU ConvInteger kernel only takes uint8 weights
+            quantize_dynamic(preprocessed_path, output_path, weight_type=QuantType.QUInt8,
+                             nodes_to_exclude=args.exclude_nodes)
+            return
+        input_name, input_size = graph_input(input_path)
+        reader = ImageCalibrationReader(
+            image_paths(args.calibration_dir, args.calibration_images), input_name, input_size)
+        quantize_static(
+            preprocessed_path, output_path, reader,
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            calibrate_method=CALIBRATION_METHODS[args.calibration_method],
+            nodes_to_exclude=args.exclude_nodes,
+        )
+
+
+def match_detections(reference, candidate, iou_thr: float) -> tuple:
+    """
+    Greedily match the candidate detections, by decreasing confidence, to the unmatched reference
+    detection of the same class they overlap the most. Returns the number of matches, their IoUs
+    and their absolute confidence differences.
+    """
+    ious, confidence_diffs = [], []
+    for label in set(reference.labels) & set(candidate.labels):
+        ref = reference.class_ids == reference.labels.index(label)
+        cand = candidate.class_ids == candidate.labels.index(label)
+        ref_boxes = reference.boxes[ref].astype(np.float64)
+        ref_confidences = reference.confidences[ref]
+        unmatched = np.ones(len(ref_boxes), dtype=bool)
+        order = np.argsort(-candidate.confidences[cand], kind="stable")
+        for box, confidence in zip(candidate.boxes[cand][order].astype(np.float64), candidate.confidences[cand][order]):
+            overlaps = np.where(unmatched, box_iou(box, ref_boxes), 0.0)
+            best = int(np.argmax(overlaps)) if len(overlaps) else -1
+            if best >= 0 and overlaps[best] >= iou_thr:
+                unmatched[best] = False
+                ious.append(overlaps[best])
+                confidence_diffs.append(abs(confidence - ref_confidences[best]))
+    return len(ious), ious, confidence_diffs
+
+
+def evaluate(model_path: str, images: list, args) -> tuple:
+    """Latency, throughput and the detections of every image of the FP32 model or one variant."""
+    model = YoloX(model_path)
+    model.warm_up()
+    tensors = [model.preprocess(image)[0].copy() for image in images]
+    ort_input = model.session.get_inputs()[0].name
+    extra_inputs = model.nms_inputs(args.nms_thr, args.score_thr) or {}
+    latencies = []
+    for _ in range(args.runs):
+        for tensor in tensors:
+            start = time.perf_counter()
+            model.session.run(None, {ort_input: tensor[None], **extra_inputs})
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    detect = lambda image: model.detect(image, args.nms_thr, args.score_thr, args.conf)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(detect, images))
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            detections = list(executor.map(detect, images))
+        elapsed = time.perf_counter() - start
+    model_registry.unload(model_path)
+    return {
+        "sizeBytes": os.path.getsize(model_path),
+        "latencyMsP50": statistics.median(latencies),
+        "latencyMsP95": float(np.percentile(latencies, 95)),
+        "throughputImagesPerSecond": args.runs * len(images) / elapsed,
+        "detections": sum(len(image_detections) for image_detections in detections),
+    }, detections
+
+
+def agreement(reference: list, candidate: list, iou_thr: float) -> dict:
+    matched, ious, confidence_diffs = 0, [], []
+    for ref, cand in zip(reference, candidate):
+        image_matched, image_ious, image_diffs = match_detections(ref, cand, iou_thr)
+        matched += image_matched
+        ious += image_ious
+        confidence_diffs += image_diffs
+    reference_count = sum(len(ref) for ref in reference)
+    candidate_count = sum(len(cand) for cand in candidate)
+    precision = matched / candidate_count if candidate_count else 1.0
+    recall = matched / reference_count if reference_count else 1.0
+    return {
+        "matched": matched,
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        "meanIou": float(np.mean(ious)) if ious else None,
+        "meanConfidenceDiff": float(np.mean(confidence_diffs)) if confidence_diffs else None,
+    }
+
+
+def add_to_catalog(directory: str, input_path: str, results: dict) -> None:
+    """Insert the variants before their FP32 model in models.json, from the least to the most faithful one."""
+    catalog_file = os.path.join(directory, MODEL_CATALOG_FILE)
+    models = [
+        {"name": entry.name, "file": os.path.relpath(entry.path, directory), "architecture": entry.architecture,
+         "inputSize": entry.input_size, "latencyMs": entry.latency_ms, "accuracy": entry.accuracy,
+         "quantized": entry.quantized, "description": entry.description}
+        for entry in ModelCatalog.read_entries(directory).values()
+    ]
+    source_file = os.path.relpath(input_path, directory)
+    variant_files = {os.path.basename(result["file"]) for variant, result in results.items() if variant != "fp32"}
+    models = [model for model in models if model["file"] not in variant_files]
+    position = next((i for i, model in enumerate(models) if model["file"] == source_file), None)
+    if position is None:
+        models.append({"name": os.path.splitext(os.path.basename(input_path))[0], "file": source_file})
+        position = len(models) - 1
+    if models[position].get("latencyMs") is None and "error" not in results["fp32"]:
+        models[position]["latencyMs"] = round(results["fp32"]["latencyMsP50"], 1)
+    variants = sorted(
+        (result for variant, result in results.items() if variant != "fp32" and "error" not in result),
+        key=lambda result: result["agreement"]["f1"],
+    )
+    models[position:position] = [
+        {
+            "name": os.path.splitext(os.path.basename(result["file"]))[0],
+            "file": os.path.basename(result["file"]),
+            "latencyMs": round(result["latencyMsP50"], 1),
+            "quantized": True,
+            "description": f"{result['variant']} of {source_file}, F1 {result['agreement']['f1']:.3f} vs FP32",
+        }
+        for result in variants
+    ]
+    with open(catalog_file, "w") as f:
+        json.dump(models, f, indent=2)
+    print(f"Catalog updated: {catalog_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize an ONNX model and compare the variants to FP32")
+    parser.add_argument("--input", required=True, help="Path of the exported FP32 ONNX model")
+    parser.add_argument("--output-dir", help="Directory of the variants, the directory of the input by default")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument("--calibration-dir", help="Images used to calibrate the static quantization")
+    parser.add_argument("--calibration-images", type=int, default=100, help="Maximum number of calibration images")
+    parser.add_argument("--calibration-method", choices=list(CALIBRATION_METHODS), default="minmax")
+    parser.add_argument("--exclude-nodes", nargs="*", default=[], help="Nodes kept in FP32, e.g. the detection head")
+    parser.add_argument("--eval-dir", required=True, help="Fixed set of images the variants are compared on")
+    parser.add_argument("--eval-images", type=int, default=50, help="Maximum number of evaluation images")
+    parser.add_argument("--runs", type=int, default=3, help="Passes over the evaluation images for the timings")
+    parser.add_argument("--concurrency", type=int, default=1, help="Concurrent requests of the throughput run")
+    parser.add_argument("--match-iou", type=float, default=0.5)
+    parser.add_argument("--nms-thr", type=float, default=0.6)
+    parser.add_argument("--score-thr", type=float, default=0.1)
+    parser.add_argument("--conf", type=float, default=0.45)
+    parser.add_argument("--report", help="Path of the JSON report")
+    parser.add_argument("--catalog", action="store_true", help="Add the variants to models.json of the output directory")
+    parser.add_argument("--skip-build", action="store_true", help="Only report on the variants already built")
+    args = parser.parse_args()
+    if "int8_static" in args.variants and not args.skip_build and not args.calibration_dir:
+        parser.error("--calibration-dir is needed for the int8_static variant")
+
+    output_dir = args.output_dir or os.path.dirname(os.path.abspath(args.input))
+    base_name = os.path.splitext(os.path.basename(args.input))[0]
+    paths = {"fp32": args.input}
+    for variant in args.variants:
+        paths[variant] = os.path.join(output_dir, f"{base_name}_{variant}.onnx")
+        if not args.skip_build:
+            start = time.perf_counter()
+            build_variant(variant, args.input, paths[variant], args)
+            print(f"{variant} saved to {paths[variant]} in {time.perf_counter() - start:.1f} s")
+
+    images = [image for image in map(cv2.imread, image_paths(args.eval_dir, args.eval_images)) if image is not None]
+    results = {}
+    reference = None
+    for variant, path in paths.items():
+        try:
+            result, detections = evaluate(path, images, args)
+        except Exception as e:
+            if variant == "fp32":
+                # Every variant is compared with it, there is nothing to report without it
+                raise SystemExit(f"The FP32 model {path} could not be evaluated: {e}") from e
+            # e.g. an FP16 model with operators the CPU execution provider can't run in FP16
+            results[variant] = {"variant": variant, "file": path, "error": str(e)}
+            print(f"{variant}: evaluation failed: {e}")
+            continue
+        if variant == "fp32":
+            reference = detections
+        results[variant] = {"variant": variant, "file": path, **result,
+                            "agreement": agreement(reference, detections, args.match_iou)}
+
+    fp32 = results["fp32"]
+    print(f"\n{len(images)} images, {args.runs} runs, concurrency {args.concurrency}, boxes matched at IoU {args.match_iou}")
+    print(f"{'variant':>12} | {'size MB':>7} | {'p50 ms':>7} | {'p95 ms':>7} | {'img/s':>7} | {'speedup':>7} | "
+          f"{'boxes':>6} | {'precision':>9} | {'recall':>6} | {'mean IoU':>8} | {'conf diff':>9}")
+    for variant, result in results.items():
+        if "error" in result:
+            print(f"{variant:>12} | failed: {result['error'][:80]}")
+            continue
+        quality = result["agreement"]
+        print(f"{variant:>12} | {result['sizeBytes'] / 1e6:>7.1f} | {result['latencyMsP50']:>7.1f} | "
+              f"{result['latencyMsP95']:>7.1f} | {result['throughputImagesPerSecond']:>7.1f} | "
+              f"{fp32['latencyMsP50'] / result['latencyMsP50']:>6.2f}x | {result['detections']:>6} | "
+              f"{quality['precision']:>9.3f} | {quality['recall']:>6.3f} | "
+              f"{quality['meanIou'] if quality['meanIou'] is not None else float('nan'):>8.3f} | "
+              f"{quality['meanConfidenceDiff'] if quality['meanConfidenceDiff'] is not None else float('nan'):>9.2f}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"images": len(images), "runs": args.runs, "concurrency": args.concurrency,
+                       "matchIou": args.match_iou, "variants": results}, f, indent=2)
+        print(f"Report saved to {args.report}")
+    if args.catalog:
+        add_to_catalog(output_dir, os.path.abspath(args.input), results)
+
+
+if __name__ == "__main__":
+    main()
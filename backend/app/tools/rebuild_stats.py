@@ -0,0 +1,62 @@
+"""
+Recompute the stats collection from the images collection, e.g. after documents were deleted or
+edited by hand, or to initialize it on a database created before it existed.
+
+The stats are built into a temporary collection which then replaces the stats collection, so the
+summary reads never see a half rebuilt collection. Images saved by the backend while the rebuild
+runs may be missing from, or counted twice in, the rebuilt stats: run it with the backend stopped
+to get exact numbers.
+
+Usage (from backend/app):
+    python -m tools.rebuild_stats
+"""
+import argparse
+import time
+import pymongo
+from core.stats import STATS_COLLECTION, stats_updates
+from db.db_client import DATABASE, HOST, PORT, INDEXES
+
+REBUILD_COLLECTION = f"{STATS_COLLECTION}_rebuild"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the stats collection from the images collection")
+    parser.add_argument("--database", default=DATABASE)
+    parser.add_argument("--chunk", type=int, default=10000, help="Images read before every write of the stats")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(f"mongodb://{HOST}:{PORT}")
+    db = client[args.database]
+    rebuild = db[REBUILD_COLLECTION]
+    try:
+        start = time.perf_counter()
+        rebuild.drop()
+        count = 0
+        chunk = []
+        cursor = db["images"].find({}, {"_id": 0, "createdOn": 1, "crops": 1, "detections": 1})
+        for document in cursor.batch_size(args.chunk):
+            chunk.append(document)
+            if len(chunk) == args.chunk:
+                rebuild.bulk_write(stats_updates(chunk), ordered=False)
+                count += len(chunk)
+                chunk = []
+                print(f"\rProcessed {count} images", end="", flush=True)
+        if chunk:
+            rebuild.bulk_write(stats_updates(chunk), ordered=False)
+            count += len(chunk)
+        for name, keys, options in INDEXES:
+            if name == STATS_COLLECTION:
+                rebuild.create_index(keys, **options)
+        if count:
+            rebuild.rename(STATS_COLLECTION, dropTarget=True)
+        else:
+            db[STATS_COLLECTION].delete_many({})
+        print(f"\rRebuilt the stats of {count} images into {db[STATS_COLLECTION].estimated_document_count()} "
+              f"documents in {time.perf_counter() - start:.1f} s")
+    finally:
+        rebuild.drop()
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+from prometheus_client import Counter, Histogram
+
+# From 0.5 ms for the NMS of a few boxes to several seconds for tiled 4K images
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+STAGE_SECONDS = Histogram(
+    "yolox_stage_duration_seconds", "Time spent in every stage of the prediction pipeline", ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "yolox_http_request_duration_seconds", "Latency of the HTTP requests by route", ["route"], buckets=STAGE_BUCKETS,
+)
+REQUESTS = Counter("yolox_http_requests_total", "HTTP requests by route, method and status", ["route", "method", "status"])
+DETECTIONS = Counter("yolox_detections_total", "Objects detected, by class", ["class_name"])
+ERRORS = Counter("yolox_errors_total", "Failed requests, writes and batch images", ["source"])
+
+_local = threading.local()
+_stage_histograms = {}
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """
+    Observe the duration of the block in the stage histogram, and add it to the timings of the
+    request the current thread is working on, if any (see request_timings).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        histogram = _stage_histograms.get(stage)
+        if histogram is None:
+            histogram = _stage_histograms[stage] = STAGE_SECONDS.labels(stage)
+        histogram.observe(elapsed)
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def request_timings(timings: Optional[dict] = None):
+    """Collect the seconds spent in every stage by the current thread during the block into timings."""
+    previous = getattr(_local, "timings", None)
+    _local.timings = timings if timings is not None else {}
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+
+def server_timing(timings: dict) -> str:
+    """Server-Timing header value of the stage timings, in milliseconds."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def count_detections(class_counts: dict) -> None:
+    for class_name, count in class_counts.items():
+        DETECTIONS.labels(class_name).inc(count)
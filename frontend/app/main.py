@@ -52,9 +52,16 @@ with tab2:
             if 'images' in st.session_state:
                 del st.session_state['images']
             
-            # Fetch new image data from the backend and update the session state
-            new_images = requests.get(f"http://{api_url}/list-images").json()
-            st.session_state.images = new_images
+            # Fetch the first page of images from the backend and update the session state
+            page = requests.get(f"http://{api_url}/list-images").json()
+            st.session_state.images = page["items"]
+            st.session_state.next_cursor = page["nextCursor"]
+
+        # The backend returns the images page by page, newest first
+        if st.session_state.get('next_cursor') and st.button('Load more images'):
+            page = requests.get(f"http://{api_url}/list-images", params={"cursor": st.session_state.next_cursor}).json()
+            st.session_state.images += page["items"]
+            st.session_state.next_cursor = page["nextCursor"]
 
     # Display images if available in col2
     with col1:
@@ -85,73 +92,83 @@ with tab2:
 with tab3:
     col1, col2 = st.columns([1, 2])
 
-    # Fetch summary data when entering tab3
-    summary_response = requests.get(f"http://{api_url}/get-summary")
+    # Filters of the statistics, computed by the backend over the whole collection
+    with col1:
+        date_range = st.date_input("Prediction dates", value=())
+        selected_classes = st.multiselect("Classes", st.session_state.get('summary_classes', []))
+
+    params = {"classes": selected_classes}
+    if len(date_range) == 2:
+        params["date_from"] = f"{date_range[0]}T00:00:00"
+        params["date_to"] = f"{date_range[1]}T23:59:59"
+
+    # Fetch summary statistics when entering tab3
+    summary_response = requests.get(f"http://{api_url}/get-summary-stats", params=params)
     
     if summary_response.status_code == 200:
         summary_data = summary_response.json()
         
-        if summary_data:  # Check if the data is not empty
-            # Convert the summary data to a DataFrame
-            image_summaries = pd.DataFrame(summary_data)
-            
-            if not image_summaries.empty:
-                # Explode the crops field to get detailed crop data
-                crops = image_summaries.explode('crops').reset_index(drop=True)
-                
-                if not crops.empty:
-                    crops_details = pd.json_normalize(crops['crops'])
-                    
-                    if not crops_details.empty:
-                        # Create a dashboard of different graphics
-                        with col1:
-                            st.write("## Distribution of Classes")
-                            class_distribution = crops_details['class'].value_counts().sort_values(ascending=False)
-                            class_distribution_df = class_distribution.reset_index()
-                            class_distribution_df.columns = ['Class', 'Count']
-
-                            class_chart = alt.Chart(class_distribution_df).mark_bar().encode(
-                                x=alt.X('Class', sort=None),
-                                y='Count'
-                            )
-
-                            st.altair_chart(class_chart, use_container_width=True)
-
-                            st.write("## Average Confidence Levels per Class")
-                            confidence_levels = crops_details.groupby('class')['confidence'].mean().reset_index()
-                            confidence_levels.columns = ['Class', 'Average Confidence']
-
-                            confidence_chart = alt.Chart(confidence_levels).mark_bar().encode(
-                                x=alt.X('Class', sort=None),
-                                y='Average Confidence'
-                            )
-
-                            st.altair_chart(confidence_chart, use_container_width=True)
-
-                        with col2:
-                            st.write("## Number of Predictions per Image")
-                            num_predictions = image_summaries.set_index('originalFileName')['imageSummary'].apply(lambda x: sum(x.values()))
-                            num_predictions_df = num_predictions.reset_index()
-                            num_predictions_df.columns = ['Image', 'Number of predictions']
-
-                            predictions_chart = alt.Chart(num_predictions_df).mark_bar().encode(
-                                x=alt.X('Image', sort=None),
-                                y='Number of predictions'
-                            )
-
-                            st.altair_chart(predictions_chart, use_container_width=True)
-
-                            st.write("## Confidence Summary Statistics")
-                            confidence_distribution = crops_details['confidence']
-                            confidence_summary = confidence_distribution.describe().reset_index()
-                            confidence_summary.columns = ['Statistic', 'Value']
-                            st.table(confidence_summary)
-                    else:
-                        st.warning("Crops details are empty.")
+        if summary_data["detections"]:  # Check if the data is not empty
+            # Empty when the images are stored with DETECTIONS_STORAGE=columnar, which has no crops per class
+            classes = pd.DataFrame(summary_data["classes"], columns=["class", "count", "meanConfidence"])
+            if not selected_classes:
+                # Options of the class filter, from the unfiltered statistics
+                st.session_state.summary_classes = classes["class"].tolist()
+
+            # Create a dashboard of different graphics
+            with col1:
+                if classes.empty:
+                    st.info("No per-class statistics for these images")
                 else:
-                    st.warning("Crops data is empty.")
-            else:
-                st.warning("Image summaries are empty.")
+                    st.write("## Distribution of Classes")
+                    class_distribution_df = classes[["class", "count"]]
+                    class_distribution_df.columns = ['Class', 'Count']
+
+                    class_chart = alt.Chart(class_distribution_df).mark_bar().encode(
+                        x=alt.X('Class', sort=None),
+                        y='Count'
+                    )
+
+                    st.altair_chart(class_chart, use_container_width=True)
+
+                    st.write("## Average Confidence Levels per Class")
+                    confidence_levels = classes[["class", "meanConfidence"]]
+                    confidence_levels.columns = ['Class', 'Average Confidence']
+
+                    confidence_chart = alt.Chart(confidence_levels).mark_bar().encode(
+                        x=alt.X('Class', sort=None),
+                        y='Average Confidence'
+                    )
+
+                    st.altair_chart(confidence_chart, use_container_width=True)
+
+                # Daily counts, read from the statistics maintained by the backend on every insert
+                stats_params = {key: params[key] for key in ("date_from", "date_to") if key in params}
+                stats_response = requests.get(f"http://{api_url}/get-stats", params={"granularity": "day", **stats_params})
+                if stats_response.status_code == 200 and stats_response.json()["series"]:
+                    st.write("## Predictions per Day")
+                    series_df = pd.DataFrame(stats_response.json()["series"])[["bucket", "images", "detections"]]
+                    series_df.columns = ['Day', 'Images', 'Predictions']
+                    st.line_chart(series_df.set_index('Day'))
+
+            with col2:
+                st.write("## Images with the Most Predictions")
+                st.write(f"{summary_data['detections']} predictions in {summary_data['images']} images, "
+                         f"{summary_data['meanDetectionsPerImage']:.1f} per image on average")
+                num_predictions_df = pd.DataFrame(summary_data["topImages"])[["originalFileName", "detections"]]
+                num_predictions_df.columns = ['Image', 'Number of predictions']
+
+                predictions_chart = alt.Chart(num_predictions_df).mark_bar().encode(
+                    x=alt.X('Image', sort=None),
+                    y='Number of predictions'
+                )
+
+                st.altair_chart(predictions_chart, use_container_width=True)
+
+                st.write("## Confidence Summary Statistics")
+                confidence_summary = pd.DataFrame(list(summary_data["confidence"].items()))
+                confidence_summary.columns = ['Statistic', 'Value']
+                st.table(confidence_summary)
         else:
             st.warning("No images were predicted yet!")
     else: